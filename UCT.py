@@ -5,14 +5,21 @@ from tkinter import ttk, messagebox, filedialog
 from tkinter.scrolledtext import ScrolledText
 import shutil
 import subprocess
-import threading
 import webbrowser
-from queue import Queue, Empty
+from queue import Queue
 import ctypes
 import sys
-import time
 import logging
 
+from uct_core import (LOG_FILENAME, ConsoleBuffer, DrivesChanged, Job, JobScheduler, ProgressUpdate, ResultsHistory,
+                      analyze_drive, is_usb_drive, list_usb_drives, run_analysis, run_archive_backup, run_backup,
+                      run_benchmark, run_image, run_repair, run_store_backup, run_surface_test, start_logging,
+                      watch_drives)
+
+MAX_CONCURRENT_JOBS = 4  # Jobs running at once across all drives
+CONSOLE_MAX_LINES = 5000  # Lines kept in the output window
+BACKUP_TARGETS = ("Folder", "Shared store", "Archive (.tar.gz)", "Disk image (.img)")
+
 
 class USBCheckerApp:
     def __init__(self, root):
@@ -25,8 +32,13 @@ class USBCheckerApp:
 
         self.selected_drive = tk.StringVar()
         self.process_queue = Queue()
+        self.console = ConsoleBuffer(max_lines=CONSOLE_MAX_LINES)
+        self.history = ResultsHistory()  # Benchmark and analysis results, compared across sessions
+        self.scheduler = JobScheduler(max_concurrent=MAX_CONCURRENT_JOBS, process_queue=self.process_queue,
+                                      history=self.history)
+        self.closing = False
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.check_queue()
-        self.is_running = False
 
         # Setup logging
         self.setup_logging()
@@ -68,8 +80,40 @@ class USBCheckerApp:
                            "Repair the selected USB drive")
         self.create_button(button_frame, "Benchmark", self.run_benchmark_in_thread,
                            "Measure the read/write speed of the USB drive")
+        self.create_button(button_frame, "Surface Test", self.run_surface_test_in_thread,
+                           "Fill the free space with test data and verify it to find fake capacity and bad areas")
         self.create_button(button_frame, "Backup", self.run_backup_in_thread,
                            "Backup data from the USB drive")
+        self.create_button(button_frame, "Cancel", self.cancel_jobs,
+                           "Cancel queued and running jobs on the selected USB drive")
+
+        # Analysis and backup options
+        options_frame = tk.Frame(root, bg="#2e2e2e")
+        options_frame.pack()
+        self.incremental_backup = tk.BooleanVar(value=True)
+        incremental_check = tk.Checkbutton(options_frame, text="Incremental backup", variable=self.incremental_backup,
+                                           bg="#2e2e2e", fg="white", selectcolor="#1e1e1e",
+                                           activebackground="#2e2e2e", activeforeground="white")
+        incremental_check.pack(side=tk.LEFT, padx=5)
+        self.create_tooltip(incremental_check, "Only copy new or changed files and resume interrupted backups")
+        self.verify_backup = tk.BooleanVar(value=False)
+        verify_check = tk.Checkbutton(options_frame, text="Verify backup", variable=self.verify_backup,
+                                      bg="#2e2e2e", fg="white", selectcolor="#1e1e1e",
+                                      activebackground="#2e2e2e", activeforeground="white")
+        verify_check.pack(side=tk.LEFT, padx=5)
+        self.create_tooltip(verify_check, "Check every copied file against the original and write a SHA256SUMS file")
+        self.backup_target = tk.StringVar(value=BACKUP_TARGETS[0])
+        target_dropdown = ttk.Combobox(options_frame, textvariable=self.backup_target, values=BACKUP_TARGETS,
+                                       state="readonly", width=16)
+        target_dropdown.pack(side=tk.LEFT, padx=5)
+        self.create_tooltip(target_dropdown, "Back up into a folder, into a deduplicating store shared by many "
+                                             "drives, into one compressed archive, or as a raw disk image")
+        self.deep_analysis = tk.BooleanVar(value=False)
+        deep_check = tk.Checkbutton(options_frame, text="Deep analysis", variable=self.deep_analysis,
+                                    bg="#2e2e2e", fg="white", selectcolor="#1e1e1e",
+                                    activebackground="#2e2e2e", activeforeground="white")
+        deep_check.pack(side=tk.LEFT, padx=5)
+        self.create_tooltip(deep_check, "Also scan the files on the drive: sizes, largest files and folders, file types")
 
         # Output window
         self.result_display = ScrolledText(root, height=10, bg="#1e1e1e", fg="lime",
@@ -80,6 +124,8 @@ class USBCheckerApp:
         # Progress bar (animated)
         self.progress = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
         self.progress.pack(pady=5)
+        self.progress_label = tk.Label(root, text="", bg="#2e2e2e", fg="white", font=("Arial", 8))
+        self.progress_label.pack()
 
         # GitHub link
         github_frame = tk.Frame(root, bg="#2e2e2e")
@@ -89,25 +135,40 @@ class USBCheckerApp:
         github_link.pack()
         github_link.bind("<Button-1>", lambda e: webbrowser.open("https://github.com/pxelbrei/UCT"))
 
-        # Initial drive refresh
+        # Initial drive refresh, then follow drives being plugged in or removed
         self.refresh_drives()
+        watch_drives(self.process_queue)
 
     def setup_logging(self):
-        """Set up logging to a file with a maximum size of 10 MB."""
-        log_file = "usb_checker.log"
-        max_size = 10 * 1024 * 1024  # 10 MB
-
-        # Check if the log file exceeds the maximum size
-        if os.path.exists(log_file) and os.path.getsize(log_file) > max_size:
-            os.remove(log_file)  # Delete the log file if it's too large
-
-        logging.basicConfig(filename=log_file, level=logging.INFO,
-                            format="%(asctime)s - %(levelname)s - %(message)s")
+        """Set up logging to a file that is rotated at 10 MB, written by a background thread."""
+        start_logging(LOG_FILENAME)
         logging.info("USB Checker started.")
 
+    def on_close(self):
+        """Close the window; running jobs are cancelled first and get to clean up."""
+        if self.closing:
+            return
+        if self.scheduler.active_jobs():
+            if not messagebox.askyesno("Jobs Running", "Operations are still running. Cancel them and quit? "
+                                       "UCT closes once they have stopped and removed their partial files."):
+                return
+            self.process_queue.put("Cancelling running jobs before closing...\n")
+            for job in self.scheduler.active_jobs():
+                self.scheduler.cancel(job)
+        self.closing = True
+        self.close_when_idle()
+
+    def close_when_idle(self):
+        """Wait (without blocking the UI) for the jobs to stop, then write the history and close."""
+        if self.scheduler.active_jobs():
+            self.root.after(200, self.close_when_idle)
+            return
+        self.history.close()
+        self.root.destroy()
+
     def open_log_file(self):
         """Open the log file in the default text editor."""
-        log_file = "usb_checker.log"
+        log_file = LOG_FILENAME
         if os.path.exists(log_file):
             if sys.platform == "win32":
                 os.startfile(log_file)  # Windows
@@ -150,78 +211,41 @@ class USBCheckerApp:
         widget.bind("<Leave>", leave)
 
     def check_queue(self):
-        """Check the process queue for updates."""
-        try:
-            while True:
-                message = self.process_queue.get_nowait()
-                self.update_result_display(message)
-        except Empty:
-            pass
-        self.root.after(100, self.check_queue)
-
-    def refresh_drives(self):
+        """Check the process queue for updates and show all new text in one insert."""
+        text = self.console.drain(self.process_queue, self.handle_queue_object)
+        if text:
+            self.update_result_display(text)
+        self.root.after(self.console.interval, self.check_queue)
+
+    def handle_queue_object(self, message):
+        """Dispatch a non-text message from the process queue."""
+        if isinstance(message, Job):
+            self.handle_job_update(message)
+        elif isinstance(message, ProgressUpdate):
+            self.handle_progress_update(message)
+        elif isinstance(message, DrivesChanged):
+            self.refresh_drives(refresh=False)
+
+    def refresh_drives(self, refresh=True):
         """Refresh the list of available USB drives with additional information."""
         try:
             drives = []
-            for partition in psutil.disk_partitions():
-                # Check if the drive is a USB drive
-                if self.is_usb_drive(partition.device):
-                    drive_letter = partition.device
-                    drive_label = self.get_drive_label(drive_letter)  # Get drive label
-                    drive_info = f"{drive_letter} - {drive_label} ({partition.fstype})"  # Combined description
-                    drives.append((drive_letter, drive_info))  # Store drive letter and description
+            for drive_letter, drive_label, fstype in list_usb_drives(refresh=refresh):
+                drive_info = f"{drive_letter} - {drive_label} ({fstype})"  # Combined description
+                drives.append((drive_letter, drive_info))  # Store drive letter and description
 
             # Update dropdown values
             self.drive_dropdown["values"] = [drive_info for _, drive_info in drives]
             if drives:
-                self.drive_dropdown.set(drives[0][1])  # Select the first entry
+                if self.selected_drive.get() not in self.drive_dropdown["values"]:
+                    self.drive_dropdown.set(drives[0][1])  # Select the first entry
             else:
                 self.drive_dropdown.set("")
                 self.process_queue.put("No USB drives found.\n")
-        except psutil.Error as e:
+        except (psutil.Error, OSError) as e:
             self.process_queue.put(f"Error refreshing drives: {e}\n")
             logging.error(f"Error refreshing drives: {e}")
 
-    def is_usb_drive(self, drive_letter):
-        """Check if the drive is a USB drive."""
-        try:
-            # Windows: Check if the drive is removable
-            if sys.platform == "win32":
-                import ctypes
-                drive_type = ctypes.windll.kernel32.GetDriveTypeW(ctypes.c_wchar_p(drive_letter))
-                return drive_type == 2  # DRIVE_REMOVABLE = 2
-            else:
-                # Linux/macOS: Check if the drive is removable
-                return "removable" in psutil.disk_partitions(all=True)[0].opts
-        except Exception as e:
-            logging.error(f"Error checking if drive is USB: {e}")
-            return False
-
-    def get_drive_label(self, drive_letter):
-        """Get the label of the drive (if available)."""
-        try:
-            # Use `ctypes` to retrieve the drive label (Windows-specific)
-            if sys.platform == "win32":
-                volume_name_buffer = ctypes.create_unicode_buffer(1024)
-                file_system_buffer = ctypes.create_unicode_buffer(1024)
-                ctypes.windll.kernel32.GetVolumeInformationW(
-                    ctypes.c_wchar_p(drive_letter),
-                    volume_name_buffer,
-                    ctypes.sizeof(volume_name_buffer),
-                    None,
-                    None,
-                    None,
-                    file_system_buffer,
-                    ctypes.sizeof(file_system_buffer)
-                )
-                return volume_name_buffer.value.strip() or "No Label"
-            else:
-                # For Linux/macOS: Use `os.statvfs` or similar methods
-                return "No Label"
-        except Exception as e:
-            logging.error(f"Error getting drive label: {e}")
-            return "No Label"
-
     def extract_drive_letter(self, drive_info):
         """Extract the drive letter from the combined drive info string."""
         if drive_info:
@@ -247,7 +271,7 @@ class USBCheckerApp:
             return None
 
         # Check if the drive is a USB drive
-        if not self.is_usb_drive(drive_letter):
+        if not is_usb_drive(drive_letter):
             messagebox.showwarning("Warning", f"The drive {drive_letter} is not a USB drive.")
             return None
 
@@ -261,24 +285,22 @@ class USBCheckerApp:
             return
 
         try:
-            usage = shutil.disk_usage(selected_drive)
-            partitions = psutil.disk_partitions()
-            drive_info = next((p for p in partitions if p.device == selected_drive), None)
-
-            if drive_info:
-                message = (f"Drive: {selected_drive}\n"
-                           f"File System: {drive_info.fstype}\n"
-                           f"Total: {usage.total / (1024**3):.2f} GB\n"
-                           f"Used: {usage.used / (1024**3):.2f} GB\n"
-                           f"Free: {usage.free / (1024**3):.2f} GB\n")
-            else:
-                message = (f"Drive: {selected_drive}\n"
-                           f"Total: {usage.total / (1024**3):.2f} GB\n"
-                           f"Used: {usage.used / (1024**3):.2f} GB\n"
-                           f"Free: {usage.free / (1024**3):.2f} GB\n")
+            info = analyze_drive(selected_drive)
+
+            message = f"Drive: {selected_drive}\n"
+            if info["file_system"]:
+                message += f"File System: {info['file_system']}\n"
+            message += (f"Total: {info['total'] / (1024**3):.2f} GB\n"
+                        f"Used: {info['used'] / (1024**3):.2f} GB\n"
+                        f"Free: {info['free'] / (1024**3):.2f} GB\n")
 
             self.process_queue.put(message)
             logging.info(f"Analyzed drive: {selected_drive}")
+
+            if self.deep_analysis.get():
+                self.submit_job("analysis", selected_drive, run_analysis, deep=True)
+            else:
+                self.history.record("analysis", selected_drive, info)
         except OSError as e:
             self.process_queue.put(f"Error accessing drive: {e}\n")
             logging.error(f"Error accessing drive: {e}")
@@ -286,168 +308,124 @@ class USBCheckerApp:
             self.process_queue.put(f"Error analyzing drive usage: {e}\n")
             logging.error(f"Error analyzing drive usage: {e}")
 
-    def run_repair_in_thread(self):
-        """Run the USB repair process in a separate thread."""
-        if self.is_running:
-            self.process_queue.put("Another operation is already running.\n")
+    def submit_job(self, kind, drive, func, **kwargs):
+        """Queue an operation on a drive; jobs on other drives run at the same time."""
+        if not self.scheduler.active_jobs():
+            self.progress["value"] = 0
+            self.progress_label.config(text="")
+        if self.scheduler.is_busy(drive):
+            self.process_queue.put(f"{drive} is busy, the {kind} will start when the current job finishes.\n")
+        return self.scheduler.submit(kind, drive, func, **kwargs)
+
+    def handle_job_update(self, job):
+        """Show a job's state change and advance the progress bar (runs on the UI thread)."""
+        self.console.write(job.status_line() + "\n")
+        if job.state == Job.FAILED:
+            logging.error(job.status_line())
+        self.refresh_progress()
+
+    def handle_progress_update(self, update):
+        """Show the latest progress of a job (runs on the UI thread)."""
+        if update.job is not None:
+            self.progress_label.config(text=f"{update.job.kind} {update.job.device}: {update}")
+        else:
+            self.progress_label.config(text=str(update))
+        self.refresh_progress()
+
+    def refresh_progress(self):
+        """Set the bar to the combined progress of the current batch of jobs."""
+        active = self.scheduler.active_jobs()
+        if not active:
+            self.progress["value"] = 100
             return
 
-        drive = self.validate_drive()
+        batch = [j for j in self.scheduler.jobs if j.submitted >= min(a.submitted for a in active)]
+        done = 0.0
+        for job in batch:
+            if job.finished_state:
+                done += 1
+            elif job.progress is not None and job.progress.fraction is not None:
+                done += job.progress.fraction
+        self.progress["value"] = 100 * done / len(batch)
+
+    def cancel_jobs(self):
+        """Cancel queued and running jobs on the selected drive."""
+        drive = self.extract_drive_letter(self.selected_drive.get())
         if not drive:
+            self.process_queue.put("No drive selected.\n")
             return
+        cancelled = self.scheduler.cancel_device(drive)
+        if not cancelled:
+            self.process_queue.put(f"No jobs to cancel on {drive}.\n")
 
-        self.is_running = True
-        self.progress["value"] = 0
-        thread = threading.Thread(target=self.repair_usb, args=(drive,))
-        thread.start()
-
-    def repair_usb(self, drive):
-        """Repair the selected USB drive."""
-        try:
-            drive_letter = drive[0]
-            if not drive_letter.isalpha():
-                self.process_queue.put(f"Invalid drive letter: {drive_letter}\n")
-                return
-
-            # Run chkdsk with administrator privileges
-            if not ctypes.windll.shell32.IsUserAnAdmin():
-                self.process_queue.put("Error: Please run the program as an administrator.\n")
-                return
-
-            # Use the full path to chkdsk
-            chkdsk_path = os.path.join(os.getenv("SystemRoot"), "System32", "chkdsk.exe")
-            process = subprocess.Popen([chkdsk_path, f"{drive_letter}:", "/f"], stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE, text=True, shell=True,
-                                       creationflags=subprocess.CREATE_NO_WINDOW)
-
-            self.process_queue.put("Repairing USB...\n")
-
-            for line in iter(process.stdout.readline, ""):
-                self.process_queue.put(line)
-                self.progress["value"] += 10  # Simulate progress
+    def run_repair_in_thread(self):
+        """Queue a repair of the selected USB drive."""
+        drive = self.validate_drive()
+        if not drive:
+            return
 
-            self.process_queue.put("\nRepair completed.\n")
-            self.progress["value"] = 100
-            logging.info(f"Repaired drive: {drive}")
-        except subprocess.CalledProcessError as e:
-            self.process_queue.put(f"Error running chkdsk: {e}\n")
-            logging.error(f"Error running chkdsk: {e}")
-        except OSError as e:
-            self.process_queue.put(f"Error accessing drive: {e}\n")
-            logging.error(f"Error accessing drive: {e}")
-        except ctypes.WinError as e:
-            self.process_queue.put(f"Error with administrator privileges: {e}\n")
-            logging.error(f"Error with administrator privileges: {e}")
-        finally:
-            self.is_running = False
+        self.submit_job("repair", drive, run_repair)
 
     def run_benchmark_in_thread(self):
-        """Run the USB benchmark process in a separate thread."""
-        if self.is_running:
-            self.process_queue.put("Another operation is already running.\n")
-            return
-
+        """Queue a benchmark of the selected USB drive."""
         drive = self.validate_drive()
         if not drive:
             return
 
-        self.is_running = True
-        self.progress["value"] = 0
         self.process_queue.put("Starting benchmark... This may take a few moments.\n")
-        thread = threading.Thread(target=self.benchmark_usb, args=(drive,))
-        thread.start()
+        self.submit_job("benchmark", drive, run_benchmark)
 
-    def benchmark_usb(self, drive):
-        """Benchmark the selected USB drive."""
-        try:
-            self.process_queue.put("Running benchmark... Please wait.\n")
-
-            # Write test
-            start_time = time.time()
-            test_file = os.path.join(drive, "test_file.bin")
-            with open(test_file, "wb") as f:
-                f.write(os.urandom(100 * 1024 * 1024))  # Write 100 MB of random data
-            write_time = time.time() - start_time
-            write_speed = (100 / write_time)  # MB/s
-
-            # Read test
-            start_time = time.time()
-            with open(test_file, "rb") as f:
-                while f.read(1024 * 1024):  # Read in 1 MB chunks
-                    pass
-            read_time = time.time() - start_time
-            read_speed = (100 / read_time)  # MB/s
-
-            # Clean up
-            os.remove(test_file)
-
-            self.process_queue.put(f"Write speed: {write_speed:.2f} MB/s\n")
-            self.process_queue.put(f"Read speed: {read_speed:.2f} MB/s\n")
-            self.progress["value"] = 100
-            logging.info(f"Benchmarked drive: {drive} - Write: {write_speed:.2f} MB/s, Read: {read_speed:.2f} MB/s")
-        except OSError as e:
-            self.process_queue.put(f"Error accessing drive: {e}\n")
-            logging.error(f"Error accessing drive: {e}")
-        except IOError as e:
-            self.process_queue.put(f"Error during benchmark: {e}\n")
-            logging.error(f"Error during benchmark: {e}")
-        finally:
-            self.is_running = False
+    def run_surface_test_in_thread(self):
+        """Queue a surface test of the selected USB drive."""
+        drive = self.validate_drive()
+        if not drive:
+            return
 
-    def run_backup_in_thread(self):
-        """Run the USB backup process in a separate thread."""
-        if self.is_running:
-            self.process_queue.put("Another operation is already running.\n")
+        if not messagebox.askyesno("Surface Test", f"The surface test fills all free space on {drive} with test "
+                                   "data and reads it back. This can take hours. Continue?"):
             return
+        self.submit_job("surface test", drive, run_surface_test)
 
+    def run_backup_in_thread(self):
+        """Queue a backup of the selected USB drive."""
         drive = self.validate_drive()
         if not drive:
             return
 
+        target = self.backup_target.get()
+        if target == "Shared store":
+            store = filedialog.askdirectory(title="Select Backup Store")
+            if store:
+                self.submit_job("backup", drive, run_store_backup, store=store)
+            return
+        if target == "Archive (.tar.gz)":
+            archive = filedialog.asksaveasfilename(title="Save Archive As", defaultextension=".tar.gz",
+                                                   filetypes=[("Compressed tar archive", "*.tar.gz")])
+            if archive:
+                self.submit_job("backup", drive, run_archive_backup, destination=archive)
+            return
+        if target == "Disk image (.img)":
+            image = filedialog.asksaveasfilename(title="Save Disk Image As", defaultextension=".img",
+                                                 filetypes=[("Disk image", "*.img")])
+            if image:
+                self.submit_job("image", drive, run_image, image=image, allocation_map=True)
+            return
+
         backup_folder = filedialog.askdirectory(title="Select Backup Folder")
         if not backup_folder:
             return
 
-        self.is_running = True
-        self.progress["value"] = 0
-        thread = threading.Thread(target=self.backup_usb, args=(drive, backup_folder))
-        thread.start()
-
-    def backup_usb(self, drive, backup_folder):
-        """Backup data from the selected USB drive."""
-        try:
-            self.process_queue.put("Starting backup...\n")
-
-            for root, dirs, files in os.walk(drive):
-                relative_path = os.path.relpath(root, drive)
-                dest_path = os.path.join(backup_folder, relative_path)
-                os.makedirs(dest_path, exist_ok=True)
-
-                for file in files:
-                    src_file = os.path.join(root, file)
-                    dest_file = os.path.join(dest_path, file)
-                    shutil.copy2(src_file, dest_file)
-                    self.progress["value"] += 1  # Simulate progress
-
-            self.process_queue.put("\nBackup completed successfully.\n")
-            self.progress["value"] = 100
-            logging.info(f"Backed up drive: {drive} to {backup_folder}")
-        except OSError as e:
-            self.process_queue.put(f"Error accessing drive: {e}\n")
-            logging.error(f"Error accessing drive: {e}")
-        except shutil.Error as e:
-            self.process_queue.put(f"Error copying files: {e}\n")
-            logging.error(f"Error copying files: {e}")
-        except FileNotFoundError as e:
-            self.process_queue.put(f"File not found: {e}\n")
-            logging.error(f"File not found: {e}")
-        finally:
-            self.is_running = False
+        self.submit_job("backup", drive, run_backup, destination=backup_folder,
+                        incremental=self.incremental_backup.get(),
+                        verify="sha256" if self.verify_backup.get() else None)
 
     def update_result_display(self, text):
-        """Update the result display with new text."""
+        """Update the result display with new text, keeping only the last CONSOLE_MAX_LINES lines."""
         self.result_display.config(state="normal")
         self.result_display.insert(tk.END, text, "center")
+        lines = int(self.result_display.index("end-1c").split(".")[0])
+        if lines > CONSOLE_MAX_LINES:
+            self.result_display.delete("1.0", f"{lines - CONSOLE_MAX_LINES + 1}.0")
         self.result_display.see(tk.END)
         self.result_display.config(state="disabled")
 
@@ -458,7 +436,7 @@ if __name__ == "__main__":
         ctypes.windll.user32.ShowWindow(ctypes.windll.kernel32.GetConsoleWindow(), 6)  # 6 = SW_MINIMIZE
 
     # Check if the script is run as administrator
-    if not ctypes.windll.shell32.IsUserAnAdmin():
+    if sys.platform == "win32" and not ctypes.windll.shell32.IsUserAnAdmin():
         ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, " ".join(sys.argv), None, 1)
         sys.exit()
 
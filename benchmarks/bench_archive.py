@@ -0,0 +1,123 @@
+"""Compare ArchiveBackup with single-threaded tarfile on a synthetic tree.
+
+The tree mixes many small text files, a few large log-like files and some
+already compressed "photos" (random data with a .jpg extension). Each mode
+writes a compressed archive of the whole tree; the table shows time,
+throughput and archive size. Pulling one file out of the end of the archive
+is timed too: tarfile has to decompress everything before it, ArchiveIndex
+only the blocks that hold the file.
+
+    python benchmarks/bench_archive.py --small-files 20000 --logs 8 --log-size-mb 64 --photos 8
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import DEFAULT_ARCHIVE_WORKERS, ArchiveBackup, ArchiveIndex  # noqa: E402
+
+WORDS = ("usb drive backup error sector block read write flash cache device file folder data copy "
+         "verify size time speed mount label archive index chunk store snapshot").split()
+
+
+def text(rng, size):
+    """Return about ``size`` bytes of compressible text."""
+    lines = []
+    total = 0
+    while total < size:
+        line = f"{rng.randrange(10 ** 6):06d} " + " ".join(rng.choices(WORDS, k=12)) + "\n"
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()
+
+
+def build_tree(root, small_files, logs, log_size, photos, photo_size, seed=0):
+    """Create the synthetic source tree."""
+    rng = random.Random(seed)
+    sample = text(rng, 1024 * 1024)
+    for i in range(small_files):
+        folder = os.path.join(root, "docs", f"dir{i // 500:03d}")
+        if i % 500 == 0:
+            os.makedirs(folder)
+        start = rng.randrange(len(sample) - 8192)
+        with open(os.path.join(folder, f"note{i:05d}.txt"), "wb") as f:
+            f.write(sample[start:start + rng.randrange(512, 8192)])
+    os.makedirs(os.path.join(root, "logs"))
+    for i in range(logs):
+        with open(os.path.join(root, "logs", f"app{i}.log"), "wb") as f:
+            for _ in range(log_size // len(sample)):
+                f.write(text(rng, len(sample)) if _ % 8 == 0 else sample)
+    os.makedirs(os.path.join(root, "photos"))
+    for i in range(photos):
+        with open(os.path.join(root, "photos", f"img{i:03d}.jpg"), "wb") as f:
+            f.write(os.urandom(photo_size))
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--small-files", type=int, default=20000)
+    parser.add_argument("--logs", type=int, default=8)
+    parser.add_argument("--log-size-mb", type=int, default=64)
+    parser.add_argument("--photos", type=int, default=8)
+    parser.add_argument("--photo-size-mb", type=int, default=16)
+    parser.add_argument("--compression", choices=("gz", "xz"), default="gz")
+    parser.add_argument("--level", type=int, default=None, help="compression level for both (default: gz 6, xz 3)")
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, DEFAULT_ARCHIVE_WORKERS}))
+    parser.add_argument("--tmpdir", default=None, help="where to create the tree (default: system temp)")
+    args = parser.parse_args()
+
+    level = args.level if args.level is not None else (6 if args.compression == "gz" else 3)
+    base = tempfile.mkdtemp(prefix="uct-archive-", dir=args.tmpdir)
+    try:
+        source = os.path.join(base, "source")
+        print(f"Building tree in {source} ...")
+        build_tree(source, args.small_files, args.logs, args.log_size_mb * 1024 * 1024,
+                   args.photos, args.photo_size_mb * 1024 * 1024)
+        total = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(source) for f in files)
+        last = f"logs/app{args.logs - 1}.log"
+        extract_dir = os.path.join(base, "extract")
+
+        print(f"{'mode':>16} {'seconds':>9} {'MB/s':>9} {'archive MB':>11} {'extract one':>12}")
+        archive = os.path.join(base, f"tarfile.tar.{args.compression}")
+
+        def write_tarfile():
+            options = {"compresslevel": level} if args.compression == "gz" else {"preset": level}
+            with tarfile.open(archive, f"w:{args.compression}", **options) as tar:
+                tar.add(source, arcname=".")
+
+        def extract_tarfile():
+            with tarfile.open(archive) as tar:
+                tar.extract(f"./{last}", extract_dir)
+
+        seconds = timed(write_tarfile)
+        print(f"{'tarfile':>16} {seconds:>9.2f} {total / 2 ** 20 / seconds:>9.1f} "
+              f"{os.path.getsize(archive) / 2 ** 20:>11.1f} {timed(extract_tarfile):>11.3f}s")
+        os.remove(archive)
+
+        for workers in args.workers:
+            archive = os.path.join(base, f"uct-{workers}.tar.{args.compression}")
+            backup = ArchiveBackup(source, archive, compression=args.compression, level=level, workers=workers)
+            seconds = timed(backup.run)
+            index = ArchiveIndex(archive)
+            extract = timed(lambda: index.extract(extract_dir, [last]))
+            print(f"{f'uct x{workers}':>16} {seconds:>9.2f} {total / 2 ** 20 / seconds:>9.1f} "
+                  f"{os.path.getsize(archive) / 2 ** 20:>11.1f} {extract:>11.3f}s")
+            os.remove(archive)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
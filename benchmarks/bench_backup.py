@@ -0,0 +1,68 @@
+"""Compare ParallelBackup worker counts on a synthetic tree.
+
+The tree is built in a local temp directory: many small files spread over
+nested folders plus a few large files. Each worker count copies the tree into
+a fresh destination which is removed again afterwards.
+
+    python benchmarks/bench_backup.py --small-files 50000 --large-files 3 --large-size-mb 2048
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import ParallelBackup  # noqa: E402
+
+
+def build_tree(root, small_files, small_size, large_files, large_size, files_per_dir=500):
+    """Create the synthetic source tree."""
+    payload = os.urandom(small_size)
+    for i in range(small_files):
+        folder = os.path.join(root, f"dir{i // files_per_dir:04d}", f"sub{(i // 50) % 10}")
+        if i % 50 == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"file{i:06d}.dat"), "wb") as f:
+            f.write(payload)
+
+    chunk = os.urandom(16 * 1024 * 1024)
+    for i in range(large_files):
+        with open(os.path.join(root, f"large{i}.bin"), "wb") as f:
+            remaining = large_size
+            while remaining > 0:
+                n = min(remaining, len(chunk))
+                f.write(chunk[:n])
+                remaining -= n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--small-files", type=int, default=50000)
+    parser.add_argument("--small-size", type=int, default=4096, help="bytes per small file")
+    parser.add_argument("--large-files", type=int, default=3)
+    parser.add_argument("--large-size-mb", type=int, default=2048)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--tmpdir", default=None, help="where to create the tree (default: system temp)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-bench-", dir=args.tmpdir)
+    try:
+        source = os.path.join(base, "source")
+        os.makedirs(source)
+        print(f"Building tree in {source} ...")
+        build_tree(source, args.small_files, args.small_size, args.large_files, args.large_size_mb * 1024 * 1024)
+
+        print(f"{'workers':>8} {'seconds':>9} {'MB/s':>9} {'files/s':>9}")
+        for workers in args.workers:
+            dest = os.path.join(base, f"dest-{workers}")
+            stats = ParallelBackup(source, dest, workers=workers).run()
+            print(f"{workers:>8} {stats.elapsed:>9.2f} {stats.mb_per_second:>9.2f} {stats.files_per_second:>9.0f}")
+            shutil.rmtree(dest)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
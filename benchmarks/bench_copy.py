@@ -0,0 +1,84 @@
+"""Measure copy_file strategies: bytes/s and CPU seconds per GB.
+
+Each strategy copies the same test file several times inside every target
+directory (by default a tmpfs at /dev/shm if present, and the system temp dir
+on disk). CPU time is process user + system time, so work done inside the
+kernel on behalf of copy_file_range/sendfile is included.
+
+    python benchmarks/bench_copy.py --size-mb 1024 --repeat 3
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import COPY_STRATEGIES, copy_file  # noqa: E402
+
+
+def default_targets():
+    """Return the tmpfs and on-disk directories to benchmark."""
+    targets = []
+    if os.path.isdir("/dev/shm"):
+        targets.append("/dev/shm")
+    targets.append(tempfile.gettempdir())
+    return targets
+
+
+def make_file(path, size):
+    """Write ``size`` bytes of random data to ``path``."""
+    chunk = os.urandom(8 * 1024 * 1024)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, len(chunk))
+            f.write(chunk[:n])
+            remaining -= n
+
+
+def run_strategy(strategy, src, dst, repeat):
+    """Copy ``src`` to ``dst`` ``repeat`` times; return (wall seconds, cpu seconds)."""
+    wall = cpu = 0.0
+    for _ in range(repeat):
+        if os.path.exists(dst):
+            os.remove(dst)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if strategy == "shutil.copy2":
+            shutil.copy2(src, dst)
+        else:
+            copy_file(src, dst, strategy=strategy)
+        wall += time.perf_counter() - start_wall
+        cpu += time.process_time() - start_cpu
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--target", action="append", help="directory to test in (repeatable)")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    strategies = [s for s in COPY_STRATEGIES if s == "buffer" or hasattr(os, s)] + ["shutil.copy2"]
+    for target in args.target or default_targets():
+        base = tempfile.mkdtemp(prefix="uct-copy-", dir=target)
+        try:
+            src = os.path.join(base, "source.bin")
+            dst = os.path.join(base, "copy.bin")
+            make_file(src, size)
+            print(f"\n{target} ({args.size_mb} MB x {args.repeat})")
+            print(f"{'strategy':>16} {'MB/s':>10} {'CPU s/GB':>10}")
+            for strategy in strategies:
+                wall, cpu = run_strategy(strategy, src, dst, args.repeat)
+                total = size * args.repeat
+                print(f"{strategy:>16} {total / (1024 ** 2) / wall:>10.1f} {cpu / (total / 1024 ** 3):>10.3f}")
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
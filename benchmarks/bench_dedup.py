@@ -0,0 +1,108 @@
+"""Measure deduplicating store ingest throughput and dedup ratio.
+
+Builds ``--drives`` synthetic drive trees that share most of their content:
+every drive holds a random subset of a common pool of files (installers,
+datasets) plus a few files of its own. The drives are then backed up one
+after the other into a single ChunkStore and the store is restored once to
+check it. Prints ingest MB/s per drive, logical vs stored bytes and the
+resulting dedup ratio.
+
+    python benchmarks/bench_dedup.py --drives 20 --shared-files 40 --shared-size-mb 8
+"""
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import ChunkStore, StoreBackup, restore_snapshot  # noqa: E402
+
+
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(rng.randbytes(size))
+
+
+def build_drives(base, drives, shared_files, shared_size, unique_files, unique_size, share, seed=0):
+    """Create the drive trees; shared files are copied, so they are byte-identical."""
+    rng = random.Random(seed)
+    pool = os.path.join(base, "pool")
+    shared = [os.path.join(pool, f"installer{i:03d}.bin") for i in range(shared_files)]
+    for path in shared:
+        write_file(path, rng.randrange(shared_size // 2, shared_size + 1), rng)
+
+    roots = []
+    for d in range(drives):
+        root = os.path.join(base, f"drive{d:03d}")
+        for path in rng.sample(shared, int(len(shared) * share)):
+            target = os.path.join(root, "installers", os.path.basename(path))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+        for i in range(unique_files):
+            write_file(os.path.join(root, "documents", f"doc{i:03d}.dat"), unique_size, rng)
+        roots.append(root)
+    return roots
+
+
+def same_tree(left, right):
+    """Compare two trees file by file, contents included."""
+    for folder, dirs, files in os.walk(left):
+        other = os.path.join(right, os.path.relpath(folder, left))
+        if sorted(dirs + files) != sorted(os.listdir(other)):
+            return False
+        if not all(filecmp.cmp(os.path.join(folder, f), os.path.join(other, f), shallow=False) for f in files):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drives", type=int, default=20)
+    parser.add_argument("--shared-files", type=int, default=40)
+    parser.add_argument("--shared-size-mb", type=int, default=8)
+    parser.add_argument("--share", type=float, default=0.6, help="fraction of the shared pool on every drive")
+    parser.add_argument("--unique-files", type=int, default=20)
+    parser.add_argument("--unique-size", type=int, default=256 * 1024)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tmpdir", default=None, help="where to create the trees (default: system temp)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-dedup-", dir=args.tmpdir)
+    try:
+        print(f"Building {args.drives} drives in {base} ...")
+        roots = build_drives(base, args.drives, args.shared_files, args.shared_size_mb * 1024 * 1024,
+                             args.unique_files, args.unique_size, args.share)
+        store = ChunkStore(os.path.join(base, "store"))
+
+        logical = written = seconds = 0
+        print(f"{'drive':>9} {'MB':>9} {'new MB':>9} {'MB/s':>9}")
+        for root in roots:
+            backup = StoreBackup(root, store, os.path.basename(root), workers=args.workers)
+            stats = backup.run()
+            logical += stats.bytes
+            written += stats.new_bytes
+            seconds += stats.elapsed
+            print(f"{os.path.basename(root):>9} {stats.bytes / 2 ** 20:>9.1f} {stats.new_bytes / 2 ** 20:>9.1f} "
+                  f"{stats.mb_per_second:>9.1f}")
+
+        chunks, stored = store.usage()
+        print(f"\nIngested {logical / 2 ** 20:.1f} MB from {len(roots)} drives in {seconds:.2f} s "
+              f"({logical / 2 ** 20 / seconds:.1f} MB/s)")
+        print(f"Wrote {written / 2 ** 20:.1f} MB; the store holds {stored / 2 ** 20:.1f} MB in {chunks} chunks, "
+              f"dedup ratio {logical / stored:.2f}x")
+
+        restored = os.path.join(base, "restored")
+        restore_snapshot(store, store.snapshots(os.path.basename(roots[-1]))[-1], restored)
+        assert same_tree(roots[-1], restored), "restored tree differs"
+        print("Restore of the last drive matches the original")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark DriveEnumerator against a synthetic mount table.
+
+Builds a mountinfo file with thousands of overlay/tmpfs/proc mounts plus a
+few USB partitions, and a fake /sys/block tree, then times:
+
+- the old approach: one full mount table read for every partition (O(n^2)),
+- one uncached DriveEnumerator refresh,
+- a cached DriveEnumerator lookup.
+
+    python benchmarks/bench_drives.py --mounts 2000 --usb 4
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import DriveEnumerator, parse_mountinfo  # noqa: E402
+
+
+def build_fixture(base, mounts, usb):
+    """Write the synthetic mountinfo and /sys/block tree; return their paths."""
+    lines = []
+    for i in range(mounts):
+        kind = ("overlay", "tmpfs", "proc", "nsfs")[i % 4]
+        lines.append(f"{100 + i} 1 0:{50 + i} / /var/lib/containers/c{i}/merged rw,relatime shared:{i} - "
+                     f"{kind} {kind} rw,lowerdir=/a:/b")
+    sys_block = os.path.join(base, "block")
+    for d in range(usb):
+        disk = f"sd{chr(ord('b') + d)}"
+        os.makedirs(os.path.join(sys_block, disk, f"{disk}1"))
+        with open(os.path.join(sys_block, disk, "removable"), "w") as f:
+            f.write("1\n")
+        with open(os.path.join(sys_block, disk, "dev"), "w") as f:
+            f.write(f"8:{16 * (d + 1)}\n")
+        with open(os.path.join(sys_block, disk, f"{disk}1", "dev"), "w") as f:
+            f.write(f"8:{16 * (d + 1) + 1}\n")
+        lines.append(f"{5000 + d} 1 8:{16 * (d + 1) + 1} / /media/usb{d} rw,nosuid shared:9 - "
+                     f"vfat /dev/{disk}1 rw")
+    os.makedirs(os.path.join(sys_block, "nvme0n1"))
+    with open(os.path.join(sys_block, "nvme0n1", "removable"), "w") as f:
+        f.write("0\n")
+
+    mountinfo = os.path.join(base, "mountinfo")
+    with open(mountinfo, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return mountinfo, sys_block
+
+
+def legacy(mountinfo):
+    """Emulate the old loop: re-read the whole table for every partition."""
+    with open(mountinfo) as f:
+        partitions = parse_mountinfo(f.read())
+    found = 0
+    for _ in partitions:
+        with open(mountinfo) as f:
+            parse_mountinfo(f.read())
+        found += 1
+    return found
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mounts", type=int, default=2000)
+    parser.add_argument("--usb", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-drives-")
+    try:
+        mountinfo, sys_block = build_fixture(base, args.mounts, args.usb)
+        enumerator = DriveEnumerator(ttl=60, mountinfo_path=mountinfo, sys_block=sys_block,
+                                     by_label=os.path.join(base, "by-label"))
+        enumerator._enumerate = enumerator._enumerate_linux  # Use the fixture on any platform
+
+        legacy_ms, _ = timed(lambda: legacy(mountinfo), 1)
+        refresh_ms, drives = timed(lambda: enumerator.drives(refresh=True), args.repeat)
+        cached_ms, _ = timed(enumerator.drives, args.repeat * 100)
+
+        print(f"{args.mounts + args.usb} mounts, {len(drives)} USB drives found")
+        print(f"{'legacy O(n^2) scan':>22}: {legacy_ms:10.2f} ms")
+        print(f"{'enumerator refresh':>22}: {refresh_ms:10.2f} ms")
+        print(f"{'enumerator cached':>22}: {cached_ms:10.4f} ms")
+        assert len(drives) == args.usb, drives
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
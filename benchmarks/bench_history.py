@@ -0,0 +1,95 @@
+"""Measure the results history: recording cost for callers and query latency.
+
+Records ``--runs`` synthetic benchmark results for ``--drives`` drives, one
+batch (ResultsHistory instance) per round of all drives, with a few drives
+getting slower in the last round. Prints the time ``record`` takes on the
+calling thread, the write throughput of the writer thread and the latency of
+the usual queries on the filled database, and checks that exactly the slowed
+drives are flagged by ``regressions``.
+
+    python benchmarks/bench_history.py --runs 100000 --drives 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import ResultsHistory  # noqa: E402
+
+
+def benchmark_result(drive, write, read):
+    """A run_benchmark result with only the sequential profiles the history extracts."""
+    return {"drive": drive, "results": [
+        {"profile": "seq-write", "block_size": 1024 ** 2, "mb_per_second": {"mean": write}},
+        {"profile": "seq-read", "block_size": 1024 ** 2, "mb_per_second": {"mean": read}},
+    ]}
+
+
+def timed(label, func, repeats=20):
+    """Print the median latency of ``func`` in milliseconds and return its last result."""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+    print(f"{label:<28} {sorted(samples)[len(samples) // 2] * 1000:8.2f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=100000)
+    parser.add_argument("--drives", type=int, default=200)
+    parser.add_argument("--slowed", type=int, default=5, help="drives that get 40%% slower in the last batch")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    drives = [f"/media/bench/USB{d:04d}" for d in range(args.drives)]
+    speeds = {drive: rng.uniform(90, 110) for drive in drives}  # One model of stick
+    slowed = set(rng.sample(drives, args.slowed))
+    batches = max(1, args.runs // args.drives)
+
+    with tempfile.TemporaryDirectory(prefix="uct-history-") as base:
+        path = os.path.join(base, "history.sqlite3")
+        record_time = 0.0
+        start = time.perf_counter()
+        for b in range(batches):
+            history = ResultsHistory(path, batch=f"batch{b:05d}")
+            results = []
+            for drive in drives:
+                write = speeds[drive] * rng.uniform(0.95, 1.05)
+                if b == batches - 1 and drive in slowed:
+                    write *= 0.6
+                results.append(benchmark_result(drive, write, write * 1.5))
+            call_start = time.perf_counter()
+            for drive, result in zip(drives, results):
+                history.record("benchmark", drive, result)
+            record_time += time.perf_counter() - call_start
+            history.close()
+        elapsed = time.perf_counter() - start
+        runs = batches * len(drives)
+        print(f"Recorded {runs} runs of {len(drives)} drives in {batches} batches: "
+              f"{record_time / runs * 1e6:.1f} us per record() call, "
+              f"{runs / elapsed:.0f} runs/s written, {os.path.getsize(path) / 1024 ** 2:.1f} MB")
+
+        history = ResultsHistory(path)
+        key = history.drives()[0]["key"]
+        timed("runs of one drive", lambda: history.runs(drive=key, limit=100))
+        timed("latest runs", lambda: history.runs(limit=100))
+        timed("baseline vs latest (view)", lambda: history.write_speeds())
+        flagged = timed("regressions", lambda: history.regressions(threshold=0.2))
+        history.close()
+
+    found = {row["label"] for row in flagged}
+    expected = {os.path.basename(drive) for drive in slowed}
+    print(f"Flagged {len(found)} drives: {'OK' if found == expected else f'MISMATCH, expected {sorted(expected)}'}")
+    return 0 if found == expected else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Image a synthetic drive with DiskImager and restore it again.
+
+The "drive" is a regular file written in full (zeros included, like a real
+device) with ``--data-fraction`` of it covered by random data in scattered
+extents. Point ``--device`` at a loop device (``losetup -f --show
+drive.img``) or a real stick instead to image that. The harness images the
+drive with an allocation map, restores the image into a new file, checks
+that it matches byte for byte, and prints throughput, data and skipped
+bytes and the space the sparse image really takes.
+
+    python benchmarks/bench_image.py --size-mb 1024 --data-fraction 0.2
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import IMAGE_MAP_SUFFIX, DiskImager, read_allocation_map  # noqa: E402
+
+
+def build_drive(path, size, data_fraction, extent_size=4 * 1024 * 1024, seed=0):
+    """Write a drive file of zeros with random data extents spread over it."""
+    rng = random.Random(seed)
+    zeros = bytes(extent_size)
+    with open(path, "wb") as f:
+        for offset in range(0, size, extent_size):
+            n = min(extent_size, size - offset)
+            f.write(os.urandom(n) if rng.random() < data_fraction else zeros[:n])
+
+
+def same_contents(left, right, chunk=1024 * 1024):
+    """Compare two files or devices byte for byte."""
+    with open(left, "rb") as a, open(right, "rb") as b:
+        while True:
+            data = a.read(chunk)
+            if data != b.read(chunk):
+                return False
+            if not data:
+                return True
+
+
+def allocated(path):
+    return os.stat(path).st_blocks * 512 if hasattr(os.stat_result, "st_blocks") else os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--data-fraction", type=float, default=0.2)
+    parser.add_argument("--device", default=None, help="image this device or file instead of a synthetic one")
+    parser.add_argument("--direct", action="store_true", help="read with O_DIRECT")
+    parser.add_argument("--tmpdir", default=None, help="where to put the files (default: system temp)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-image-", dir=args.tmpdir)
+    try:
+        drive = args.device
+        if drive is None:
+            drive = os.path.join(base, "drive.bin")
+            build_drive(drive, args.size_mb * 1024 * 1024, args.data_fraction)
+
+        image = os.path.join(base, "drive.img")
+        stats = DiskImager(drive, image, direct=args.direct, map_out=image + IMAGE_MAP_SUFFIX).run()
+        extents = read_allocation_map(image + IMAGE_MAP_SUFFIX)[1]
+        print(f"image:   {stats.summary()}")
+        print(f"         sparse image takes {allocated(image) / 2 ** 20:.1f} MB on disk, "
+              f"allocation map lists {len(extents)} extents")
+
+        restored = os.path.join(base, "restored.bin")
+        stats = DiskImager(image, restored, map_in=image + IMAGE_MAP_SUFFIX).run()
+        print(f"restore: {stats.summary()}")
+        assert same_contents(drive, restored), "restored image differs from the drive"
+        print("Restored image matches the drive")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Measure what logging adds to a backup of many small files.
+
+Builds a tree of ``--files`` small files and backs it up once per logging
+mode: no log file, a plain FileHandler formatting and writing on the copy
+threads, and start_logging's queue with text or JSON lines, each at INFO
+(one summary per backup) and at DEBUG (a timing line per copied file). Prints the backup time of each
+mode, its overhead over the run without logging, the records written and
+how long the listener took to drain the queue after the backup returned.
+Use a tmpfs ``--tmpdir`` to see the CPU cost without device noise.
+
+    python benchmarks/bench_logging.py --files 100000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import TextLogFormatter, run_backup, start_logging, stop_logging  # noqa: E402
+
+MODES = (  # name, handler ("sync" or "queue"), structured, level
+    ("off", None, False, logging.WARNING),
+    ("sync text, per file", "sync", False, logging.DEBUG),
+    ("queue text", "queue", False, logging.INFO),
+    ("queue json", "queue", True, logging.INFO),
+    ("queue text, per file", "queue", False, logging.DEBUG),
+    ("queue json, per file", "queue", True, logging.DEBUG),
+)
+
+
+def build_tree(root, files, size, files_per_dir=500):
+    """Create ``files`` files of ``size`` bytes in folders of ``files_per_dir``."""
+    payload = os.urandom(size)
+    for i in range(files):
+        folder = os.path.join(root, f"dir{i // files_per_dir:04d}")
+        if i % files_per_dir == 0:
+            os.makedirs(folder)
+        with open(os.path.join(folder, f"file{i:06d}.dat"), "wb") as f:
+            f.write(payload)
+
+
+def reset_logging():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(logging.WARNING)
+
+
+def run_mode(source, destination, log_file, handler, structured, level):
+    """Back up once with one logging mode; returns (backup seconds, drain seconds)."""
+    reset_logging()
+    if handler == "queue":
+        start_logging(log_file, level=level, structured=structured, max_bytes=1024 ** 3)
+    elif handler == "sync":
+        file_handler = logging.FileHandler(log_file, encoding="utf-8")
+        file_handler.setFormatter(TextLogFormatter())
+        logging.getLogger().addHandler(file_handler)
+        logging.getLogger().setLevel(level)
+    if hasattr(os, "sync"):
+        os.sync()  # Do not let the previous run's writeback slow this one down
+    start = time.perf_counter()
+    run_backup(source, destination)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    stop_logging()
+    reset_logging()
+    return elapsed, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=1024, help="bytes per file")
+    parser.add_argument("--repeats", type=int, default=2, help="backups per mode, the fastest counts")
+    parser.add_argument("--tmpdir", default=None, help="where to create the tree (default: system temp)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-bench-", dir=args.tmpdir)
+    try:
+        source = os.path.join(base, "source")
+        print(f"Building {args.files} files in {source} ...")
+        build_tree(source, args.files, args.size)
+
+        best = {}  # mode -> (seconds, drain seconds, records); modes take turns so drift hits all alike
+        for repeat in range(args.repeats):
+            for name, handler, structured, level in MODES:
+                destination = os.path.join(base, "dest")
+                log_file = os.path.join(base, "bench.log")
+                elapsed, drain = run_mode(source, destination, log_file, handler, structured, level)
+                records = 0
+                if os.path.exists(log_file):
+                    with open(log_file, "rb") as f:
+                        records = sum(1 for _ in f)
+                    os.remove(log_file)
+                shutil.rmtree(destination)
+                if name not in best or elapsed < best[name][0]:
+                    best[name] = (elapsed, drain, records)
+
+        print(f"{'mode':<22} {'seconds':>8} {'overhead':>9} {'records':>8} {'drain s':>8}")
+        baseline = best[MODES[0][0]][0]
+        for name, _, _, _ in MODES:
+            elapsed, drain, records = best[name]
+            print(f"{name:<22} {elapsed:>8.2f} {(elapsed / baseline - 1) * 100:>8.1f}% {records:>8} {drain:>8.2f}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark deep_scan on a large synthetic tree.
+
+Creates a tree with ``--entries`` files and directories in a local temp
+directory, then times os.walk + os.stat (one stat per file) and deep_scan
+with several worker counts.
+
+    python benchmarks/bench_scan.py --entries 500000 --workers 1 4 16
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import deep_scan  # noqa: E402
+
+
+def build_tree(root, entries, files_per_dir=100, fanout=10):
+    """Create about ``entries`` files and directories, ``files_per_dir`` files each."""
+    created = 0
+    dirs = [root]
+    index = 0
+    while created < entries:
+        parent = dirs[index // fanout]
+        folder = os.path.join(parent, f"d{index}")
+        os.mkdir(folder)
+        dirs.append(folder)
+        created += 1
+        for i in range(min(files_per_dir, entries - created)):
+            with open(os.path.join(folder, f"f{i}.{('txt', 'jpg', 'bin', 'dat')[i % 4]}"), "wb") as f:
+                f.write(b"x" * (i * 37))
+            created += 1
+        index += 1
+
+
+def walk_and_stat(root):
+    """Baseline: what a naive os.walk based analysis costs."""
+    files = nbytes = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            nbytes += os.stat(os.path.join(dirpath, name)).st_size
+            files += 1
+    return files, nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=500000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--tmpdir", default=None, help="where to create the tree (default: system temp)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-scan-", dir=args.tmpdir)
+    try:
+        print(f"Building {args.entries} entries in {base} ...")
+        build_tree(base, args.entries)
+
+        start = time.perf_counter()
+        files, _ = walk_and_stat(base)
+        print(f"{'os.walk + stat':>16}: {time.perf_counter() - start:7.2f} s ({files} files)")
+        for workers in args.workers:
+            scan = deep_scan(base, workers=workers)
+            print(f"{f'deep_scan x{workers}':>16}: {scan.elapsed:7.2f} s ({scan.files} files, {scan.dirs} dirs)")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measure the cost of verified backups against a plain backup.
+
+Copies the same synthetic tree (a few large files plus many small ones) with
+ParallelBackup once without verification, once per VERIFY_ALGORITHMS
+entry and once as the GUI default does it: a verified first incremental
+run, which must not read the source more than the plain verified one. A
+verified backup leaves its data flushed to the device, so the plain run is
+timed including an ``os.sync()`` to compare like with like. The source is
+dropped from the page cache before every run.
+
+    python benchmarks/bench_verify.py --large-files 4 --large-size-mb 512 --small-files 5000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import DEFAULT_BACKUP_WORKERS, VERIFY_ALGORITHMS, BackupManifest, ParallelBackup  # noqa: E402
+
+
+def build_tree(root, large_files, large_size, small_files, small_size):
+    """Create the synthetic source tree."""
+    chunk = os.urandom(16 * 1024 * 1024)
+    for i in range(large_files):
+        with open(os.path.join(root, f"large{i}.bin"), "wb") as f:
+            remaining = large_size
+            while remaining > 0:
+                n = min(remaining, len(chunk))
+                f.write(chunk[:n])
+                remaining -= n
+    for i in range(small_files):
+        folder = os.path.join(root, f"dir{i // 500:04d}")
+        if i % 500 == 0:
+            os.makedirs(folder)
+        with open(os.path.join(folder, f"file{i:06d}.dat"), "wb") as f:
+            f.write(chunk[i:i + small_size])
+
+
+def drop_cache(root):
+    """Flush the tree and evict it from the page cache where the platform allows it."""
+    os.sync()
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for folder, _, files in os.walk(root):
+        for name in files:
+            fd = os.open(os.path.join(folder, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def run(source, dest, workers, verify, incremental=False):
+    """Back up once; return wall seconds including the flush to the device."""
+    drop_cache(source)
+    manifest = BackupManifest(dest, hash_name=verify) if incremental else None
+    start = time.perf_counter()
+    stats = ParallelBackup(source, dest, workers=workers, verify=verify, manifest=manifest).run()
+    os.sync()
+    elapsed = time.perf_counter() - start
+    assert not stats.verify_failures, stats.verify_failures
+    return elapsed, stats.bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--large-files", type=int, default=4)
+    parser.add_argument("--large-size-mb", type=int, default=512)
+    parser.add_argument("--small-files", type=int, default=5000)
+    parser.add_argument("--small-size", type=int, default=16 * 1024, help="bytes per small file")
+    parser.add_argument("--workers", type=int, default=DEFAULT_BACKUP_WORKERS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tmpdir", default=None, help="where to create the tree (default: system temp)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-verify-", dir=args.tmpdir)
+    try:
+        source = os.path.join(base, "source")
+        os.makedirs(source)
+        print(f"Building tree in {source} ...")
+        build_tree(source, args.large_files, args.large_size_mb * 1024 * 1024, args.small_files, args.small_size)
+
+        modes = [(None, False)] + [(verify, False) for verify in VERIFY_ALGORITHMS] + [("sha256", True)]
+        print(f"{'mode':>12} {'seconds':>9} {'MB/s':>9} {'overhead':>9}")
+        baseline = None
+        for verify, incremental in modes:
+            best = None
+            for _ in range(args.repeat):
+                dest = os.path.join(base, "dest")
+                elapsed, nbytes = run(source, dest, args.workers, verify, incremental)
+                shutil.rmtree(dest)
+                best = elapsed if best is None else min(best, elapsed)
+            baseline = baseline or best
+            label = (verify or "plain") + (" incr" if incremental else "")
+            print(f"{label:>12} {best:>9.2f} {nbytes / (1024 ** 2) / best:>9.1f} "
+                  f"{100 * (best / baseline - 1):>8.1f}%")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
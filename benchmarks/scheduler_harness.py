@@ -0,0 +1,118 @@
+"""Exercise JobScheduler against several temp-directory "drives".
+
+Every drive gets a backup and a benchmark job, and one extra queued job is
+cancelled before it starts. The harness checks that no device ever runs two
+jobs at once, that the global concurrency cap holds, and prints the jobs as
+JSON.
+
+    python benchmarks/scheduler_harness.py --drives 8 --max-concurrent 4
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from queue import Queue, Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import Job, JobScheduler, run_backup, run_benchmark  # noqa: E402
+
+
+class Tracker:
+    """Wrap job functions to record how many jobs run per device and in total."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.per_device = {}
+        self.running = 0
+        self.max_running = 0
+        self.violations = []
+
+    def wrap(self, func):
+        def tracked(device, **kwargs):
+            with self.lock:
+                self.per_device[device] = self.per_device.get(device, 0) + 1
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                if self.per_device[device] > 1:
+                    self.violations.append(device)
+            try:
+                return func(device, **kwargs)
+            finally:
+                with self.lock:
+                    self.per_device[device] -= 1
+                    self.running -= 1
+        return tracked
+
+
+def make_drive(path, files, size):
+    """Fill a directory with a few nested files."""
+    for i in range(files):
+        folder = os.path.join(path, f"dir{i % 4}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"file{i}.dat"), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drives", type=int, default=8)
+    parser.add_argument("--max-concurrent", type=int, default=4)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=16 * 1024)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-sched-")
+    messages = Queue()
+    tracker = Tracker()
+    scheduler = JobScheduler(max_concurrent=args.max_concurrent, process_queue=messages)
+    try:
+        drives = []
+        for i in range(args.drives):
+            drive = os.path.join(base, f"drive{i}")
+            make_drive(drive, args.files, args.file_size)
+            drives.append(drive)
+
+        start = time.perf_counter()
+        cancelled = []
+        for i, drive in enumerate(drives):
+            scheduler.submit("backup", drive, tracker.wrap(run_backup),
+                             destination=os.path.join(base, f"backup{i}"), incremental=True)
+            scheduler.submit("benchmark", drive, tracker.wrap(run_benchmark), profiles=("seq-write", "seq-read"),
+                             block_sizes=(1024 * 1024,), file_size=8 * 1024 * 1024, repeats=1)
+            extra = scheduler.submit("benchmark", drive, tracker.wrap(run_benchmark))
+            scheduler.cancel(extra)
+            cancelled.append(extra)
+        scheduler.wait()
+        elapsed = time.perf_counter() - start
+
+        updates = 0
+        while True:
+            try:
+                if isinstance(messages.get_nowait(), Job):
+                    updates += 1
+            except Empty:
+                break
+
+        states = [job.state for job in scheduler.jobs]
+        print(json.dumps([job.to_dict() for job in scheduler.jobs if job.state != Job.DONE], indent=2))
+        print(f"{len(scheduler.jobs)} jobs in {elapsed:.2f} s, {updates} job updates, "
+              f"max concurrent {tracker.max_running}/{args.max_concurrent}")
+
+        assert not tracker.violations, f"devices ran two jobs at once: {tracker.violations}"
+        assert tracker.max_running <= args.max_concurrent, "concurrency cap exceeded"
+        assert all(job.state == Job.CANCELLED and job.started is None for job in cancelled)
+        assert states.count(Job.DONE) == 2 * args.drives, states
+        for i, drive in enumerate(drives):
+            assert len(os.listdir(os.path.join(base, f"backup{i}"))) == len(os.listdir(drive)) + 1  # + manifest
+        print("OK")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Stress the output console with a flood of messages.
+
+Producer threads put messages on a queue while a simulated UI loop drains
+it once per tick, the way USBCheckerApp.check_queue does. For both the
+batched ConsoleBuffer and the old one-insert-per-message loop it reports the
+UI-thread time per tick (p50/p99/max), the number of ticks and inserts, and
+the peak traced memory. With --tk a real ScrolledText widget is used (needs
+a display); otherwise a stand-in widget that keeps the same number of lines.
+
+    python benchmarks/stress_console.py --messages 1000000
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from queue import Queue, Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_core import ConsoleBuffer, percentile  # noqa: E402
+
+MAX_LINES = 5000
+
+
+class FakeText:
+    """Stand-in for the ScrolledText widget: keeps the last MAX_LINES lines."""
+
+    def __init__(self):
+        self.lines = deque(maxlen=MAX_LINES)
+        self.inserts = 0
+
+    def insert(self, text):
+        self.inserts += 1
+        self.lines.extend(text.splitlines())
+
+
+class TkText:
+    """The real widget, updated like update_result_display does."""
+
+    def __init__(self):
+        import tkinter as tk
+        from tkinter.scrolledtext import ScrolledText
+        self.tk = tk
+        self.root = tk.Tk()
+        self.widget = ScrolledText(self.root, state="disabled")
+        self.widget.pack()
+        self.inserts = 0
+
+    def insert(self, text):
+        self.inserts += 1
+        self.widget.config(state="normal")
+        self.widget.insert(self.tk.END, text)
+        lines = int(self.widget.index("end-1c").split(".")[0])
+        if lines > MAX_LINES:
+            self.widget.delete("1.0", f"{lines - MAX_LINES + 1}.0")
+        self.widget.see(self.tk.END)
+        self.widget.config(state="disabled")
+        self.root.update_idletasks()
+
+
+def produce(queue, count, producers):
+    """Fill the queue from several threads."""
+    def worker(n, offset):
+        for i in range(n):
+            queue.put(f"Copied file {offset + i:07d}.dat\n")
+
+    per_producer = count // producers
+    threads = [threading.Thread(target=worker, args=(per_producer, p * per_producer)) for p in range(producers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run(mode, args):
+    queue = Queue()
+    widget = TkText() if args.tk else FakeText()
+    console = ConsoleBuffer(max_lines=MAX_LINES)
+    tick_times = []
+
+    tracemalloc.start()
+    threads = produce(queue, args.messages, args.producers)
+    start = time.perf_counter()
+    while True:
+        tick_start = time.perf_counter()
+        if mode == "batched":
+            text = console.drain(queue)
+            if text:
+                widget.insert(text)
+            delay = console.interval
+        else:
+            try:
+                while True:
+                    widget.insert(queue.get_nowait())
+            except Empty:
+                pass
+            delay = 100
+        tick_times.append((time.perf_counter() - tick_start) * 1000)
+        if queue.empty() and not any(thread.is_alive() for thread in threads):
+            break
+        time.sleep(delay / 1000 * args.time_scale)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ticks = sorted(tick_times)
+    print(f"{mode:>8}: {len(ticks):6d} ticks, {widget.inserts:8d} inserts, "
+          f"tick p50 {percentile(ticks, 50):8.2f} ms, p99 {percentile(ticks, 99):8.2f} ms, "
+          f"max {ticks[-1]:8.2f} ms, peak memory {peak / 1024 ** 2:7.1f} MB, total {elapsed:6.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--producers", type=int, default=4)
+    parser.add_argument("--mode", choices=("batched", "legacy", "both"), default="both")
+    parser.add_argument("--tk", action="store_true", help="insert into a real Tk widget")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="scale the polling delays")
+    args = parser.parse_args()
+
+    for mode in ("batched", "legacy") if args.mode == "both" else (args.mode,):
+        run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
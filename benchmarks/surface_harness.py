@@ -0,0 +1,134 @@
+"""Run SurfaceTest against image files, including a simulated fake drive.
+
+The fake drive reports ``--reported`` bytes but only stores ``--real`` bytes:
+like counterfeit sticks, writes past the real capacity wrap around and
+overwrite the start. The harness checks that the test finds the real
+capacity and the wrap-around, that a clean image verifies without errors,
+that a few flipped bytes are pinpointed to their sectors, and that a
+directory target is filled and cleaned up. Throughput is printed for each.
+
+    python benchmarks/surface_harness.py --reported 256M --real 64M
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uct_cli import parse_size  # noqa: E402
+from uct_core import SURFACE_SECTOR_SIZE, SurfaceTest  # noqa: E402
+
+
+class WrappingFile:
+    """File wrapper that maps every offset modulo the real capacity."""
+
+    def __init__(self, raw, capacity):
+        self.raw = raw
+        self.capacity = capacity
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.raw.close()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def _io(self, func, view):
+        n = min(len(view), self.capacity - self.pos % self.capacity)
+        self.raw.seek(self.pos % self.capacity)
+        n = func(view[:n])
+        self.pos += n
+        return n
+
+    def write(self, view):
+        return self._io(self.raw.write, view)
+
+    def readinto(self, view):
+        return self._io(self.raw.readinto, view)
+
+
+class FakeDriveTest(SurfaceTest):
+    """SurfaceTest whose target only holds ``capacity`` bytes."""
+
+    capacity = 0
+
+    def _open(self, path, flags, mode):
+        return WrappingFile(super()._open(path, flags, mode), self.capacity)
+
+
+def make_image(path, size):
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+def report(name, result):
+    print(f"{name}: usable {result.usable_capacity >> 20} MB of {result.verified_bytes >> 20} MB, "
+          f"{len(result.ranges)} bad ranges, write {result.write_mb_per_second:.0f} MB/s, "
+          f"read {result.read_mb_per_second:.0f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reported", type=parse_size, default=256 * 1024 * 1024)
+    parser.add_argument("--real", type=parse_size, default=64 * 1024 * 1024)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="uct-surface-")
+    try:
+        image = os.path.join(base, "clean.img")
+        make_image(image, args.reported)
+        result = SurfaceTest(image, destructive=True).run()
+        report("clean image", result)
+        assert result.corrupted_bytes == 0 and result.usable_capacity == args.reported
+
+        fake = os.path.join(base, "fake.img")
+        make_image(fake, args.reported)
+        FakeDriveTest.capacity = args.real
+        result = FakeDriveTest(fake, destructive=True).run()
+        report("fake drive", result)
+        assert result.usable_capacity == args.real, result.usable_capacity
+        assert result.ok_bytes == args.real and result.aliased_bytes == args.reported - args.real
+        # The start of the drive was overwritten last, by data written at the final wrap
+        assert result.first_alias == (0, args.reported - args.real), result.first_alias
+
+        # Flip a byte in two places; only their sectors may be reported
+        flipped = (5 * 1024 * 1024 + 100, args.real // 2 + SURFACE_SECTOR_SIZE - 1)
+        test = SurfaceTest(image, size=args.real, destructive=True, seed=1)
+        original = test._write_segment
+
+        def write_then_flip(result, block, path, offset, length):
+            original(result, block, path, offset, length)
+            with open(path, "r+b") as f:
+                for offset in flipped:
+                    f.seek(offset)
+                    value = f.read(1)[0]
+                    f.seek(offset)
+                    f.write(bytes([value ^ 0xFF]))
+
+        test._write_segment = write_then_flip
+        result = test.run()
+        report("flipped bytes", result)
+        sectors = [[o - o % SURFACE_SECTOR_SIZE, o - o % SURFACE_SECTOR_SIZE + SURFACE_SECTOR_SIZE] for o in flipped]
+        assert result.ranges == sectors and result.aliased_bytes == 0, result.ranges
+
+        folder = os.path.join(base, "drive")
+        os.mkdir(folder)
+        result = SurfaceTest(folder, size=args.real, file_size=args.real // 3).run()
+        report("directory", result)
+        assert result.corrupted_bytes == 0 and result.verified_bytes == args.real
+        assert not os.listdir(folder), "test files were not removed"
+        print("OK")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
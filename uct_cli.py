@@ -0,0 +1,286 @@
+"""Command line interface for UCT without the GUI.
+
+Every subcommand prints its results as JSON on stdout; progress messages go
+to stderr with ``--verbose``. Results of analyze, bench and surface are also
+recorded in a SQLite history (``--history``, off with ``--no-history``).
+
+    python uct_cli.py drives
+    python uct_cli.py analyze E:\\ F:\\
+    python uct_cli.py bench /media/usb --profile seq-write --profile seq-read --block-size 1M
+    python uct_cli.py backup /media/usb /srv/backups/usb1 --workers 8 --incremental --verify
+    python uct_cli.py backup /media/usb /srv/store --store
+    python uct_cli.py --log uct.jsonl --log-json --log-files backup /media/usb /srv/backups/usb1
+    python uct_cli.py restore /srv/store usb /tmp/usb-restored
+    python uct_cli.py backup /media/usb /srv/archives --archive xz
+    python uct_cli.py extract /srv/archives/usb-20250101-120000.tar.xz /tmp/out docs/report.pdf
+    python uct_cli.py image /dev/sdb usb.img --map
+    python uct_cli.py surface /media/usb
+    python uct_cli.py history --regressions --threshold 0.3
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import sys
+
+import uct_core
+
+
+class StderrQueue:
+    """Stand-in for the GUI's process queue that prints messages to stderr."""
+
+    def put(self, message):
+        if isinstance(message, uct_core.ProgressUpdate):
+            message = f"{message}\n"
+        sys.stderr.write(message)
+        sys.stderr.flush()
+
+
+def parse_size(text):
+    """Parse sizes like 4096, 4K, 16M or 1G into bytes."""
+    text = text.strip().upper().rstrip("B")
+    factors = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text and text[-1] in factors:
+        return int(float(text[:-1]) * factors[text[-1]])
+    return int(text)
+
+
+def cmd_drives(args, progress):
+    """List mounted USB drives."""
+    return [{"drive": device, "label": label, "file_system": fstype}
+            for device, label, fstype in uct_core.list_usb_drives()]
+
+
+def cmd_analyze(args, progress):
+    """Analyze one or more drives."""
+    if args.deep:
+        return [uct_core.run_analysis(drive, process_queue=progress, workers=args.workers) for drive in args.drives]
+    return [uct_core.analyze_drive(drive) for drive in args.drives]
+
+
+def cmd_bench(args, progress):
+    """Benchmark one or more drives (or directories)."""
+    return [uct_core.run_benchmark(drive,
+                                   process_queue=progress,
+                                   profiles=args.profile or uct_core.BENCHMARK_PROFILES,
+                                   block_sizes=args.block_size or uct_core.BENCHMARK_BLOCK_SIZES,
+                                   file_size=args.file_size,
+                                   repeats=args.repeats,
+                                   queue_depth=args.queue_depth,
+                                   fsync=not args.no_fsync,
+                                   direct=args.direct)
+            for drive in args.drives]
+
+
+def cmd_backup(args, progress):
+    """Back up a drive into a folder or a deduplicating store."""
+    if args.store:
+        return uct_core.run_store_backup(args.source, args.destination, name=args.name, process_queue=progress,
+                                         workers=args.workers)
+    if args.archive:
+        return uct_core.run_archive_backup(args.source, args.destination, compression=args.archive,
+                                           level=args.level, process_queue=progress,
+                                           workers=args.archive_workers)
+    return uct_core.run_backup(args.source, args.destination, process_queue=progress,
+                               incremental=args.incremental, hash_name=args.hash, verify=args.verify,
+                               workers=args.workers)
+
+
+def cmd_restore(args, progress):
+    """Restore a drive's snapshot from a deduplicating store."""
+    return uct_core.run_restore(args.store, args.name, args.destination, snapshot=args.snapshot,
+                                process_queue=progress)
+
+
+def cmd_snapshots(args, progress):
+    """List the snapshots in a deduplicating store."""
+    store = uct_core.ChunkStore(args.store)
+    return {name: store.snapshots(name) for name in ([args.name] if args.name else store.names())}
+
+
+def cmd_list(args, progress):
+    """List the members of an archive through its side index."""
+    return [{"name": name, "type": kind, "size": size, "mtime": mtime}
+            for name, kind, size, mtime in uct_core.ArchiveIndex(args.archive).list()]
+
+
+def cmd_extract(args, progress):
+    """Extract members of an archive through its side index."""
+    count = uct_core.ArchiveIndex(args.archive).extract(args.destination, args.members or None)
+    return {"archive": args.archive, "destination": args.destination, "extracted": count}
+
+
+def cmd_image(args, progress):
+    """Image a raw device into a sparse file."""
+    return uct_core.run_image(args.source, args.image, process_queue=progress, allocation_map=args.map,
+                              direct=args.direct, block_size=args.block_size)
+
+
+def cmd_image_restore(args, progress):
+    """Write an image back to a device."""
+    return uct_core.run_image_restore(args.image, args.target, process_queue=progress, direct=args.direct,
+                                      block_size=args.block_size)
+
+
+def cmd_surface(args, progress):
+    """Fill a drive with test data and verify it."""
+    return uct_core.run_surface_test(args.target, process_queue=progress, size=args.size,
+                                     destructive=args.destructive, keep_files=args.keep_files,
+                                     direct=args.direct, seed=args.seed)
+
+
+def cmd_history(args, progress):
+    """Show recorded runs, or the drives that got slower."""
+    history = uct_core.ResultsHistory(args.history)
+    try:
+        if args.regressions:
+            return history.regressions(threshold=args.threshold, kind=args.kind or "benchmark")
+        return history.runs(drive=args.drive, kind=args.kind, limit=args.limit)
+    finally:
+        history.close()
+
+
+def build_parser():
+    """Build the argument parser."""
+    parser = argparse.ArgumentParser(prog="uct", description="USB Checker (UCT) command line interface")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print progress messages to stderr")
+    parser.add_argument("--indent", type=int, default=None, help="indent the JSON output")
+    parser.add_argument("--history", default=uct_core.HISTORY_FILENAME, help="results history database")
+    parser.add_argument("--no-history", action="store_true", help="do not record results in the history")
+    parser.add_argument("--log", default=None, help="also write a rotating log file, e.g. usb_checker.log")
+    parser.add_argument("--log-json", action="store_true", help="write the log as JSON lines with drive, op, "
+                                                                "bytes, duration and throughput fields")
+    parser.add_argument("--log-files", action="store_true", help="log the copy time of every backed up file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    drives = subparsers.add_parser("drives", help="list mounted USB drives")
+    drives.set_defaults(func=cmd_drives)
+
+    analyze = subparsers.add_parser("analyze", help="report capacity and usage")
+    analyze.add_argument("drives", nargs="+")
+    analyze.add_argument("--deep", action="store_true", help="also scan file sizes, types and largest entries")
+    analyze.add_argument("--workers", type=int, default=uct_core.DEFAULT_SCAN_WORKERS)
+    analyze.set_defaults(func=cmd_analyze, record_kind="analysis")
+
+    bench = subparsers.add_parser("bench", help="run the I/O benchmark")
+    bench.add_argument("drives", nargs="+", help="drive or directory to write the test file into")
+    bench.add_argument("--profile", action="append", choices=uct_core.BENCHMARK_PROFILES,
+                       help="profile to run (repeatable, default: all)")
+    bench.add_argument("--block-size", action="append", type=parse_size,
+                       help="sequential block size, e.g. 4K or 16M (repeatable)")
+    bench.add_argument("--file-size", type=parse_size, default=uct_core.BENCHMARK_FILE_SIZE)
+    bench.add_argument("--repeats", type=int, default=3)
+    bench.add_argument("--queue-depth", type=int, default=1)
+    bench.add_argument("--no-fsync", action="store_true", help="do not flush writes or drop the page cache")
+    bench.add_argument("--direct", action="store_true", help="bypass the page cache with O_DIRECT")
+    bench.set_defaults(func=cmd_bench, record_kind="benchmark")
+
+    backup = subparsers.add_parser("backup", help="copy a drive into a folder")
+    backup.add_argument("source")
+    backup.add_argument("destination")
+    backup.add_argument("--workers", type=int, default=uct_core.DEFAULT_BACKUP_WORKERS)
+    backup.add_argument("--incremental", action="store_true", help="skip files unchanged since the last backup")
+    backup.add_argument("--hash", default=None, help="hash algorithm recorded in the manifest, e.g. blake2b")
+    backup.add_argument("--verify", nargs="?", const="sha256", choices=uct_core.VERIFY_ALGORITHMS,
+                        help="hash every file while copying, check the copy read back from the device "
+                             "and write a checksum file (default: sha256)")
+    backup.add_argument("--store", action="store_true",
+                        help="treat the destination as a deduplicating chunk store shared by many drives")
+    backup.add_argument("--name", default=None, help="snapshot name in the store (default: the drive label)")
+    backup.add_argument("--archive", choices=uct_core.ARCHIVE_FORMATS,
+                        help="write one compressed tar archive (destination: file or folder) with a side index")
+    backup.add_argument("--level", type=int, default=None, help="compression level (gzip 0-9, xz 0-9)")
+    backup.add_argument("--archive-workers", type=int, default=uct_core.DEFAULT_ARCHIVE_WORKERS,
+                        help="compression processes (default: one per core)")
+    backup.set_defaults(func=cmd_backup)
+
+    restore = subparsers.add_parser("restore", help="rebuild a drive's files from a deduplicating store")
+    restore.add_argument("store")
+    restore.add_argument("name", help="snapshot name, see the snapshots command")
+    restore.add_argument("destination")
+    restore.add_argument("--snapshot", default=None, help="snapshot file to restore (default: the latest)")
+    restore.set_defaults(func=cmd_restore)
+
+    snapshots = subparsers.add_parser("snapshots", help="list the snapshots in a deduplicating store")
+    snapshots.add_argument("store")
+    snapshots.add_argument("name", nargs="?")
+    snapshots.set_defaults(func=cmd_snapshots)
+
+    list_ = subparsers.add_parser("list", help="list an archive written by backup --archive")
+    list_.add_argument("archive")
+    list_.set_defaults(func=cmd_list)
+
+    extract = subparsers.add_parser("extract", help="extract files from an archive without reading all of it")
+    extract.add_argument("archive")
+    extract.add_argument("destination")
+    extract.add_argument("members", nargs="*", help="files or folders to extract (default: everything)")
+    extract.set_defaults(func=cmd_extract)
+
+    image = subparsers.add_parser("image", help="copy a raw device into a sparse image file")
+    image.add_argument("source", help="device (e.g. /dev/sdb), image file or mounted drive")
+    image.add_argument("image")
+    image.add_argument("--map", action="store_true", help="also write an allocation map (<image>.map)")
+    image.add_argument("--direct", action="store_true", help="read with O_DIRECT")
+    image.add_argument("--block-size", type=parse_size, default=uct_core.IMAGE_BLOCK_SIZE,
+                       help="size of the all-zero blocks that are skipped")
+    image.set_defaults(func=cmd_image)
+
+    image_restore = subparsers.add_parser("image-restore", help="write an image back to a device or file")
+    image_restore.add_argument("image")
+    image_restore.add_argument("target", help="device or file; a device is overwritten")
+    image_restore.add_argument("--direct", action="store_true", help="read with O_DIRECT")
+    image_restore.add_argument("--block-size", type=parse_size, default=uct_core.IMAGE_BLOCK_SIZE)
+    image_restore.set_defaults(func=cmd_image_restore)
+
+    surface = subparsers.add_parser("surface", help="write and verify test data to find fake capacity and bad areas")
+    surface.add_argument("target", help="directory to fill, or an image file / device to overwrite")
+    surface.add_argument("--size", type=parse_size, default=None, help="bytes to test (default: all free space)")
+    surface.add_argument("--destructive", action="store_true",
+                         help="allow overwriting a target that is not a directory")
+    surface.add_argument("--keep-files", action="store_true", help="leave the test files in the directory")
+    surface.add_argument("--direct", action="store_true", help="bypass the page cache with O_DIRECT")
+    surface.add_argument("--seed", type=int, default=None, help="pattern seed (default: random)")
+    surface.set_defaults(func=cmd_surface, record_kind="surface test")
+
+    history = subparsers.add_parser("history", help="show recorded analysis, benchmark and surface test results")
+    history.add_argument("--drive", default=None, help="drive key as listed in the runs")
+    history.add_argument("--kind", choices=uct_core.HISTORY_KINDS, default=None)
+    history.add_argument("--limit", type=int, default=100)
+    history.add_argument("--regressions", action="store_true",
+                         help="list drives whose latest sustained write speed dropped below their baseline "
+                              "or the median of their batch")
+    history.add_argument("--threshold", type=float, default=uct_core.HISTORY_REGRESSION_THRESHOLD,
+                         help="drop that counts as a regression, as a fraction (default: 0.2)")
+    history.set_defaults(func=cmd_history)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    progress = StderrQueue() if args.verbose else None
+    if args.log:
+        uct_core.start_logging(args.log, level=logging.DEBUG if args.log_files else logging.INFO,
+                               structured=args.log_json)
+    history = None
+    try:
+        record_kind = getattr(args, "record_kind", None)  # Set by the subcommands whose results are kept
+        if record_kind and not args.no_history:
+            history = uct_core.ResultsHistory(args.history)
+        result = args.func(args, progress)
+        if history is not None:
+            for entry in result if isinstance(result, list) else [result]:
+                history.record(record_kind, entry["drive"], entry)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        json.dump({"error": str(e)}, sys.stdout, indent=args.indent)
+        sys.stdout.write("\n")
+        return 1
+    finally:
+        if history is not None:
+            history.close()
+    json.dump(result, sys.stdout, indent=args.indent)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
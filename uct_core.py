@@ -0,0 +1,3897 @@
+"""Drive analysis, benchmark, surface test and backup engines used by UCT.
+
+Nothing in here depends on Tkinter, so the engines can be imported by the GUI
+(UCT.py), the command line (uct_cli.py) or other scripts.
+"""
+import os
+import sys
+import shutil
+import threading
+import time
+import logging
+import atexit
+import hashlib
+import array
+import errno
+import math
+import mmap
+import random
+import stat
+import struct
+import gzip
+import lzma
+import json
+import tarfile
+import subprocess
+import itertools
+import multiprocessing
+import bisect
+import copy
+import heapq
+import re
+import sqlite3
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue, Empty, SimpleQueue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+DEFAULT_BACKUP_WORKERS = min(16, (os.cpu_count() or 1) * 4)
+BACKUP_BATCH_FILES = 64  # Small files handed to a worker in one go
+BACKUP_BATCH_BYTES = 16 * 1024 * 1024
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024  # Files above this size get a worker of their own
+MANIFEST_FILENAME = ".uct_manifest"
+COPY_BUFFER_SIZE = 8 * 1024 * 1024  # Reused per copy thread by the buffered fallback
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes requested per copy_file_range/sendfile call
+COPY_STRATEGIES = ("copy_file_range", "sendfile", "buffer")
+VERIFY_ALGORITHMS = ("blake2b", "sha256")
+CHECKSUM_FILENAMES = {"blake2b": "B2SUMS", "sha256": "SHA256SUMS"}  # Readable by b2sum -c / sha256sum -c
+
+# Errors that mean "this strategy does not work for these files", not "the copy failed"
+_COPY_FALLBACK_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP,
+                         errno.EBADF, errno.ETXTBSY}
+_unsupported_strategies = set()
+_copy_buffers = threading.local()
+
+
+class OperationCancelled(Exception):
+    """Raised by an engine when its ``cancel_event`` was set."""
+
+
+LOG_FILENAME = "usb_checker.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024  # The log is rotated at this size ...
+LOG_BACKUPS = 3  # ... keeping usb_checker.log.1 to .3
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_FIELDS = ("drive", "op", "bytes", "duration", "throughput")  # Written by JsonLogFormatter
+
+_log_listener = None
+
+
+def log_fields(drive, op, nbytes=None, duration=None):
+    """Return the ``extra`` of a log record describing one operation."""
+    fields = {"drive": drive, "op": op, "bytes": nbytes, "duration": None if duration is None else round(duration, 6)}
+    if nbytes is not None and duration:
+        fields["throughput"] = round(nbytes / (1024 ** 2) / duration, 3)
+    return fields
+
+
+def _file_entries(record):
+    """Yield ``(message, fields)`` for every file of a record carrying per-file timings.
+
+    Hot loops do not log each file: they collect ``(path, bytes, seconds)``
+    tuples and log them as one record with ``extra={"drive": ..., "op": ...,
+    "files": [...]}``, which the formatters below expand on the listener
+    thread.
+    """
+    for path, nbytes, duration in record.files:
+        yield f"{record.op} {path}", log_fields(record.drive, record.op, nbytes, duration)
+
+
+class TextLogFormatter(logging.Formatter):
+    """LOG_FORMAT lines, one per file for records carrying per-file timings."""
+
+    def __init__(self):
+        super().__init__(LOG_FORMAT)
+
+    def format(self, record):
+        if not getattr(record, "files", None):
+            return super().format(record)
+        prefix = f"{self.formatTime(record)} - {record.levelname} - "
+        return "\n".join(f"{prefix}{message}: {fields['bytes']} bytes in {fields['duration'] * 1000:.3f} ms"
+                         for message, fields in _file_entries(record))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as JSON lines.
+
+    Besides time, level and message, every LOG_FIELDS attribute a record got
+    through ``extra`` (see log_fields) is written: ``bytes``, ``duration`` in
+    seconds and ``throughput`` in MB/s. Records carrying per-file timings
+    become one line per file.
+    """
+
+    def format(self, record):
+        base = {"time": self.formatTime(record), "level": record.levelname}
+        if getattr(record, "files", None):
+            return "\n".join(json.dumps(dict(base, message=message,
+                                             **{k: v for k, v in fields.items() if v is not None}))
+                             for message, fields in _file_entries(record))
+        entry = dict(base, message=record.getMessage())
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _LogQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener and keeps tracebacks apart.
+
+    The stock ``prepare`` formats the record on the logging thread and
+    appends the traceback to the message; this one only merges the
+    arguments and turns the traceback into ``exc_text``, so
+    JsonLogFormatter can write it as its own field.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None  # Do not keep the frames alive in the queue
+        return record
+
+
+class _LogFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that formats a record once for both the size check and the write."""
+
+    def format(self, record):
+        text = record.__dict__.get("_formatted")
+        if text is None:
+            text = record._formatted = super().format(record)
+        return text
+
+
+_exception_formatter = logging.Formatter()
+
+
+def start_logging(log_file=LOG_FILENAME, level=logging.INFO, structured=False,
+                  max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """Log to a size-rotated file from a background thread; returns the QueueListener.
+
+    The root logger gets a QueueHandler, so a thread that logs only puts the
+    record on a queue; the listener thread formats it (as text, or as JSON
+    lines with ``structured``) and writes it. ``logging.DEBUG`` adds
+    per-file timings to backups. See stop_logging.
+    """
+    global _log_listener
+    stop_logging()
+    handler = _LogFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    handler.setFormatter(JsonLogFormatter() if structured else TextLogFormatter())
+    records = SimpleQueue()
+    listener = QueueListener(records, handler)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(_LogQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    _log_listener = listener
+    return listener
+
+
+def stop_logging():
+    """Write what start_logging still has queued and close the log file (also done at exit)."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+atexit.register(stop_logging)
+
+
+class ProgressUpdate:
+    """Snapshot of an operation's progress, as posted to the process queue."""
+
+    def __init__(self, done_bytes, total_bytes, done_files, total_files, elapsed, fraction, finished):
+        self.done_bytes = done_bytes
+        self.total_bytes = total_bytes
+        self.done_files = done_files
+        self.total_files = total_files
+        self.elapsed = elapsed
+        self.fraction = fraction
+        self.finished = finished
+        self.job = None  # Set by the scheduler for job messages
+
+    @property
+    def mb_per_second(self):
+        return self.done_bytes / (1024 ** 2) / max(self.elapsed, 1e-9)
+
+    @property
+    def files_per_second(self):
+        return self.done_files / max(self.elapsed, 1e-9)
+
+    @property
+    def eta(self):
+        """Estimated seconds left, from the average rate so far (None if unknown)."""
+        if self.finished:
+            return 0.0
+        if not self.fraction or self.fraction >= 1:
+            return None
+        return self.elapsed * (1 - self.fraction) / self.fraction
+
+    def __str__(self):
+        parts = []
+        if self.total_files or self.done_files:
+            total = f"/{self.total_files}" if self.total_files else ""
+            parts.append(f"{self.done_files}{total} files")
+        if self.total_bytes or self.done_bytes:
+            total = f"/{self.total_bytes / (1024 ** 2):.1f}" if self.total_bytes else ""
+            parts.append(f"{self.done_bytes / (1024 ** 2):.1f}{total} MB")
+        if self.fraction is not None:
+            parts.append(f"{self.fraction * 100:.1f}%")
+        if self.done_bytes:
+            parts.append(f"{self.mb_per_second:.2f} MB/s")
+        if self.done_files:
+            parts.append(f"{self.files_per_second:.0f} files/s")
+        if self.eta is not None and not self.finished:
+            parts.append(f"ETA {int(self.eta) // 60}:{int(self.eta) % 60:02d}")
+        return ", ".join(parts)
+
+
+class ProgressTracker:
+    """Thread-safe byte/file progress with throttled reporting.
+
+    Workers call ``advance`` as often as they like; an update is put on the
+    process queue at most every ``interval`` seconds (plus a final one from
+    ``finish``), so the cost on the UI side does not depend on the number of
+    files.
+    """
+
+    def __init__(self, process_queue=None, total_bytes=0, total_files=0, interval=0.25):
+        self.process_queue = process_queue
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.interval = interval
+        self.done_bytes = 0
+        self.done_files = 0
+        self.start_time = time.perf_counter()
+        self._fraction = None
+        self._last_post = 0.0
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def set_totals(self, total_bytes, total_files=0):
+        """Set the amount of work, e.g. from scan_tree."""
+        with self._lock:
+            self.total_bytes = total_bytes
+            self.total_files = total_files
+
+    def advance(self, nbytes=0, files=0):
+        """Account for finished work and post an update if one is due."""
+        with self._lock:
+            self.done_bytes += nbytes
+            self.done_files += files
+            now = time.perf_counter()
+            if now - self._last_post < self.interval:
+                return
+            self._last_post = now
+            update = self._snapshot(now)
+        self._post(update)
+
+    def set_fraction(self, fraction):
+        """Report progress directly, for tools that only print a percentage."""
+        with self._lock:
+            self._fraction = max(0.0, min(1.0, fraction))
+        self.advance()
+
+    def finish(self):
+        """Post the final state."""
+        with self._lock:
+            self._finished = True
+            update = self._snapshot(time.perf_counter())
+        self._post(update)
+
+    def snapshot(self):
+        """Return the current state as a ProgressUpdate."""
+        with self._lock:
+            return self._snapshot(time.perf_counter())
+
+    def _snapshot(self, now):
+        if self._fraction is not None:
+            fraction = self._fraction
+        elif self.total_bytes:
+            fraction = min(1.0, self.done_bytes / self.total_bytes)
+        elif self.total_files:
+            fraction = min(1.0, self.done_files / self.total_files)
+        else:
+            fraction = None
+        if self._finished:
+            fraction = 1.0
+        return ProgressUpdate(self.done_bytes, self.total_bytes, self.done_files, self.total_files,
+                              now - self.start_time, fraction, self._finished)
+
+    def _post(self, update):
+        if self.process_queue is not None:
+            self.process_queue.put(update)
+
+
+def scan_tree(path):
+    """Return ``(total_bytes, total_files)`` of the files a backup would copy.
+
+    Uses ``os.scandir`` with the same rules as ParallelBackup: symlinks to
+    directories are not followed and unreadable directories are skipped.
+    """
+    total_bytes = total_files = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                stack.append(entry.path)
+                            continue
+                        total_bytes += entry.stat().st_size
+                    except OSError:
+                        pass
+                    total_files += 1
+        except OSError:
+            continue
+    return total_bytes, total_files
+
+
+def _copy_buffer():
+    """Return this thread's reusable copy buffer."""
+    view = getattr(_copy_buffers, "view", None)
+    if view is None:
+        view = _copy_buffers.view = memoryview(bytearray(COPY_BUFFER_SIZE))
+    return view
+
+
+def _copy_kernel(fsrc, fdst, strategy, progress=None):
+    """Copy a whole file inside the kernel; returns the number of bytes copied."""
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    while True:
+        if strategy == "copy_file_range":
+            sent = os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+        else:
+            sent = os.sendfile(outfd, infd, None, COPY_CHUNK_SIZE)
+        if sent == 0:
+            return copied
+        copied += sent
+        if progress is not None:
+            progress(sent)
+
+
+def _copy_buffered(fsrc, fdst, progress=None, digest=None):
+    """Copy through the reused per-thread buffer; returns the number of bytes copied."""
+    view = _copy_buffer()
+    copied = 0
+    while True:
+        n = fsrc.readinto(view)
+        if not n:
+            return copied
+        chunk = view[:n]
+        if digest is not None:
+            digest.update(chunk)  # hashlib releases the GIL, so copy workers hash in parallel
+        while chunk:
+            written = fdst.write(chunk)
+            chunk = chunk[written:]
+        copied += n
+        if progress is not None:
+            progress(n)
+
+
+def copy_file(src, dst, strategy=None, progress=None, digest=None):
+    """Copy file data and metadata like ``shutil.copy2``, preferring zero-copy syscalls.
+
+    ``os.copy_file_range`` is tried first, then ``os.sendfile``, then a loop over a
+    large reused buffer. Pass ``strategy`` to force one of ``COPY_STRATEGIES``.
+    ``progress`` is called with the byte count of every chunk copied. A hashlib
+    ``digest`` is updated with the data as it is copied, which needs the buffer
+    loop, so the source is only read once. Returns the number of bytes copied.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if strategy and strategy != "buffer" and not hasattr(os, strategy):
+        raise ValueError(f"Copy strategy not available: {strategy}")
+    strategies = ("buffer",) if digest is not None else (strategy,) if strategy else COPY_STRATEGIES
+
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        for name in strategies:
+            if name == "buffer":
+                copied = _copy_buffered(fsrc, fdst, progress, digest)
+                break
+            if not hasattr(os, name) or (name in _unsupported_strategies and not strategy):
+                continue
+            try:
+                copied = _copy_kernel(fsrc, fdst, name, progress)
+                break
+            except OSError as e:
+                # Only fall back if nothing was written yet, otherwise the error is real
+                if strategy or e.errno not in _COPY_FALLBACK_ERRNOS or fdst.tell() != 0:
+                    raise
+                if e.errno == errno.ENOSYS:
+                    _unsupported_strategies.add(name)
+                fsrc.seek(0)
+
+    shutil.copystat(src, dst)
+    return copied
+
+
+def hash_stored_file(path, hash_name):
+    """Hash a file as the device returns it: flushed and dropped from the page cache first.
+
+    Without ``posix_fadvise`` (Windows, macOS) the read may be served from the
+    cache.
+    """
+    digest = hashlib.new(hash_name)
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # Dirty pages are not evicted, so write them out first
+            os.fdatasync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        view = _copy_buffer()
+        while True:
+            n = f.readinto(view)
+            if not n:
+                return digest.hexdigest()
+            digest.update(view[:n])
+
+
+def write_checksums(path, checksums):
+    """Write ``{relative path: hex digest}`` in the ``sha256sum``/``b2sum`` format."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+        for relative_path in sorted(checksums):
+            name = relative_path.replace(os.sep, "/")
+            if "\\" in name or "\n" in name:
+                # Same escaping as coreutils: a leading backslash marks an escaped name
+                name = name.replace("\\", "\\\\").replace("\n", "\\n")
+                f.write(f"\\{checksums[relative_path]}  {name}\n")
+            else:
+                f.write(f"{checksums[relative_path]}  {name}\n")
+    os.replace(tmp_path, path)
+
+
+class BackupStats:
+    """Aggregate counters for a backup run, shared by all copy workers."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.verified = 0
+        self.verify_failures = []  # Relative paths whose copy did not match the source
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self._lock = threading.Lock()
+
+    def add(self, files, nbytes):
+        """Account for copied files."""
+        with self._lock:
+            self.files += files
+            self.bytes += nbytes
+
+    def skip(self, nbytes):
+        """Account for an unchanged file that was not copied again."""
+        with self._lock:
+            self.skipped += 1
+            self.skipped_bytes += nbytes
+
+    def verify(self, relative_path, ok):
+        """Account for a copy that was read back and compared."""
+        with self._lock:
+            if ok:
+                self.verified += 1
+            else:
+                self.verify_failures.append(relative_path)
+
+    def finish(self):
+        """Stop the clock."""
+        self.end_time = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        end = self.end_time if self.end_time is not None else time.perf_counter()
+        return max(end - self.start_time, 1e-9)
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / (1024 ** 2) / self.elapsed
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed
+
+    def to_dict(self):
+        """Return the counters as plain data."""
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "skipped_files": self.skipped,
+            "skipped_bytes": self.skipped_bytes,
+            "seconds": self.elapsed,
+            "mb_per_second": self.mb_per_second,
+            "files_per_second": self.files_per_second,
+            "verified_files": self.verified,
+            "verify_failures": self.verify_failures,
+        }
+
+    def summary(self):
+        """Return a one-line human readable summary."""
+        summary = (f"{self.files} files, {self.bytes / (1024 ** 2):.2f} MB in {self.elapsed:.2f} s "
+                   f"({self.mb_per_second:.2f} MB/s, {self.files_per_second:.0f} files/s)")
+        if self.skipped:
+            summary += f", {self.skipped} unchanged files skipped ({self.skipped_bytes / (1024 ** 2):.2f} MB)"
+        if self.verified:
+            summary += f", {self.verified} verified"
+        if self.verify_failures:
+            summary += f", {len(self.verify_failures)} FAILED verification: {', '.join(self.verify_failures[:5])}"
+        return summary
+
+
+class BackupManifest:
+    """On-disk index of the files already present in a backup folder.
+
+    Each record stores the relative path, size, mtime_ns and an optional content
+    hash tagged with its algorithm (``sha256:<hex>``); digests made with another
+    algorithm than ``hash_name``, or untagged ones from older manifests, are
+    kept on disk but never used. Records are appended while the backup runs, so an interrupted run can
+    be resumed; a completed run rewrites the file with only the current entries.
+    Records are tab-separated and NUL-terminated with the path last, so any
+    path can be stored.
+    """
+
+    def __init__(self, folder, hash_name=None):
+        if hash_name is not None and hash_name not in hashlib.algorithms_available:
+            raise ValueError(f"Unknown hash algorithm: {hash_name}")
+        self.path = os.path.join(folder, MANIFEST_FILENAME)
+        self.hash_name = hash_name
+        self.entries = {}
+        self._seen = {}
+        self._journal = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load existing records; later records override earlier ones."""
+        self.entries = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return self.entries
+
+        entries = self.entries
+        records = os.fsdecode(data).split("\0")
+        for record in records[:-1]:  # The last piece is empty or a torn write
+            try:
+                size, mtime_ns, digest, path = record.split("\t", 3)
+                entries[path] = (int(size), int(mtime_ns), digest if ":" in digest else None)
+            except ValueError:
+                continue
+        return self.entries
+
+    def open(self):
+        """Load the manifest and start appending new records to it."""
+        self.load()
+        self._seen = {}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._journal = open(self.path, "ab")
+
+    def is_unchanged(self, relative_path, size, mtime_ns):
+        """Return True if the file was backed up with the same size and mtime."""
+        entry = self.entries.get(relative_path)
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            self._seen[relative_path] = entry
+            return True
+        return False
+
+    def stored_hash(self, relative_path, size):
+        """Return the recorded hash of a file if its size still matches."""
+        entry = self.entries.get(relative_path)
+        if entry is not None and entry[0] == size:
+            return self._digest(entry, self.hash_name)
+        return None
+
+    def known_hash(self, relative_path, hash_name):
+        """Return the ``hash_name`` digest recorded for a file in this or the previous run, or None."""
+        entry = self._seen.get(relative_path) or self.entries.get(relative_path)
+        return self._digest(entry, hash_name) if entry is not None else None
+
+    @staticmethod
+    def _digest(entry, hash_name):
+        """Return the hex digest of an entry if it was made with ``hash_name``."""
+        tagged = entry[2]
+        if tagged is None or hash_name is None:
+            return None
+        name, _, digest = tagged.partition(":")
+        return digest if name == hash_name else None
+
+    def hash_file(self, path):
+        """Hash a file with the manifest's hash algorithm."""
+        digest = hashlib.new(self.hash_name)
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def record(self, relative_path, size, mtime_ns, digest=None):
+        """Append a record for a file that is now in the backup (thread-safe); ``digest`` uses ``hash_name``."""
+        if digest is not None:
+            digest = f"{self.hash_name}:{digest}"
+        entry = (size, mtime_ns, digest)
+        line = b"%d\t%d\t%s\t%s\0" % (size, mtime_ns, (digest or "").encode("ascii"), os.fsencode(relative_path))
+        with self._lock:
+            self._seen[relative_path] = entry
+            if self._journal is not None:
+                self._journal.write(line)
+
+    def flush(self):
+        """Push appended records to disk."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.flush()
+
+    def close(self, complete=True):
+        """Close the journal; a complete run compacts it to the current entries."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if not complete:
+                return
+
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for relative_path, (size, mtime_ns, digest) in self._seen.items():
+                    f.write(b"%d\t%d\t%s\t%s\0" % (size, mtime_ns, (digest or "").encode("ascii"),
+                                                     os.fsencode(relative_path)))
+            os.replace(tmp_path, self.path)
+            self.entries = self._seen
+            self._seen = {}
+
+
+class _TreeBackup:
+    """Walker and bounded worker pool shared by ParallelBackup and StoreBackup.
+
+    ``_iter_jobs`` walks ``source`` depth first and batches the jobs that
+    ``_file_job`` returns (large files get a job of their own); ``_run_jobs``
+    hands the batches to ``workers`` threads running ``_run_batch``, with at
+    most two batches queued per worker. Subclasses set the attributes used
+    here and implement ``_enter_dir``, ``_file_job`` and ``_run_batch``.
+    """
+
+    def _run_jobs(self, thread_name_prefix):
+        """Run every batch on the worker pool; stops early on an error or cancel."""
+        # Bound the number of queued jobs so memory does not grow with the drive size
+        slots = threading.Semaphore(self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=thread_name_prefix) as pool:
+            for job in self._iter_jobs():
+                slots.acquire()
+                if self._failed.is_set() or self._check_cancelled():
+                    slots.release()
+                    break
+                future = pool.submit(self._run_batch, job)
+                future.add_done_callback(lambda f: self._job_done(f, slots))
+
+    def _iter_jobs(self):
+        """Walk the source tree and yield batches of file jobs."""
+        batch = []
+        batch_size = 0
+        stack = [self.source]
+        while stack:
+            root = stack.pop()
+            try:
+                with os.scandir(root) as it:
+                    entries = list(it)
+            except OSError:
+                continue  # Unreadable directories are skipped, like os.walk does
+
+            relative_dir = os.path.relpath(root, self.source)
+            self._enter_dir(root, relative_dir)
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not entry.is_symlink():
+                        stack.append(entry.path)
+                    continue
+
+                try:
+                    st = entry.stat()
+                    size, mtime_ns = st.st_size, st.st_mtime_ns
+                except OSError:
+                    size, mtime_ns = 0, 0
+                file_key = entry.name if relative_dir == "." else os.path.join(relative_dir, entry.name)
+                job = self._file_job(entry, relative_dir, file_key, size, mtime_ns)
+                if job is None:
+                    continue
+                if size >= self.large_file_threshold:
+                    yield [job]
+                    continue
+
+                batch.append(job)
+                batch_size += size
+                if len(batch) >= self.batch_files or batch_size >= self.batch_bytes:
+                    yield batch
+                    batch = []
+                    batch_size = 0
+
+        if batch:
+            yield batch
+
+    def _job_done(self, future, slots):
+        """Free a finished job's slot; an error the job did not handle fails the backup."""
+        slots.release()
+        error = future.exception()
+        if error is not None:
+            self._errors.append(error)
+            self._failed.set()
+
+    def _check_cancelled(self):
+        """Stop the backup if it was cancelled."""
+        if self.cancel_event is None or not self.cancel_event.is_set():
+            return False
+        if not self._failed.is_set():
+            self._errors.append(OperationCancelled("Backup cancelled"))
+            self._failed.set()
+        return True
+
+
+class ParallelBackup(_TreeBackup):
+    """Copy a directory tree with a bounded pool of copy workers.
+
+    Directories are created by the walking thread, small files are batched per
+    worker and large files are copied as jobs of their own. The resulting tree
+    is the same one a plain ``os.walk`` + ``shutil.copy2`` loop produces.
+
+    With a ``manifest`` the backup is incremental: files whose size and mtime
+    match the manifest are skipped, and copied files are recorded as they
+    complete so an interrupted run picks up where it stopped.
+
+    With ``verify`` (a hashlib name from VERIFY_ALGORITHMS) every file is
+    hashed from the same buffers it is copied with, then the copy is read back
+    past the page cache and hashed again. Mismatches are listed in the stats
+    and left out of the manifest so the next run copies them again. The
+    digests are written to a ``sha256sum``-style checksum file in the backup
+    folder when the run completes; files skipped as unchanged are listed with
+    the digest the manifest recorded for them, when it used the same
+    algorithm. A verified incremental run reads a new or resized file once:
+    the manifest gets the digest of the verified copy.
+
+    Progress goes through a ProgressTracker: pass one with totals from
+    scan_tree for a percentage and ETA, otherwise one without totals is
+    created that posts at most one update per ``report_interval`` seconds.
+    When the root logger is enabled for DEBUG, the size and copy time of
+    every file is logged, as one record per batch (op ``copy``, see
+    TextLogFormatter and JsonLogFormatter).
+    """
+
+    def __init__(self, source, destination, workers=DEFAULT_BACKUP_WORKERS,
+                 batch_files=BACKUP_BATCH_FILES, batch_bytes=BACKUP_BATCH_BYTES,
+                 large_file_threshold=LARGE_FILE_THRESHOLD, process_queue=None, report_interval=1.0,
+                 manifest=None, cancel_event=None, progress=None, verify=None):
+        if verify is not None and verify not in VERIFY_ALGORITHMS:
+            raise ValueError(f"Unknown verify algorithm: {verify}")
+        self.source = source
+        self.destination = destination
+        self.workers = max(1, int(workers))
+        self.batch_files = max(1, int(batch_files))
+        self.batch_bytes = batch_bytes
+        self.large_file_threshold = large_file_threshold
+        self.process_queue = process_queue
+        self.report_interval = report_interval
+        self.manifest = manifest
+        self.cancel_event = cancel_event
+        self.progress = progress
+        self.verify = verify
+        self.stats = BackupStats()
+        self.checksums = {}
+        self._errors = []
+        self._failed = threading.Event()
+
+    def run(self):
+        """Run the backup and return the collected statistics."""
+        self.stats = BackupStats()
+        self.checksums = {}
+        self._errors = []
+        self._failed.clear()
+        self._progress = self.progress or ProgressTracker(self.process_queue, interval=self.report_interval)
+        self._file_timings = logging.getLogger().isEnabledFor(logging.DEBUG)  # Checked once, not per file
+
+        if self.manifest is not None:
+            self.manifest.open()
+        complete = False
+        try:
+            self._run_jobs("uct-backup")
+            complete = not self._failed.is_set()
+        finally:
+            self.stats.finish()
+            self._progress.finish()
+            if self.manifest is not None:
+                self.manifest.close(complete=complete)
+            if self.verify is not None and complete:  # A stopped run keeps the last complete list
+                write_checksums(os.path.join(self.destination, CHECKSUM_FILENAMES[self.verify]), self.checksums)
+
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+    def _enter_dir(self, root, relative_dir):
+        """Create the directory in the backup."""
+        os.makedirs(os.path.join(self.destination, relative_dir), exist_ok=True)
+
+    def _file_job(self, entry, relative_dir, file_key, size, mtime_ns):
+        """Return the copy job of a file, or None if the manifest has it unchanged and the copy is there."""
+        dest_file = os.path.join(self.destination, relative_dir, entry.name)
+        if self.manifest is not None and self.manifest.is_unchanged(file_key, size, mtime_ns) \
+                and self._copy_present(dest_file, size) and self._keep_checksum(file_key):
+            self.stats.skip(size)
+            self._progress.advance(size, 1)
+            return None
+        return entry.path, dest_file, size, mtime_ns, file_key
+
+    @staticmethod
+    def _copy_present(dest_file, size):
+        """Return True if the backup still holds a file of the recorded size (it may have been deleted)."""
+        try:
+            return os.stat(dest_file).st_size == size
+        except OSError:
+            return False
+
+    def _run_batch(self, job):
+        """Copy one batch of files (runs on a worker thread)."""
+        timings = [] if self._file_timings else None
+        try:
+            for src_file, dest_file, size, mtime_ns, file_key in job:
+                if self._failed.is_set() or self._check_cancelled():
+                    return
+                try:
+                    digest = None
+                    hash_name = self.manifest.hash_name if self.manifest is not None else None
+                    stored = self.manifest.stored_hash(file_key, size) if hash_name else None
+                    if stored is not None:
+                        # Same size but a new mtime: compare contents before rewriting the copy
+                        digest = self.manifest.hash_file(src_file)
+                        if digest == stored and self._copy_present(dest_file, size):
+                            self.manifest.record(file_key, size, mtime_ns, digest)
+                            self._keep_checksum(file_key)
+                            self.stats.skip(size)
+                            self._progress.advance(size, 1)
+                            continue
+                    start = time.perf_counter() if timings is not None else 0.0
+                    if self.verify is not None:
+                        copied = self._copy_verified(src_file, dest_file, file_key)
+                        if copied is None:
+                            continue
+                        if hash_name == self.verify:
+                            digest = copied
+                    elif hash_name and digest is None:
+                        # Nothing to compare against: hash the same buffers the copy reads
+                        hasher = hashlib.new(hash_name)
+                        copy_file(src_file, dest_file, progress=self._progress.advance, digest=hasher)
+                        digest = hasher.hexdigest()
+                    else:
+                        copy_file(src_file, dest_file, progress=self._progress.advance)
+                    if timings is not None:
+                        timings.append((file_key, size, time.perf_counter() - start))
+                    if self.manifest is not None:
+                        self.manifest.record(file_key, size, mtime_ns, digest)
+                except OSError as e:
+                    self._errors.append(e)
+                    self._failed.set()
+                    return
+                self.stats.add(1, size)
+                self._progress.advance(files=1)
+        finally:
+            if self.manifest is not None:
+                self.manifest.flush()
+            if timings:
+                logging.debug("Copied %d files", len(timings),
+                              extra={"drive": self.source, "op": "copy", "files": timings})
+
+    def _copy_verified(self, src_file, dest_file, file_key):
+        """Copy while hashing, then compare with the copy read back; returns the digest or None."""
+        digest = hashlib.new(self.verify)
+        copy_file(src_file, dest_file, progress=self._progress.advance, digest=digest)
+        expected = digest.hexdigest()
+        ok = hash_stored_file(dest_file, self.verify) == expected
+        self.stats.verify(file_key, ok)
+        if not ok:
+            logging.error(f"Backup verification failed: {dest_file} does not match {src_file}")
+            if self.process_queue is not None:
+                self.process_queue.put(f"Verification failed: {file_key}\n")
+            self._progress.advance(files=1)
+            return None
+        self.checksums[file_key] = expected
+        return expected
+
+    def _keep_checksum(self, file_key):
+        """List an unchanged file in the checksum file; False if the manifest has no digest for it."""
+        if self.verify is None or self.manifest.hash_name != self.verify:
+            return True
+        digest = self.manifest.known_hash(file_key, self.verify)
+        if digest is None:
+            return False  # Recorded without a hash or with another algorithm: copy and verify it again
+        self.checksums[file_key] = digest
+        return True
+
+
+STORE_CHUNK_SIZE = 4 * 1024 * 1024  # Files are cut into fixed chunks of this size
+STORE_HASH = "sha256"
+SNAPSHOT_SUFFIX = ".snap"
+
+
+class StoreStats(BackupStats):
+    """BackupStats plus how much data a store backup actually had to write."""
+
+    def __init__(self):
+        super().__init__()
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def stored(self, nbytes):
+        """Account for a chunk that was not in the store yet."""
+        with self._lock:
+            self.new_chunks += 1
+            self.new_bytes += nbytes
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update(new_chunks=self.new_chunks, new_bytes=self.new_bytes)
+        return data
+
+    def summary(self):
+        return (f"{super().summary()}, {self.new_bytes / (1024 ** 2):.2f} MB new data "
+                f"in {self.new_chunks} chunks")
+
+
+class ChunkStore:
+    """Content-addressed store of file chunks shared by the backups of many drives.
+
+    Files are cut into STORE_CHUNK_SIZE pieces named by their SHA-256 and kept
+    once under ``chunks/``, whichever drive they came from. Every backup adds
+    a snapshot index under ``snapshots/<name>/`` that maps each path to its
+    chunk IDs, so storage grows with unique data, not with the number of
+    drives. Chunks are written to a temporary name and renamed into place,
+    so several backups can share a store at the same time.
+
+    Snapshot records use the manifest layout (tab-separated, NUL-terminated,
+    path last): kind (``f`` or ``d``), size, mtime_ns, comma-separated chunk
+    IDs, path.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.chunk_dir = os.path.join(root, "chunks")
+        self.snapshot_dir = os.path.join(root, "snapshots")
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.chunk_dir, chunk_id[:2], chunk_id)
+
+    def has_chunk(self, chunk_id):
+        """Return True if the chunk is stored (remembered once seen)."""
+        if chunk_id in self._known:
+            return True
+        if os.path.exists(self.chunk_path(chunk_id)):
+            with self._lock:
+                self._known.add(chunk_id)
+            return True
+        return False
+
+    def put_chunk(self, data):
+        """Store a chunk unless it exists; return (chunk ID, True if it was written)."""
+        chunk_id = hashlib.new(STORE_HASH, data).hexdigest()
+        if self.has_chunk(chunk_id):
+            return chunk_id, False
+        path = self.chunk_path(chunk_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb", buffering=0) as f:
+            _write_all(f, data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._known.add(chunk_id)
+        return chunk_id, True
+
+    def read_chunk(self, chunk_id):
+        """Return a chunk's data after checking it still matches its ID."""
+        path = self.chunk_path(chunk_id)
+        with open(path, "rb") as f:
+            data = f.read()
+        if hashlib.new(STORE_HASH, data).hexdigest() != chunk_id:
+            raise OSError(errno.EIO, "Chunk is corrupted", path)
+        return data
+
+    def snapshots(self, name):
+        """Return the snapshot files of a drive, oldest first."""
+        folder = os.path.join(self.snapshot_dir, name)
+        try:
+            return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(SNAPSHOT_SUFFIX))
+        except FileNotFoundError:
+            return []
+
+    def names(self):
+        """Return the names of all drives with snapshots."""
+        try:
+            return sorted(os.listdir(self.snapshot_dir))
+        except FileNotFoundError:
+            return []
+
+    def write_snapshot(self, name, entries):
+        """Write ``{path: (kind, size, mtime_ns, chunk IDs)}`` as a new snapshot; return its path."""
+        folder = os.path.join(self.snapshot_dir, name)
+        os.makedirs(folder, exist_ok=True)
+        # Names sort by time: 20250101-120000.123456.snap
+        now = time.time_ns() // 1000
+        while True:
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now // 1000000)) + f".{now % 1000000:06d}"
+            path = os.path.join(folder, stamp + SNAPSHOT_SUFFIX)
+            if not os.path.exists(path):
+                break
+            now += 1
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for relative_path in sorted(entries):
+                kind, size, mtime_ns, chunks = entries[relative_path]
+                f.write(b"%s\t%d\t%d\t%s\t%s\0" % (kind.encode("ascii"), size, mtime_ns,
+                                                   ",".join(chunks).encode("ascii"), os.fsencode(relative_path)))
+        os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def read_snapshot(path):
+        """Load a snapshot as ``{path: (kind, size, mtime_ns, chunk IDs)}``."""
+        entries = {}
+        with open(path, "rb") as f:
+            records = os.fsdecode(f.read()).split("\0")
+        for record in records[:-1]:
+            kind, size, mtime_ns, chunks, relative_path = record.split("\t", 4)
+            entries[relative_path] = (kind, int(size), int(mtime_ns), chunks.split(",") if chunks else [])
+        return entries
+
+    def usage(self):
+        """Return (chunks, bytes) currently held by the store."""
+        chunks = nbytes = 0
+        for folder, _, files in os.walk(self.chunk_dir):
+            for name in files:
+                chunks += 1
+                nbytes += os.path.getsize(os.path.join(folder, name))
+        return chunks, nbytes
+
+
+class StoreBackup(_TreeBackup):
+    """Back up a directory tree into a ChunkStore as a snapshot named ``name``.
+
+    Files are read by a pool of workers, cut into chunks and hashed; only
+    chunks the store does not have yet are written. Files whose size and
+    mtime match the drive's previous snapshot reuse its chunk list without
+    being read. The snapshot is written only when the whole tree is done,
+    so a failed or cancelled run leaves no snapshot.
+    """
+
+    def __init__(self, source, store, name, workers=DEFAULT_BACKUP_WORKERS, chunk_size=STORE_CHUNK_SIZE,
+                 batch_files=BACKUP_BATCH_FILES, batch_bytes=BACKUP_BATCH_BYTES,
+                 large_file_threshold=LARGE_FILE_THRESHOLD, process_queue=None, cancel_event=None, progress=None):
+        if chunk_size <= 0:
+            raise ValueError(f"Invalid chunk size: {chunk_size}")
+        self.source = source
+        self.store = store if isinstance(store, ChunkStore) else ChunkStore(store)
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.chunk_size = chunk_size
+        self.batch_files = max(1, int(batch_files))
+        self.batch_bytes = batch_bytes
+        self.large_file_threshold = large_file_threshold
+        self.process_queue = process_queue
+        self.cancel_event = cancel_event
+        self.progress = progress
+        self.stats = StoreStats()
+        self.snapshot = None
+        self._entries = {}
+        self._previous = {}
+        self._errors = []
+        self._failed = threading.Event()
+
+    def run(self):
+        """Run the backup and return the collected statistics."""
+        self.stats = StoreStats()
+        self._entries = {}
+        self._errors = []
+        self._failed.clear()
+        self._progress = self.progress or ProgressTracker(self.process_queue)
+        latest = self.store.snapshots(self.name)
+        self._previous = self.store.read_snapshot(latest[-1]) if latest else {}
+        try:
+            self._run_jobs("uct-store")
+        finally:
+            self.stats.finish()
+            self._progress.finish()
+
+        if self._errors:
+            raise self._errors[0]
+        self.snapshot = self.store.write_snapshot(self.name, self._entries)
+        return self.stats
+
+    def _enter_dir(self, root, relative_dir):
+        """Record the directory in the snapshot."""
+        if relative_dir != ".":
+            self._entries[relative_dir] = ("d", 0, os.stat(root).st_mtime_ns, [])
+
+    def _file_job(self, entry, relative_dir, file_key, size, mtime_ns):
+        """Return the store job of a file, or None if the previous snapshot has it unchanged."""
+        old = self._previous.get(file_key)
+        if old is not None and old[0] == "f" and old[1] == size and old[2] == mtime_ns:
+            self._entries[file_key] = old
+            self.stats.skip(size)
+            self._progress.advance(size, 1)
+            return None
+        return entry.path, size, mtime_ns, file_key
+
+    def _run_batch(self, job):
+        """Chunk and store one batch of files (runs on a worker thread)."""
+        if self.chunk_size <= COPY_BUFFER_SIZE:
+            view = _copy_buffer()[:self.chunk_size]
+        else:
+            view = memoryview(bytearray(self.chunk_size))
+        for src_file, size, mtime_ns, file_key in job:
+            if self._failed.is_set() or self._check_cancelled():
+                return
+            chunks = []
+            nbytes = 0
+            try:
+                with open(src_file, "rb", buffering=0) as f:
+                    while True:
+                        n = f.readinto(view)
+                        if not n:
+                            break
+                        chunk_id, written = self.store.put_chunk(view[:n])
+                        if written:
+                            self.stats.stored(n)
+                        chunks.append(chunk_id)
+                        nbytes += n
+                        self._progress.advance(n)
+            except OSError as e:
+                self._errors.append(e)
+                self._failed.set()
+                return
+            self._entries[file_key] = ("f", nbytes, mtime_ns, chunks)
+            self.stats.add(1, nbytes)
+            self._progress.advance(files=1)
+
+
+def restore_snapshot(store, snapshot, destination, process_queue=None, cancel_event=None, progress=None):
+    """Rebuild the tree of a snapshot file in ``destination``; returns BackupStats.
+
+    Every chunk is checked against its ID while it is read back, and files
+    get their original modification times.
+    """
+    store = store if isinstance(store, ChunkStore) else ChunkStore(store)
+    entries = store.read_snapshot(snapshot)
+    stats = BackupStats()
+    progress = progress or ProgressTracker(process_queue)
+    progress.set_totals(sum(e[1] for e in entries.values() if e[0] == "f"),
+                        sum(1 for e in entries.values() if e[0] == "f"))
+    os.makedirs(destination, exist_ok=True)
+    directories = []
+    try:
+        for relative_path in sorted(entries):
+            if cancel_event is not None and cancel_event.is_set():
+                raise OperationCancelled("Restore cancelled")
+            kind, size, mtime_ns, chunks = entries[relative_path]
+            path = os.path.join(destination, relative_path)
+            if kind == "d":
+                os.makedirs(path, exist_ok=True)
+                directories.append((path, mtime_ns))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb", buffering=0) as f:
+                for chunk_id in chunks:
+                    data = store.read_chunk(chunk_id)
+                    _write_all(f, memoryview(data))
+                    progress.advance(len(data))
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+            stats.add(1, size)
+            progress.advance(files=1)
+        # Set directory times last, writing the files changed them
+        for path, mtime_ns in reversed(directories):
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+    finally:
+        stats.finish()
+        progress.finish()
+    return stats
+
+
+ARCHIVE_FORMATS = ("gz", "xz")
+ARCHIVE_BLOCK_SIZE = 4 * 1024 * 1024  # Uncompressed tar data compressed as one independent block
+ARCHIVE_INDEX_SUFFIX = ".idx"
+DEFAULT_ARCHIVE_WORKERS = os.cpu_count() or 1
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    ".7z", ".aac", ".apk", ".avi", ".bz2", ".cab", ".docx", ".epub", ".flac", ".gif", ".gz", ".heic", ".iso",
+    ".jar", ".jpeg", ".jpg", ".lz", ".lz4", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".opus", ".png",
+    ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+))
+_TAR_FILE, _TAR_DIR, _TAR_SYMLINK, _TAR_HARDLINK = (
+    t.decode("ascii") for t in (tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE, tarfile.LNKTYPE))
+
+
+def _compress_block(data, compression, level):
+    """Compress one block as a complete gzip member or xz stream (runs in a worker process)."""
+    if compression == "gz":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+def _decompress_block(data, compression):
+    return gzip.decompress(data) if compression == "gz" else lzma.decompress(data)
+
+
+class ArchiveStats(BackupStats):
+    """BackupStats plus the size of the archive written."""
+
+    def __init__(self):
+        super().__init__()
+        self.archive_bytes = 0
+        self.blocks = 0
+        self.stored_blocks = 0  # Blocks of already compressed files, written without real compression
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update(archive_bytes=self.archive_bytes, blocks=self.blocks, stored_blocks=self.stored_blocks)
+        return data
+
+    def summary(self):
+        ratio = self.archive_bytes / self.bytes if self.bytes else 0.0
+        return f"{super().summary()}, archive {self.archive_bytes / (1024 ** 2):.2f} MB ({ratio:.0%})"
+
+
+class _BlockWriter:
+    """File-like sink for tarfile that compresses the stream in independent blocks.
+
+    Full blocks are handed to a process pool; results are written in order
+    and at most ``max_pending`` blocks are in flight, so memory stays at a
+    few blocks however large the archive gets.
+    """
+
+    def __init__(self, output, compression, level, block_size, pool, max_pending, stats):
+        self.output = output
+        self.compression = compression
+        self.level = level
+        self.store_level = 0
+        self.store = False
+        self.block_size = block_size
+        self.pool = pool
+        self.max_pending = max_pending
+        self.stats = stats
+        self.position = 0  # Bytes of uncompressed tar data written so far
+        self.blocks = []  # (uncompressed offset, compressed offset, compressed length)
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._pending = deque()
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self._buffer += data
+        self.position += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def cut(self, store=False):
+        """End the current block early; ``store`` selects near-zero compression for the next ones."""
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        self.store = store
+
+    def _submit(self, block):
+        level = self.store_level if self.store else self.level
+        if self.pool is None:
+            future = _compress_block(block, self.compression, level)
+        else:
+            future = self.pool.submit(_compress_block, block, self.compression, level)
+        self._pending.append((self._buffer_start, future))
+        self._buffer_start += len(block)
+        self.stats.blocks += 1
+        self.stats.stored_blocks += self.store
+        while len(self._pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        offset, future = self._pending.popleft()
+        data = future if self.pool is None else future.result()
+        self.blocks.append((offset, self.stats.archive_bytes, len(data)))
+        self.output.write(data)
+        self.stats.archive_bytes += len(data)
+
+    def close(self):
+        """Compress what is left and write every pending block."""
+        self.cut()
+        while self._pending:
+            self._write_next()
+
+
+class ArchiveBackup:
+    """Stream a directory tree into one compressed tar archive.
+
+    The tar stream is cut into ARCHIVE_BLOCK_SIZE blocks that are compressed
+    independently on a process pool and concatenated, so every core is used
+    and the result is still a plain ``.tar.gz`` / ``.tar.xz`` that ``tar``
+    reads. Large files with already compressed types (INCOMPRESSIBLE_EXTENSIONS)
+    get blocks of their own that are only stored (gzip level 0, xz preset 0).
+
+    A JSON side index (``<archive>.idx``) lists every member with the offset
+    of its data in the tar stream, together with the block table, so
+    ArchiveIndex can list the archive and extract single members by
+    decompressing only the blocks that hold them.
+    """
+
+    def __init__(self, source, archive_path, compression="gz", level=None, workers=DEFAULT_ARCHIVE_WORKERS,
+                 block_size=ARCHIVE_BLOCK_SIZE, process_queue=None, cancel_event=None, progress=None):
+        if compression not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive compression: {compression}")
+        self.source = source
+        self.archive_path = archive_path
+        self.index_path = archive_path + ARCHIVE_INDEX_SUFFIX
+        self.compression = compression
+        self.level = level if level is not None else (6 if compression == "gz" else 3)
+        self.workers = max(1, int(workers))
+        self.block_size = block_size
+        self.process_queue = process_queue
+        self.cancel_event = cancel_event
+        self.progress = progress
+        self.stats = ArchiveStats()
+
+    def run(self):
+        """Write the archive and its index; return ArchiveStats."""
+        self.stats = ArchiveStats()
+        progress = self.progress or ProgressTracker(self.process_queue)
+        members = []
+        pool = None
+        if self.workers > 1:
+            # Spawned, not forked: this runs on a job thread next to the GUI, log and history threads,
+            # and a forked child could inherit one of their locks held
+            pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        complete = False
+        try:
+            with open(self.archive_path, "wb") as output:
+                writer = _BlockWriter(output, self.compression, self.level, self.block_size, pool,
+                                      self.workers * 2, self.stats)
+                with tarfile.open(fileobj=writer, mode="w", format=tarfile.PAX_FORMAT,
+                                  copybufsize=COPY_BUFFER_SIZE) as tar:
+                    for path, arcname in self._iter_paths():
+                        if self.cancel_event is not None and self.cancel_event.is_set():
+                            raise OperationCancelled("Backup cancelled")
+                        record = self._add(tar, writer, path, arcname)
+                        members.append(record)
+                        if record[1] in (_TAR_FILE, _TAR_HARDLINK):  # A hard link is a file without data
+                            self.stats.add(1, record[2])
+                            progress.advance(record[2], 1)
+                writer.close()
+            self._write_index(members, writer.blocks)
+            complete = True
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            self.stats.finish()
+            progress.finish()
+            if not complete:
+                for path in (self.archive_path, self.index_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return self.stats
+
+    def _iter_paths(self):
+        """Yield (path, archive name) for every entry, directories before their contents."""
+        stack = [self.source]
+        while stack:
+            root = stack.pop()
+            try:
+                with os.scandir(root) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
+            relative_dir = os.path.relpath(root, self.source)
+            if relative_dir != ".":
+                yield root, relative_dir.replace(os.sep, "/")
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                yield entry.path, (entry.name if relative_dir == "." else
+                                   f"{relative_dir.replace(os.sep, '/')}/{entry.name}")
+
+    def _add(self, tar, writer, path, arcname):
+        """Add one entry; return its index record (name, type, size, mtime, mode, data offset, link)."""
+        info = tar.gettarinfo(path, arcname)
+        if info is None:  # Sockets and other types tar cannot store
+            return (arcname, "", 0, 0, 0, 0, "")
+        if not info.isreg():
+            tar.addfile(info)
+            return (arcname, info.type.decode("ascii"), 0, int(info.mtime), info.mode, 0, info.linkname)
+
+        store = (info.size >= self.block_size // 4
+                 and os.path.splitext(arcname)[1].lower() in INCOMPRESSIBLE_EXTENSIONS)
+        if store:
+            writer.cut(store=True)
+        with open(path, "rb") as f:
+            tar.addfile(info, f)
+        if store:
+            writer.cut()
+        # The data ends at a 512 byte boundary behind the header
+        data_offset = writer.position - (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        return (arcname, info.type.decode("ascii"), info.size, int(info.mtime), info.mode, data_offset, "")
+
+    def _write_index(self, members, blocks):
+        """Write the side index used by ArchiveIndex."""
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape") as f:
+            json.dump({"compression": self.compression, "blocks": blocks,
+                       "members": [m for m in members if m[1]]}, f, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+
+class ArchiveIndex:
+    """Random access to an archive written by ArchiveBackup, through its side index."""
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        with open(archive_path + ARCHIVE_INDEX_SUFFIX, encoding="utf-8", errors="surrogateescape") as f:
+            index = json.load(f)
+        self.compression = index["compression"]
+        self.blocks = index["blocks"]
+        self.members = {m[0]: m for m in index["members"]}
+        self._starts = [block[0] for block in self.blocks]
+        self._cached = (None, b"")
+
+    def list(self):
+        """Return (name, type, size, mtime) for every member in archive order."""
+        return [(m[0], m[1], m[2], m[3]) for m in self.members.values()]
+
+    def _block(self, f, number):
+        """Return the decompressed data of one block, keeping the last one."""
+        if self._cached[0] != number:
+            _, offset, length = self.blocks[number]
+            f.seek(offset)
+            self._cached = (number, _decompress_block(f.read(length), self.compression))
+        return self._cached[1]
+
+    def _copy_range(self, f, start, size, output):
+        """Write ``size`` bytes of the tar stream starting at ``start`` to ``output``."""
+        number = bisect.bisect_right(self._starts, start) - 1
+        while size > 0:
+            data = self._block(f, number)
+            begin = start - self._starts[number]
+            piece = memoryview(data)[begin:begin + size]
+            output.write(piece)
+            start += len(piece)
+            size -= len(piece)
+            number += 1
+
+    def _extract_data(self, f, path, size, mtime, mode, data_offset):
+        """Write the data of a regular file member to ``path``."""
+        with open(path, "wb") as out:
+            self._copy_range(f, data_offset, size, out)
+        os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+
+    def extract(self, destination, names=None):
+        """Extract all members, or only ``names`` (and what is inside named directories).
+
+        Hard links are linked to their extracted target; where that is not
+        possible (the target was not selected, or the file system has no hard
+        links, like FAT) the target's data is copied. Returns the number of
+        entries created; devices, FIFOs and sockets are skipped.
+        """
+        selected = list(self.members.values())
+        if names:
+            names = {name.rstrip("/") for name in names}
+            missing = names - set(self.members)
+            if missing:
+                raise ValueError(f"Not in the archive: {', '.join(sorted(missing))}")
+            prefixes = tuple(name + "/" for name in names)
+            selected = [m for m in selected if m[0] in names or m[0].startswith(prefixes)]
+        directories = []
+        extracted = 0
+        written = set()  # Names of the files extracted so far, which hard links can point to
+        with open(self.archive_path, "rb") as f:
+            for name, kind, size, mtime, mode, data_offset, linkname in selected:
+                if name.startswith("/") or ".." in name.split("/"):
+                    raise ValueError(f"Unsafe member name: {name}")
+                path = os.path.join(destination, *name.split("/"))
+                if kind == _TAR_DIR:
+                    os.makedirs(path, exist_ok=True)
+                    directories.append((path, mtime, mode))
+                    extracted += 1
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if kind == _TAR_SYMLINK:
+                    os.symlink(linkname, path)
+                elif kind == _TAR_FILE:
+                    self._extract_data(f, path, size, mtime, mode, data_offset)
+                    written.add(name)
+                elif kind == _TAR_HARDLINK:
+                    self._extract_hardlink(f, destination, path, linkname, linkname in written)
+                else:
+                    continue
+                extracted += 1
+        for path, mtime, mode in reversed(directories):
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+        return extracted
+
+    def _extract_hardlink(self, f, destination, path, linkname, target_written):
+        """Link ``path`` to the member ``linkname`` if it was extracted, or copy that member's data."""
+        if linkname.startswith("/") or ".." in linkname.split("/"):
+            raise ValueError(f"Unsafe hard link target: {linkname}")
+        target = self.members.get(linkname)
+        if target is None or target[1] != _TAR_FILE:
+            raise ValueError(f"Hard link target not in the archive: {linkname}")
+        if target_written:
+            try:
+                os.link(os.path.join(destination, *linkname.split("/")), path)
+                return
+            except OSError:
+                pass  # No hard links on this file system
+        _, _, size, mtime, mode, data_offset, _ = target
+        self._extract_data(f, path, size, mtime, mode, data_offset)
+
+
+IMAGE_READ_SIZE = 4 * 1024 * 1024  # Bytes per sequential read
+IMAGE_BLOCK_SIZE = 64 * 1024  # All-zero blocks of this size are skipped
+IMAGE_MAP_SUFFIX = ".map"
+BLKZEROOUT = 0x127F  # Linux ioctl that zeroes a range of a block device
+IOCTL_DISK_GET_LENGTH_INFO = 0x7405C  # Windows ioctl returning the size of a disk or volume
+
+
+def device_size(fd):
+    """Return the size of an open file or device.
+
+    lseek(SEEK_END) works for files everywhere and for Linux block devices,
+    but returns 0 for a Windows volume (``\\\\.\\E:``), which is asked with
+    IOCTL_DISK_GET_LENGTH_INFO instead.
+    """
+    if sys.platform == "win32":
+        import ctypes
+        import msvcrt
+        from ctypes import wintypes
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        length = ctypes.c_longlong()
+        returned = wintypes.DWORD()
+        if kernel32.DeviceIoControl(wintypes.HANDLE(msvcrt.get_osfhandle(fd)), IOCTL_DISK_GET_LENGTH_INFO, None, 0,
+                                    ctypes.byref(length), ctypes.sizeof(length), ctypes.byref(returned), None):
+            return length.value
+        # Not a disk or volume (a regular file fails with ERROR_INVALID_FUNCTION): fall back to lseek
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def read_allocation_map(path):
+    """Load an allocation map; return (size, [(offset, length) of data]) ."""
+    with open(path) as f:
+        header = f.readline().split()
+        if header[:3] != ["#", "UCT", "allocation-map"]:
+            raise ValueError(f"Not an allocation map: {path}")
+        size = int(header[3])
+        return size, [tuple(int(value) for value in line.split()) for line in f if line.strip()]
+
+
+def write_allocation_map(path, size, extents):
+    """Write the data extents of an image, one "offset length" line each."""
+    with open(path, "w") as f:
+        f.write(f"# UCT allocation-map {size}\n")
+        for offset, length in extents:
+            f.write(f"{offset} {length}\n")
+
+
+def _data_extents(fd, size):
+    """Yield the (offset, length) ranges of a file that can hold data; holes are skipped."""
+    if not hasattr(os, "SEEK_DATA") or not stat.S_ISREG(os.fstat(fd).st_mode):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:  # ENXIO: only a hole is left
+                yield offset, size - offset
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def _zero_range(f, offset, length):
+    """Zero a range of a block device, with BLKZEROOUT where the kernel offers it."""
+    if sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            fcntl.ioctl(f.fileno(), BLKZEROOUT, struct.pack("QQ", offset, length))
+            return
+        except OSError:
+            pass
+    zeros = memoryview(bytes(min(length, IMAGE_READ_SIZE)))
+    f.seek(offset)
+    while length:
+        n = min(length, len(zeros))
+        _write_all(f, zeros[:n])
+        length -= n
+
+
+class ImageStats:
+    """Counters of a DiskImager run."""
+
+    def __init__(self, size):
+        self.size = size
+        self.data_bytes = 0  # Bytes written
+        self.zero_bytes = 0  # Bytes skipped as holes or all-zero blocks
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        end = self.end_time if self.end_time is not None else time.perf_counter()
+        return max(end - self.start_time, 1e-9)
+
+    @property
+    def mb_per_second(self):
+        return (self.data_bytes + self.zero_bytes) / (1024 ** 2) / self.elapsed
+
+    def to_dict(self):
+        return {
+            "size": self.size,
+            "data_bytes": self.data_bytes,
+            "zero_bytes": self.zero_bytes,
+            "seconds": self.elapsed,
+            "mb_per_second": self.mb_per_second,
+        }
+
+    def summary(self):
+        return (f"{format_size(self.size)} in {self.elapsed:.2f} s ({self.mb_per_second:.2f} MB/s), "
+                f"{format_size(self.data_bytes)} data, {format_size(self.zero_bytes)} zeros skipped")
+
+
+class DiskImager:
+    """Copy a raw device (or any file standing in for one) block for block.
+
+    The source is read sequentially in IMAGE_READ_SIZE steps into a
+    page-aligned buffer (``direct`` adds O_DIRECT). IMAGE_BLOCK_SIZE blocks
+    that are all zeros are not written: a file destination is created
+    sparse, a device destination gets them zeroed with BLKZEROOUT (or
+    written) so stale data does not survive. Holes in a sparse source are
+    not read at all; ``map_in`` names an allocation map listing the data
+    ranges of the source instead, ``map_out`` writes one for the result.
+    """
+
+    def __init__(self, source, destination, read_size=IMAGE_READ_SIZE, block_size=IMAGE_BLOCK_SIZE,
+                 direct=False, map_in=None, map_out=None, process_queue=None, cancel_event=None, progress=None):
+        if read_size % block_size:
+            raise ValueError("The read size must be a multiple of the block size")
+        if direct and not hasattr(os, "O_DIRECT"):
+            raise ValueError("O_DIRECT is not supported on this platform")
+        self.source = source
+        self.destination = destination
+        self.read_size = read_size
+        self.block_size = block_size
+        self.direct = direct
+        self.map_in = map_in
+        self.map_out = map_out
+        self.process_queue = process_queue
+        self.cancel_event = cancel_event
+        self.progress = progress
+        self.extents = []  # Data ranges written to the destination
+
+    def run(self):
+        """Copy the source and return ImageStats."""
+        flags = os.O_RDONLY | getattr(os, "O_BINARY", 0) | (os.O_DIRECT if self.direct else 0)
+        with open(os.open(self.source, flags), "rb", buffering=0) as src:
+            size = device_size(src.fileno())
+            if size == 0:
+                raise ValueError(f"{self.source} reports a size of 0 bytes, there is nothing to image")
+            if self.map_in is not None:
+                map_size, extents = read_allocation_map(self.map_in)
+                if map_size != size:
+                    raise ValueError(f"The allocation map is for {map_size} bytes, the image has {size}")
+            else:
+                extents = _data_extents(src.fileno(), size)
+            stats = ImageStats(size)
+            progress = self.progress or ProgressTracker(self.process_queue)
+            progress.set_totals(size)
+            self.extents = []
+            try:
+                with self._open_destination(size) as dst:
+                    self._copy(src, dst, extents, size, stats, progress)
+                    os.fsync(dst.fileno())
+            finally:
+                stats.finish()
+                progress.finish()
+        if self.map_out is not None:
+            write_allocation_map(self.map_out, size, self.extents)
+        return stats
+
+    def _open_destination(self, size):
+        """Open a file destination truncated to ``size`` (all holes) or a device as it is."""
+        self._sparse = not os.path.exists(self.destination) or os.path.isfile(self.destination)
+        if self._sparse:
+            f = open(os.open(self.destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                             0o644), "wb", buffering=0)
+            f.truncate(size)
+            return f
+        f = open(os.open(self.destination, os.O_WRONLY | getattr(os, "O_BINARY", 0)), "wb", buffering=0)
+        capacity = device_size(f.fileno())
+        if capacity < size:
+            f.close()
+            raise ValueError(f"{self.destination} holds {capacity} bytes, the image needs {size}")
+        return f
+
+    def _skip(self, dst, offset, length, stats):
+        """Account for a zero range; on devices it is zeroed once the run is complete."""
+        if length <= 0:
+            return
+        stats.zero_bytes += length
+        if self._sparse:
+            return
+        if self._zeros is not None and sum(self._zeros) == offset:
+            self._zeros = (self._zeros[0], self._zeros[1] + length)
+            return
+        self._flush_zeros(dst)
+        self._zeros = (offset, length)
+
+    def _flush_zeros(self, dst):
+        if self._zeros is not None:
+            _zero_range(dst, *self._zeros)
+            self._zeros = None
+
+    def _write(self, dst, data, offset, stats):
+        """Write a data run and record it in the allocation map."""
+        dst.seek(offset)
+        _write_all(dst, data)
+        stats.data_bytes += len(data)
+        if self.extents and sum(self.extents[-1]) == offset:
+            self.extents[-1] = (self.extents[-1][0], self.extents[-1][1] + len(data))
+        else:
+            self.extents.append((offset, len(data)))
+
+    def _copy(self, src, dst, extents, size, stats, progress):
+        """Read the data ranges in large steps and write their non-zero blocks."""
+        buf = mmap.mmap(-1, self.read_size)
+        view = memoryview(buf)
+        zero_block = bytes(self.block_size)
+        block_size = self.block_size
+        position = 0
+        self._zeros = None
+        for start, length in extents:
+            self._skip(dst, position, start - position, stats)
+            progress.advance(start - position)
+            src.seek(start)
+            position = start
+            end = start + length
+            while position < end:
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise OperationCancelled("Imaging cancelled")
+                n = src.readinto(view[:min(self.read_size, end - position)])
+                if not n:
+                    raise OSError(errno.EIO, f"Unexpected end of {self.source} at {position}")
+                run_start = None  # Offset in buf of the pending data run
+                for pos in range(0, n, block_size):
+                    if buf[pos:pos + block_size] == zero_block[:min(block_size, n - pos)]:
+                        if run_start is not None:
+                            self._write(dst, view[run_start:pos], position + run_start, stats)
+                            run_start = None
+                        self._skip(dst, position + pos, min(block_size, n - pos), stats)
+                    elif run_start is None:
+                        run_start = pos
+                if run_start is not None:
+                    self._write(dst, view[run_start:n], position + run_start, stats)
+                position += n
+                progress.advance(n)
+        self._skip(dst, position, size - position, stats)
+        self._flush_zeros(dst)
+        progress.advance(size - position)
+
+
+BENCHMARK_PROFILES = ("seq-write", "seq-read", "rand-read", "rand-write", "mixed")
+BENCHMARK_BLOCK_SIZES = (4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+BENCHMARK_FILE_SIZE = 64 * 1024 * 1024
+BENCHMARK_FILENAME = "uct_benchmark.bin"
+RANDOM_BLOCK_SIZE = 4 * 1024
+MIXED_READ_RATIO = 0.7  # The "mixed" profile issues 70% reads and 30% writes
+HISTOGRAM_SUB_BUCKET_BITS = 5  # 32 sub-buckets per power of two, about 3% relative error
+HISTOGRAM_MAX_NS = 1 << 40  # About 18 minutes; longer operations land in the last bucket
+TIMELINE_INTERVAL_NS = 100 * 1000 * 1000  # 100 ms throughput buckets
+
+
+def format_size(nbytes):
+    """Format a block size as 4K, 64K, 1M, ..."""
+    for unit, factor in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if nbytes >= factor and nbytes % factor == 0:
+            return f"{nbytes // factor}{unit}"
+    return f"{nbytes}B"
+
+
+def percentile(sorted_values, pct):
+    """Return the nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LatencyHistogram:
+    """Fixed-size log-linear (HDR-style) histogram of nanosecond latencies.
+
+    Values below ``2 * sub_buckets`` are counted exactly, larger values fall
+    into one of ``sub_buckets`` buckets per power of two. Memory use is fixed
+    no matter how many values are recorded.
+    """
+
+    SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS
+
+    def __init__(self):
+        top_shift = HISTOGRAM_MAX_NS.bit_length() - (HISTOGRAM_SUB_BUCKET_BITS + 1)
+        self.counts = array.array("Q", bytes(8 * self.SUB_BUCKETS * (top_shift + 2)))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        """Return the bucket index for a value."""
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - (HISTOGRAM_SUB_BUCKET_BITS + 1)
+        return self.SUB_BUCKETS * (shift + 1) + (value >> shift) - self.SUB_BUCKETS
+
+    def _highest_equivalent(self, index):
+        """Return the largest value that maps to a bucket."""
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        mantissa = index % self.SUB_BUCKETS + self.SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        """Record one latency in nanoseconds."""
+        value = max(0, min(value, HISTOGRAM_MAX_NS - 1))
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the counts of another histogram to this one."""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """Return the value at a percentile (nanoseconds)."""
+        if not self.count:
+            return 0
+        target = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._highest_equivalent(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        """Return the usual percentiles in microseconds."""
+        result = {"count": self.count, "mean_us": self.mean / 1000,
+                  "min_us": (self.min or 0) / 1000, "max_us": self.max / 1000}
+        for pct in (50, 90, 99, 99.9):
+            result[f"p{pct:g}_us"] = self.percentile(pct) / 1000
+        return result
+
+
+class ThroughputTimeline:
+    """Bytes completed per fixed time interval since the start of a run."""
+
+    def __init__(self, start_ns, interval_ns=TIMELINE_INTERVAL_NS):
+        self.start_ns = start_ns
+        self.interval_ns = interval_ns
+        self.buckets = array.array("Q")
+
+    def record(self, end_ns, nbytes):
+        """Account ``nbytes`` to the interval in which an I/O completed."""
+        index = max(0, end_ns - self.start_ns) // self.interval_ns
+        if index >= len(self.buckets):
+            self.buckets.extend([0] * (index + 1 - len(self.buckets)))
+        self.buckets[index] += nbytes
+
+    def merge(self, other):
+        """Add another timeline that shares this one's start time."""
+        if len(other.buckets) > len(self.buckets):
+            self.buckets.extend([0] * (len(other.buckets) - len(self.buckets)))
+        for index, nbytes in enumerate(other.buckets):
+            self.buckets[index] += nbytes
+
+    def mb_per_second(self):
+        """Return the series as MB/s per interval."""
+        scale = 1e9 / self.interval_ns / (1024 ** 2)
+        return [nbytes * scale for nbytes in self.buckets]
+
+    def find_drop(self, ratio=0.5, window=10):
+        """Find where throughput falls below ``ratio`` of its earlier peak for good.
+
+        Uses a moving average over ``window`` intervals (1 s by default) and
+        returns ``(seconds, peak_mb_s, sustained_mb_s)`` or None. This is where
+        cheap flash runs out of its fast (SLC) cache.
+        """
+        series = self.mb_per_second()
+        if len(series) < 2 * window:
+            return None
+        averages = [sum(series[i:i + window]) / window for i in range(len(series) - window + 1)]
+        peak = 0.0
+        for i, value in enumerate(averages):
+            peak = max(peak, value)
+            rest = series[i + window:]
+            if rest and value < ratio * peak and sum(rest) / len(rest) < ratio * peak:
+                first_slow = next(j for j in range(i, i + window) if series[j] < ratio * peak)
+                return first_slow * self.interval_ns / 1e9, peak, sum(rest) / len(rest)
+        return None
+
+
+class BenchmarkResult:
+    """Results of one profile at one block size.
+
+    Holds one throughput sample and one throughput timeline per repeat, and a
+    latency histogram of every I/O across all repeats.
+    """
+
+    def __init__(self, profile, block_size):
+        self.profile = profile
+        self.block_size = block_size
+        self.samples = []  # MB/s
+        self.iops = []
+        self.latency = LatencyHistogram()
+        self.timelines = []
+
+    def add(self, nbytes, ops, seconds, latency=None, timeline=None):
+        """Record one repeat of the profile."""
+        seconds = max(seconds, 1e-9)
+        self.samples.append(nbytes / (1024 ** 2) / seconds)
+        self.iops.append(ops / seconds)
+        if latency is not None:
+            self.latency.merge(latency)
+        if timeline is not None:
+            self.timelines.append(timeline)
+
+    def slowdown(self):
+        """Return the first throughput drop found in any repeat (see ThroughputTimeline.find_drop)."""
+        for timeline in self.timelines:
+            drop = timeline.find_drop()
+            if drop:
+                return drop
+        return None
+
+    @property
+    def mean(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def p50(self):
+        return percentile(sorted(self.samples), 50)
+
+    @property
+    def p99(self):
+        return percentile(sorted(self.samples), 99)
+
+    def to_dict(self):
+        """Return the result as plain data."""
+        return {
+            "profile": self.profile,
+            "block_size": self.block_size,
+            "mb_per_second": {"mean": self.mean, "p50": self.p50, "p99": self.p99, "samples": self.samples},
+            "iops_mean": sum(self.iops) / len(self.iops) if self.iops else 0.0,
+            "latency": self.latency.to_dict(),
+            "timeline_interval_ms": TIMELINE_INTERVAL_NS / 1e6,
+            "timelines_mb_per_second": [timeline.mb_per_second() for timeline in self.timelines],
+        }
+
+    def summary(self):
+        """Return a one-line human readable summary."""
+        line = (f"{self.profile:<10} {format_size(self.block_size):>4}: mean {self.mean:.2f} MB/s, "
+                f"p50 {self.p50:.2f}, p99 {self.p99:.2f}")
+        if not self.profile.startswith("seq"):
+            line += f" ({sum(self.iops) / len(self.iops):.0f} IOPS)"
+        line += (f"; latency p50 {self.latency.percentile(50) / 1000:.0f} us, "
+                 f"p99 {self.latency.percentile(99) / 1000:.0f} us, max {self.latency.max / 1000:.0f} us")
+        drop = self.slowdown()
+        if drop:
+            line += f"; dropped from {drop[1]:.2f} to {drop[2]:.2f} MB/s after {drop[0]:.1f} s"
+        return line
+
+
+class DiskBenchmark:
+    """Run named I/O profiles against a test file in any directory.
+
+    Sequential profiles run at every block size, the random and mixed profiles
+    use 4K blocks spread over ``queue_depth`` threads. Each combination is
+    repeated ``repeats`` times. ``fsync`` includes flushing to the device in
+    write timings and lets reads drop the file from the page cache first;
+    ``direct`` opens the file with O_DIRECT where the platform supports it.
+
+    Every I/O is timed with ``perf_counter_ns`` into a LatencyHistogram and a
+    100 ms ThroughputTimeline. Without ``direct``, buffered writes only reach
+    the device when the page cache flushes, so use ``direct`` to see exactly
+    when a drive falls from its cache speed to its sustained speed.
+    """
+
+    def __init__(self, directory, profiles=BENCHMARK_PROFILES, block_sizes=BENCHMARK_BLOCK_SIZES,
+                 file_size=BENCHMARK_FILE_SIZE, repeats=3, queue_depth=1, random_ops=4096,
+                 fsync=True, direct=False, process_queue=None, seed=0, cancel_event=None, progress=None):
+        unknown = set(profiles) - set(BENCHMARK_PROFILES)
+        if unknown:
+            raise ValueError(f"Unknown benchmark profile(s): {', '.join(sorted(unknown))}")
+        if direct and not hasattr(os, "O_DIRECT"):
+            raise ValueError("O_DIRECT is not supported on this platform")
+
+        self.directory = directory
+        self.path = os.path.join(directory, BENCHMARK_FILENAME)
+        self.profiles = tuple(profiles)
+        self.block_sizes = tuple(sorted(block_sizes))
+        largest = max(self.block_sizes + (RANDOM_BLOCK_SIZE,))
+        self.file_size = max(largest, file_size - file_size % largest)
+        self.repeats = max(1, int(repeats))
+        self.queue_depth = max(1, int(queue_depth))
+        self.random_ops = max(self.queue_depth, int(random_ops))
+        self.fsync = fsync
+        self.direct = direct
+        self.process_queue = process_queue
+        self.seed = seed
+        self.cancel_event = cancel_event
+        self.progress = progress
+        self._buffers = {}
+        self._prepared = False
+
+    def planned_bytes(self):
+        """Return how many bytes the timed runs will transfer."""
+        total = 0
+        for profile in self.profiles:
+            if profile.startswith("seq"):
+                total += self.file_size * len(self.block_sizes)
+            else:
+                total += self.random_ops // self.queue_depth * self.queue_depth * RANDOM_BLOCK_SIZE
+        return total * self.repeats
+
+    def run(self):
+        """Run every profile and return a list of BenchmarkResult."""
+        results = []
+        if self.progress is not None:
+            self.progress.set_totals(self.planned_bytes())
+        try:
+            for profile in self.profiles:
+                block_sizes = self.block_sizes if profile.startswith("seq") else (RANDOM_BLOCK_SIZE,)
+                for block_size in block_sizes:
+                    result = BenchmarkResult(profile, block_size)
+                    for repeat in range(self.repeats):
+                        if self.cancel_event is not None and self.cancel_event.is_set():
+                            raise OperationCancelled("Benchmark cancelled")
+                        run = self._run_once(profile, block_size, repeat)
+                        result.add(*run)
+                        if self.progress is not None:
+                            self.progress.advance(run[0])
+                    results.append(result)
+                    if self.process_queue is not None:
+                        self.process_queue.put(result.summary() + "\n")
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            if self.progress is not None:
+                self.progress.finish()
+        return results
+
+    def _buffer(self, block_size):
+        """Return a page-aligned buffer of random data (required by O_DIRECT)."""
+        buf = self._buffers.get(block_size)
+        if buf is None:
+            buf = mmap.mmap(-1, block_size)
+            buf.write(os.urandom(block_size))
+            self._buffers[block_size] = buf
+        return memoryview(buf)
+
+    def _open(self, flags, mode):
+        """Open the test file unbuffered with the configured flags."""
+        flags |= getattr(os, "O_BINARY", 0)
+        if self.direct:
+            flags |= os.O_DIRECT
+        fd = os.open(self.path, flags, 0o644)
+        return open(fd, mode, buffering=0)
+
+    def _drop_cache(self):
+        """Evict the test file from the page cache so reads hit the device."""
+        if self.direct or not self.fsync or not hasattr(os, "posix_fadvise"):
+            return
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def _prepare(self):
+        """Make sure a full-size test file exists for the read profiles."""
+        if self._prepared:
+            return
+        self._sequential_write(max(self.block_sizes))
+        self._prepared = True
+
+    def _run_once(self, profile, block_size, repeat):
+        """Run one repeat; return (bytes, operations, seconds, latency, timeline)."""
+        if profile == "seq-write":
+            result = self._sequential_write(block_size)
+            self._prepared = True
+            return result
+        self._prepare()
+        self._drop_cache()
+        if profile == "seq-read":
+            return self._sequential_read(block_size)
+        read_ratio = {"rand-read": 1.0, "rand-write": 0.0, "mixed": MIXED_READ_RATIO}[profile]
+        return self._random(block_size, read_ratio, self.seed + repeat)
+
+    def _sequential_write(self, block_size):
+        """Write the whole test file front to back."""
+        view = self._buffer(block_size)
+        count = self.file_size // block_size
+        latency = LatencyHistogram()
+        with self._open(os.O_WRONLY | os.O_CREAT | os.O_TRUNC, "wb") as f:
+            start = time.perf_counter_ns()
+            timeline = ThroughputTimeline(start)
+            for _ in range(count):
+                op_start = time.perf_counter_ns()
+                _write_all(f, view)
+                op_end = time.perf_counter_ns()
+                latency.record(op_end - op_start)
+                timeline.record(op_end, block_size)
+            if self.fsync:
+                os.fsync(f.fileno())
+            elapsed = (time.perf_counter_ns() - start) / 1e9
+        return count * block_size, count, elapsed, latency, timeline
+
+    def _sequential_read(self, block_size):
+        """Read the whole test file front to back."""
+        view = self._buffer(block_size)
+        total = ops = 0
+        latency = LatencyHistogram()
+        with self._open(os.O_RDONLY, "rb") as f:
+            start = time.perf_counter_ns()
+            timeline = ThroughputTimeline(start)
+            while total < self.file_size:
+                op_start = time.perf_counter_ns()
+                n = f.readinto(view)
+                op_end = time.perf_counter_ns()
+                if not n:
+                    break
+                latency.record(op_end - op_start)
+                timeline.record(op_end, n)
+                total += n
+                ops += 1
+            elapsed = (time.perf_counter_ns() - start) / 1e9
+        return total, ops, elapsed, latency, timeline
+
+    def _random(self, block_size, read_ratio, seed):
+        """Issue random block I/O from ``queue_depth`` threads at once."""
+        blocks = self.file_size // block_size
+        per_worker = self.random_ops // self.queue_depth
+        plans = []
+        for worker in range(self.queue_depth):
+            rng = random.Random(seed * 1000 + worker)
+            plans.append([(rng.randrange(blocks) * block_size, rng.random() < read_ratio)
+                          for _ in range(per_worker)])
+
+        writes = read_ratio < 1.0
+        files = [self._open(os.O_RDWR, "r+b") if writes else self._open(os.O_RDONLY, "rb") for _ in plans]
+        latencies = [LatencyHistogram() for _ in plans]
+        start = time.perf_counter_ns()
+        timelines = [ThroughputTimeline(start) for _ in plans]
+        done = [0] * len(plans)  # Ops each thread completed
+        errors = []  # Raised by the threads, re-raised here
+        stop = threading.Event()  # Set on the first error so the other threads stop too
+        try:
+            threads = [threading.Thread(target=self._random_worker, args=args)
+                       for args in zip(range(len(plans)), files, plans, latencies, timelines,
+                                       [block_size] * len(plans), [done] * len(plans), [errors] * len(plans),
+                                       [stop] * len(plans))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = (time.perf_counter_ns() - start) / 1e9
+        finally:
+            for f in files:
+                f.close()
+        if errors:
+            raise errors[0]
+
+        # Each thread records into its own histogram and timeline, merged once at the end
+        latency, timeline = latencies[0], timelines[0]
+        for other_latency, other_timeline in zip(latencies[1:], timelines[1:]):
+            latency.merge(other_latency)
+            timeline.merge(other_timeline)
+        ops = sum(done)
+        return ops * block_size, ops, elapsed, latency, timeline
+
+    def _random_worker(self, index, f, plan, latency, timeline, block_size, done, errors, stop):
+        """Execute one thread's share of a random profile; errors are put on ``errors``."""
+        try:
+            view = memoryview(mmap.mmap(-1, block_size))
+            view[:] = self._buffer(block_size)
+            wrote = False
+            for offset, is_read in plan:
+                if stop.is_set():
+                    return
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise OperationCancelled("Benchmark cancelled")
+                op_start = time.perf_counter_ns()
+                f.seek(offset)
+                if is_read:
+                    f.readinto(view)
+                else:
+                    _write_all(f, view)
+                    wrote = True
+                op_end = time.perf_counter_ns()
+                latency.record(op_end - op_start)
+                timeline.record(op_end, block_size)
+                done[index] += 1
+            if wrote and self.fsync:
+                os.fsync(f.fileno())
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+
+def _write_all(f, view):
+    """Write the whole buffer to an unbuffered file."""
+    while view:
+        written = f.write(view)
+        view = view[written:]
+
+
+SURFACE_BLOCK_SIZE = 1024 * 1024  # Unit generated and compared in one go
+SURFACE_SECTOR_SIZE = 4096  # Every sector is stamped with its own offset
+SURFACE_READ_SIZE = 16 * 1024 * 1024  # Bytes requested per read while verifying
+SURFACE_FILE_SIZE = 1024 ** 3  # Free space is filled with files of this size, like h2testw and f3
+SURFACE_FILE_PATTERN = "uct_surface_{:04d}.bin"
+SURFACE_RESERVE = 16 * 1024 * 1024  # Free space left for file system metadata
+SURFACE_MAX_RANGES = 1000  # Corrupted ranges listed in the result; bytes are counted beyond this
+
+# CreateFileW constants for opening surface test files uncached on Windows
+GENERIC_READ = 0x80000000
+GENERIC_WRITE = 0x40000000
+FILE_SHARE_READ_WRITE = 0x1 | 0x2
+CREATE_ALWAYS = 2
+OPEN_EXISTING = 3
+FILE_FLAG_NO_BUFFERING = 0x20000000
+FILE_FLAG_WRITE_THROUGH = 0x80000000
+
+
+def open_uncached_windows(path, flags):
+    """Open ``path`` with FILE_FLAG_NO_BUFFERING and return a C runtime file descriptor.
+
+    Windows has neither O_DIRECT nor posix_fadvise; this is the only way to
+    make reads come from the drive. Offsets, lengths and buffers must be
+    sector-aligned.
+    """
+    import ctypes
+    import msvcrt
+    from ctypes import wintypes
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+                                     wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+    writing = flags & (os.O_WRONLY | os.O_RDWR)
+    access = GENERIC_READ | GENERIC_WRITE if flags & os.O_RDWR else GENERIC_WRITE if writing else GENERIC_READ
+    disposition = CREATE_ALWAYS if flags & os.O_CREAT else OPEN_EXISTING
+    handle = kernel32.CreateFileW(path, access, FILE_SHARE_READ_WRITE, None, disposition,
+                                  FILE_FLAG_NO_BUFFERING | FILE_FLAG_WRITE_THROUGH, None)
+    if handle is None or handle == ctypes.c_void_p(-1).value:
+        error = ctypes.get_last_error()
+        raise OSError(None, ctypes.FormatError(error), path, error)
+    return msvcrt.open_osfhandle(handle, flags & (os.O_WRONLY | os.O_RDWR))
+
+
+class SurfacePattern:
+    """Deterministic test data keyed by the byte offset it is written to.
+
+    A pool of seeded random bytes is generated once; every block is a window
+    into the pool picked by its offset, and every sector starts with its own
+    offset xor the seed. Building a block is one copy plus a few stamps, so
+    the pattern keeps up with fast drives, and a sector that comes back from
+    the wrong place (drives that wrap around) tells where it was written.
+    """
+
+    _stamp = struct.Struct("<Q")
+
+    def __init__(self, seed, block_size=SURFACE_BLOCK_SIZE, sector_size=SURFACE_SECTOR_SIZE):
+        if block_size % sector_size:
+            raise ValueError("The block size must be a multiple of the sector size")
+        self.seed = seed & 0xFFFFFFFFFFFFFFFF
+        self.block_size = block_size
+        self.sector_size = sector_size
+        self._pool = memoryview(random.Random(seed).randbytes(2 * block_size))
+
+    def fill(self, buf, offset):
+        """Write the expected contents of the block at ``offset`` into ``buf``."""
+        shift = (offset // self.block_size * 0x9E3779B97F4A7C15 >> 24) % self.block_size
+        buf[:self.block_size] = self._pool[shift:shift + self.block_size]
+        pack = self._stamp.pack_into
+        for pos in range(0, self.block_size, self.sector_size):
+            pack(buf, pos, (offset + pos) ^ self.seed)
+
+    def origin(self, sector):
+        """Return the offset stamped into a sector read back from the drive."""
+        return self._stamp.unpack_from(sector)[0] ^ self.seed
+
+
+class SurfaceResult:
+    """Outcome of a surface test: usable capacity, bad ranges and throughput."""
+
+    def __init__(self, target, planned_bytes, seed):
+        self.target = target
+        self.planned_bytes = planned_bytes
+        self.seed = seed
+        self.written_bytes = 0
+        self.verified_bytes = 0
+        self.corrupted_bytes = 0
+        self.aliased_bytes = 0  # Corrupted sectors holding data written to another offset
+        self.ranges = []  # [start, end) byte ranges that did not verify
+        self.first_alias = None  # (offset read, offset it was written to)
+        self.write_seconds = 0.0
+        self.read_seconds = 0.0
+        self.write_error = None
+        self.uncached = True  # False if the read-back may have been served from the page cache
+
+    def mark_bad(self, start, end, aliased=False):
+        """Record a corrupted byte range, merging it with the previous one."""
+        self.corrupted_bytes += end - start
+        if aliased:
+            self.aliased_bytes += end - start
+        if self.ranges and self.ranges[-1][1] == start:
+            self.ranges[-1][1] = end
+        elif len(self.ranges) < SURFACE_MAX_RANGES:
+            self.ranges.append([start, end])
+
+    @property
+    def ok_bytes(self):
+        return self.verified_bytes - self.corrupted_bytes
+
+    @property
+    def usable_capacity(self):
+        """Bytes that kept their data; on a drive that wraps around this is its real size."""
+        return self.ok_bytes
+
+    @property
+    def first_error(self):
+        """Offset of the first corrupted byte, or None."""
+        return self.ranges[0][0] if self.ranges else None
+
+    @property
+    def write_mb_per_second(self):
+        return self.written_bytes / self.write_seconds / (1024 * 1024) if self.write_seconds else 0.0
+
+    @property
+    def read_mb_per_second(self):
+        return self.verified_bytes / self.read_seconds / (1024 * 1024) if self.read_seconds else 0.0
+
+    def to_dict(self):
+        return {
+            "target": self.target,
+            "seed": self.seed,
+            "planned_bytes": self.planned_bytes,
+            "written_bytes": self.written_bytes,
+            "verified_bytes": self.verified_bytes,
+            "ok_bytes": self.ok_bytes,
+            "corrupted_bytes": self.corrupted_bytes,
+            "aliased_bytes": self.aliased_bytes,
+            "usable_capacity": self.usable_capacity,
+            "first_error": self.first_error,
+            "corrupted_ranges": [tuple(r) for r in self.ranges],
+            "first_alias": self.first_alias,
+            "write_mb_per_second": round(self.write_mb_per_second, 2),
+            "read_mb_per_second": round(self.read_mb_per_second, 2),
+            "write_error": self.write_error,
+            "uncached": self.uncached,
+        }
+
+    def summary(self):
+        lines = [f"Surface test of {self.target}: {format_size(self.verified_bytes)} verified, "
+                 f"{format_size(self.ok_bytes)} OK, {format_size(self.corrupted_bytes)} corrupted",
+                 f"Write {self.write_mb_per_second:.1f} MB/s, read {self.read_mb_per_second:.1f} MB/s"]
+        if self.write_error:
+            lines.append(f"Writing stopped early: {self.write_error}")
+        if not self.uncached:
+            lines.append("The page cache could not be bypassed on this platform: the read-back may have been "
+                         "served from RAM and missed fake capacity")
+        if self.ranges:
+            lines.append(f"Usable capacity: {format_size(self.usable_capacity)}, "
+                         f"first error at {format_size(self.first_error)}")
+            for start, end in self.ranges[:10]:
+                lines.append(f"  Corrupted: {start:#x} - {end:#x} ({format_size(end - start)})")
+            if len(self.ranges) > 10:
+                lines.append(f"  ... and {len(self.ranges) - 10} more ranges")
+            if self.first_alias is not None:
+                read_at, written_at = self.first_alias
+                lines.append(f"Data read at {format_size(read_at)} was written at {format_size(written_at)}: "
+                             f"the drive wraps around and its real capacity is smaller than reported")
+        else:
+            lines.append("No errors found.")
+        return "\n".join(lines)
+
+
+class SurfaceTest:
+    """Write position-keyed test data over a drive and verify every byte.
+
+    ``target`` is either a directory, whose free space is filled with
+    SURFACE_FILE_SIZE test files that are removed afterwards (unless
+    ``keep_files``), or an image file / block device that is overwritten in
+    place and therefore needs ``destructive=True``. ``size`` limits how many
+    bytes are tested. Reads drop the data from the page cache first (or use
+    ``direct``) so they come from the drive, not from RAM; on Windows the
+    files are always opened with FILE_FLAG_NO_BUFFERING and on macOS with
+    F_NOCACHE.
+    """
+
+    def __init__(self, target, size=None, block_size=SURFACE_BLOCK_SIZE, file_size=SURFACE_FILE_SIZE,
+                 seed=None, destructive=False, keep_files=False, direct=False, process_queue=None,
+                 cancel_event=None, progress=None):
+        if direct and not hasattr(os, "O_DIRECT") and sys.platform != "win32":
+            raise ValueError("O_DIRECT is not supported on this platform")
+        self.target = target
+        self.in_place = not os.path.isdir(target)
+        if self.in_place and not destructive:
+            raise ValueError(f"{target} is not a directory and testing it overwrites its contents; "
+                             f"allow this with destructive=True (--destructive on the command line)")
+        self.block_size = block_size
+        self.file_size = max(block_size, file_size - file_size % block_size)
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.pattern = SurfacePattern(self.seed, block_size)
+        self.keep_files = keep_files
+        self.direct = direct
+        self.process_queue = process_queue
+        self.cancel_event = cancel_event
+        self.progress = progress
+        self.size = self._available() if size is None else min(size, self._available())
+        self.size -= self.size % block_size
+        self.segments = self._plan()
+
+    def _available(self):
+        """Return how many bytes can be tested on the target."""
+        if not self.in_place:
+            return max(0, shutil.disk_usage(self.target).free - SURFACE_RESERVE)
+        fd = os.open(self.target, os.O_RDONLY)
+        try:
+            return device_size(fd)
+        finally:
+            os.close(fd)
+
+    def _plan(self):
+        """Split the tested range into (path, offset, length) segments."""
+        if self.in_place:
+            return [(self.target, 0, self.size)]
+        return [(os.path.join(self.target, SURFACE_FILE_PATTERN.format(index)), offset,
+                 min(self.file_size, self.size - offset))
+                for index, offset in enumerate(range(0, self.size, self.file_size))]
+
+    def run(self):
+        """Fill, then verify; return a SurfaceResult."""
+        result = SurfaceResult(self.target, self.size, self.seed)
+        result.uncached = self._bypasses_cache()
+        if self.progress is not None:
+            self.progress.set_totals(2 * self.size)
+        buf = mmap.mmap(-1, max(SURFACE_READ_SIZE, self.block_size))  # Page-aligned for O_DIRECT
+        try:
+            self._write(result, buf)
+            self._verify(result, buf)
+        finally:
+            if not self.in_place and not self.keep_files:
+                for path, _, _ in self.segments:
+                    if os.path.exists(path):
+                        os.remove(path)
+            if self.progress is not None:
+                self.progress.finish()
+        return result
+
+    def _bypasses_cache(self):
+        """Return True if the read-back is guaranteed to come from the drive."""
+        if self.direct or sys.platform == "win32" or hasattr(os, "posix_fadvise"):
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        return hasattr(fcntl, "F_NOCACHE")
+
+    def _open(self, path, flags, mode):
+        """Open a segment unbuffered and, where the platform allows, uncached."""
+        flags |= getattr(os, "O_BINARY", 0)
+        if sys.platform == "win32":
+            return open(open_uncached_windows(path, flags), mode, buffering=0)
+        if self.direct:
+            flags |= os.O_DIRECT
+        fd = os.open(path, flags, 0o644)
+        if not self.direct and not hasattr(os, "posix_fadvise"):
+            import fcntl
+            if hasattr(fcntl, "F_NOCACHE"):
+                fcntl.fcntl(fd, fcntl.F_NOCACHE, 1)
+        return open(fd, mode, buffering=0)
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise OperationCancelled("Surface test cancelled")
+
+    def _write(self, result, buf):
+        """Write the pattern over every segment until done or the drive is full."""
+        if self.process_queue is not None:
+            self.process_queue.put(f"Writing {format_size(self.size)} of test data to {self.target}...\n")
+        block = memoryview(buf)[:self.block_size]
+        start = time.perf_counter()
+        for path, offset, length in self.segments:
+            try:
+                self._write_segment(result, block, path, offset, length)
+            except OSError as e:
+                # A full file system ends the fill; anything else is reported and verified up to there
+                if e.errno != errno.ENOSPC:
+                    result.write_error = str(e)
+                break
+        result.write_seconds = time.perf_counter() - start
+        if result.written_bytes < self.size and self.progress is not None:
+            self.progress.set_totals(2 * result.written_bytes)
+        if self.process_queue is not None:
+            self.process_queue.put(f"Wrote {format_size(result.written_bytes)} in {result.write_seconds:.1f} s "
+                                   f"({result.write_mb_per_second:.1f} MB/s)\n")
+
+    def _write_segment(self, result, block, path, offset, length):
+        """Write one segment, then flush it and drop it from the page cache."""
+        flags = os.O_WRONLY if self.in_place else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        with self._open(path, flags, "wb") as f:
+            try:
+                for position in range(offset, offset + length, self.block_size):
+                    self._check_cancelled()
+                    self.pattern.fill(block, position)
+                    _write_all(f, block)
+                    result.written_bytes += self.block_size
+                    if self.progress is not None:
+                        self.progress.advance(self.block_size)
+            finally:
+                os.fsync(f.fileno())
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _verify(self, result, buf):
+        """Read every written block back with large reads and compare it to the pattern."""
+        if self.process_queue is not None:
+            self.process_queue.put("Verifying test data...\n")
+        view = memoryview(buf)
+        expected = bytearray(self.block_size)
+        start = time.perf_counter()
+        for path, offset, length in self.segments:
+            length = min(length, result.written_bytes - offset)
+            if length <= 0:
+                break
+            with self._open(path, os.O_RDONLY, "rb") as f:
+                done = 0
+                while done < length:
+                    self._check_cancelled()
+                    want = min(len(buf), length - done)
+                    try:
+                        n = f.readinto(view[:want])
+                    except OSError:
+                        # Unreadable chunk: count it as corrupted and read on behind it
+                        result.verified_bytes += want
+                        result.mark_bad(offset + done, offset + done + want)
+                        done += want
+                        f.seek(done)
+                        continue
+                    n -= n % self.block_size
+                    for pos in range(0, n, self.block_size):
+                        position = offset + done + pos
+                        self.pattern.fill(expected, position)
+                        data = buf[pos:pos + self.block_size]
+                        if data != expected:
+                            self._compare_sectors(result, data, expected, position)
+                    result.verified_bytes += n
+                    done += n
+                    if self.progress is not None:
+                        self.progress.advance(n)
+                    if n < want:
+                        # The segment is shorter than what was written
+                        result.verified_bytes += length - done
+                        result.mark_bad(offset + done, offset + length)
+                        break
+        result.read_seconds = time.perf_counter() - start
+
+    def _compare_sectors(self, result, data, expected, position):
+        """Locate the bad sectors of a block that did not verify."""
+        sector_size = self.pattern.sector_size
+        for pos in range(0, self.block_size, sector_size):
+            sector = data[pos:pos + sector_size]  # bytes, compared with memcmp
+            if sector == expected[pos:pos + sector_size]:
+                continue
+            origin = self.pattern.origin(sector)
+            aliased = origin != position + pos and origin % sector_size == 0 and origin < self.size
+            if aliased and result.first_alias is None:
+                result.first_alias = (position + pos, origin)
+            result.mark_bad(position + pos, position + pos + sector_size, aliased)
+
+
+def get_drive_label(drive_letter):
+    """Get the label of the drive (if available)."""
+    try:
+        # Use `ctypes` to retrieve the drive label (Windows-specific)
+        if sys.platform == "win32":
+            import ctypes
+            volume_name_buffer = ctypes.create_unicode_buffer(1024)
+            file_system_buffer = ctypes.create_unicode_buffer(1024)
+            ctypes.windll.kernel32.GetVolumeInformationW(
+                ctypes.c_wchar_p(drive_letter),
+                volume_name_buffer,
+                ctypes.sizeof(volume_name_buffer),
+                None,
+                None,
+                None,
+                file_system_buffer,
+                ctypes.sizeof(file_system_buffer)
+            )
+            return volume_name_buffer.value.strip() or "No Label"
+        else:
+            # For Linux/macOS: Use `os.statvfs` or similar methods
+            return "No Label"
+    except Exception as e:
+        logging.error(f"Error getting drive label: {e}")
+        return "No Label"
+
+
+class DrivesChanged:
+    """Posted on the process queue by DriveEnumerator.watch when drives come or go."""
+
+
+def _unescape_mount_field(field):
+    """Undo the octal escapes (\\040 for space, ...) used in /proc/self/mountinfo."""
+    if "\\" not in field:
+        return field
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+    """Parse /proc/self/mountinfo into ``(major:minor, mount_point, fstype, source)`` tuples."""
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split()
+        try:
+            separator = fields.index("-", 6)
+            mounts.append((fields[2], _unescape_mount_field(fields[4]), fields[separator + 1],
+                           _unescape_mount_field(fields[separator + 2])))
+        except (ValueError, IndexError):
+            continue
+    return mounts
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return ""
+
+
+def read_removable_devices(sys_block="/sys/block"):
+    """Return ``{major:minor: disk}`` for removable/USB disks and their partitions."""
+    devices = {}
+    try:
+        disks = os.listdir(sys_block)
+    except OSError:
+        return devices
+    for disk in disks:
+        if disk.startswith(("sr", "loop", "ram")):
+            continue  # Optical drives, loop devices and RAM disks are not USB sticks
+        disk_path = os.path.join(sys_block, disk)
+        removable = _read_first_line(os.path.join(disk_path, "removable")) == "1"
+        if not removable and "/usb" not in os.path.realpath(disk_path):
+            continue
+        number = _read_first_line(os.path.join(disk_path, "dev"))
+        if number:
+            devices[number] = disk
+        try:
+            children = os.listdir(disk_path)
+        except OSError:
+            continue
+        for child in children:
+            if child.startswith(disk):
+                number = _read_first_line(os.path.join(disk_path, child, "dev"))
+                if number:
+                    devices[number] = disk
+    return devices
+
+
+def read_device_labels(by_label="/dev/disk/by-label"):
+    """Return ``{device name: label}`` from the udev by-label symlinks."""
+    labels = {}
+    try:
+        names = os.listdir(by_label)
+    except OSError:
+        return labels
+    for name in names:
+        target = os.path.basename(os.path.realpath(os.path.join(by_label, name)))
+        # udev escapes unsafe bytes of the UTF-8 label as \xNN
+        raw = re.sub(rb"\\x([0-9a-fA-F]{2})", lambda m: bytes([int(m.group(1), 16)]), os.fsencode(name))
+        labels[target] = raw.decode("utf-8", "replace")
+    return labels
+
+
+class DriveEnumerator:
+    """Cached USB drive discovery.
+
+    On Linux the mount table and the removable flags are read once per
+    refresh from /proc/self/mountinfo and /sys/block, which stays fast with
+    thousands of container mounts. Elsewhere psutil.disk_partitions() is
+    called once. Results are cached for ``ttl`` seconds or until
+    ``invalidate`` is called; ``watch`` invalidates the cache (and posts
+    DrivesChanged) as soon as the set of mounts changes.
+    """
+
+    def __init__(self, ttl=5.0, mountinfo_path="/proc/self/mountinfo", sys_block="/sys/block",
+                 by_label="/dev/disk/by-label"):
+        self.ttl = ttl
+        self.mountinfo_path = mountinfo_path
+        self.sys_block = sys_block
+        self.by_label = by_label
+        self._drives = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stop_watch = threading.Event()
+
+    def drives(self, refresh=False):
+        """Return ``(path, label, fstype)`` for every mounted USB drive."""
+        with self._lock:
+            if refresh or self._drives is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._drives = self._enumerate()
+                self._loaded_at = time.monotonic()
+            return list(self._drives)
+
+    def invalidate(self):
+        """Forget the cached drives so the next call enumerates again."""
+        with self._lock:
+            self._drives = None
+
+    def is_usb_drive(self, path):
+        """Return True if ``path`` is the mount point of a USB drive."""
+        path = os.path.normcase(os.path.abspath(path))
+        return any(os.path.normcase(os.path.abspath(drive)) == path for drive, _, _ in self.drives())
+
+    def _enumerate(self):
+        if sys.platform.startswith("linux") and os.path.exists(self.mountinfo_path):
+            return self._enumerate_linux()
+        return self._enumerate_psutil()
+
+    def _enumerate_linux(self):
+        with open(self.mountinfo_path) as f:
+            mounts = parse_mountinfo(f.read())
+        removable = read_removable_devices(self.sys_block)
+        if not removable:
+            return []
+        labels = read_device_labels(self.by_label)
+        drives = []
+        for number, mount_point, fstype, source in mounts:
+            if number in removable:
+                label = labels.get(os.path.basename(source), "No Label")
+                drives.append((mount_point, label, fstype))
+        return drives
+
+    def _enumerate_psutil(self):
+        import psutil
+        drives = []
+        for partition in psutil.disk_partitions():
+            if sys.platform == "win32":
+                import ctypes
+                if ctypes.windll.kernel32.GetDriveTypeW(ctypes.c_wchar_p(partition.device)) != 2:
+                    continue  # DRIVE_REMOVABLE = 2
+                drives.append((partition.device, get_drive_label(partition.device), partition.fstype))
+            elif "removable" in partition.opts:
+                drives.append((partition.mountpoint, get_drive_label(partition.device), partition.fstype))
+        return drives
+
+    def watch(self, process_queue=None, callback=None, interval=2.0):
+        """Watch for mounts coming and going on a background thread.
+
+        On Linux the thread sleeps in poll() on /proc/self/mountinfo, which
+        wakes up on every mount table change; elsewhere the mount list is
+        compared every ``interval`` seconds.
+        """
+        if self._watcher is not None:
+            return
+        self._stop_watch.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(process_queue, callback, interval),
+                                         name="uct-drive-watch", daemon=True)
+        self._watcher.start()
+
+    def stop_watch(self):
+        """Stop the watcher thread."""
+        self._stop_watch.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _mount_signature(self):
+        if sys.platform == "win32":
+            import ctypes
+            return ctypes.windll.kernel32.GetLogicalDrives()
+        import psutil
+        return tuple(p.mountpoint for p in psutil.disk_partitions())
+
+    def _watch(self, process_queue, callback, interval):
+        import select
+        poller = None
+        if sys.platform.startswith("linux") and hasattr(select, "poll") and os.path.exists(self.mountinfo_path):
+            mountinfo = open(self.mountinfo_path)
+            mountinfo.read()
+            poller = select.poll()
+            poller.register(mountinfo, select.POLLPRI | select.POLLERR)
+        else:
+            signature = self._mount_signature()
+
+        try:
+            while not self._stop_watch.is_set():
+                if poller is not None:
+                    changed = bool(poller.poll(interval * 1000))
+                    if changed:
+                        mountinfo.seek(0)
+                        mountinfo.read()
+                else:
+                    self._stop_watch.wait(interval)
+                    current = self._mount_signature()
+                    changed = current != signature
+                    signature = current
+                if changed and not self._stop_watch.is_set():
+                    self.invalidate()
+                    if process_queue is not None:
+                        process_queue.put(DrivesChanged())
+                    if callback is not None:
+                        callback()
+        finally:
+            if poller is not None:
+                mountinfo.close()
+
+
+_drive_enumerator = DriveEnumerator()
+
+
+def is_usb_drive(drive_letter):
+    """Check if the drive is a USB drive."""
+    try:
+        # Windows: Check if the drive is removable
+        if sys.platform == "win32":
+            import ctypes
+            drive_type = ctypes.windll.kernel32.GetDriveTypeW(ctypes.c_wchar_p(drive_letter))
+            return drive_type == 2  # DRIVE_REMOVABLE = 2
+        else:
+            # Linux/macOS: Check against the (cached) list of removable mounts
+            return _drive_enumerator.is_usb_drive(drive_letter)
+    except Exception as e:
+        logging.error(f"Error checking if drive is USB: {e}")
+        return False
+
+
+def list_usb_drives(refresh=False):
+    """Return ``(path, label, fstype)`` for every mounted USB drive."""
+    return _drive_enumerator.drives(refresh=refresh)
+
+
+def watch_drives(process_queue=None, callback=None):
+    """Post DrivesChanged to ``process_queue`` whenever drives are plugged in or removed."""
+    _drive_enumerator.watch(process_queue=process_queue, callback=callback)
+
+
+def analyze_drive(drive):
+    """Return storage information about a drive (or any directory) as a dict."""
+    import psutil
+    usage = shutil.disk_usage(drive)
+    partition = next((p for p in psutil.disk_partitions() if drive in (p.device, p.mountpoint)), None)
+    return {
+        "drive": drive,
+        "file_system": partition.fstype if partition else None,
+        "total": usage.total,
+        "used": usage.used,
+        "free": usage.free,
+    }
+
+
+DEFAULT_SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+SIZE_HISTOGRAM_BOUNDS = (4 * 1024, 64 * 1024, 1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2, 4 * 1024 ** 3)
+TINY_FILE_SIZE = 64 * 1024  # Files below this are dominated by per-file overhead when copied
+SCAN_CACHE_MAX_AGE = 15 * 60  # Seconds a deep scan is reused for backup totals
+
+
+class TreeScan:
+    """Content statistics of a directory tree, as collected by deep_scan."""
+
+    def __init__(self, root, top=10):
+        self.root = root
+        self.top = top
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.size_histogram = [0] * (len(SIZE_HISTOGRAM_BOUNDS) + 1)
+        self.tiny_files = 0
+        self.tiny_bytes = 0
+        self.extensions = {}  # extension -> [files, bytes]
+        self.dir_bytes = {}  # relative directory -> bytes of the files directly inside
+        self.largest_files = []  # min-heap of (size, relative path)
+        self.elapsed = 0.0
+        self.scanned_at = time.time()
+
+    def add_file(self, relative_dir, name, size):
+        """Account for one file (called by a single scan worker)."""
+        self.files += 1
+        self.bytes += size
+        self.size_histogram[bisect.bisect_right(SIZE_HISTOGRAM_BOUNDS, size)] += 1
+        if size < TINY_FILE_SIZE:
+            self.tiny_files += 1
+            self.tiny_bytes += size
+
+        dot = name.rfind(".")
+        extension = name[dot:].lower() if dot > 0 else "(none)"
+        totals = self.extensions.get(extension)
+        if totals is None:
+            self.extensions[extension] = [1, size]
+        else:
+            totals[0] += 1
+            totals[1] += size
+
+        if len(self.largest_files) < self.top or size > self.largest_files[0][0]:
+            path = name if relative_dir == "." else os.path.join(relative_dir, name)
+            if len(self.largest_files) < self.top:
+                heapq.heappush(self.largest_files, (size, path))
+            else:
+                heapq.heappushpop(self.largest_files, (size, path))
+
+    def merge(self, other):
+        """Add the statistics of another worker's partial scan."""
+        self.files += other.files
+        self.dirs += other.dirs
+        self.bytes += other.bytes
+        self.errors += other.errors
+        self.tiny_files += other.tiny_files
+        self.tiny_bytes += other.tiny_bytes
+        for i, count in enumerate(other.size_histogram):
+            self.size_histogram[i] += count
+        for extension, (files, nbytes) in other.extensions.items():
+            totals = self.extensions.setdefault(extension, [0, 0])
+            totals[0] += files
+            totals[1] += nbytes
+        for relative_dir, nbytes in other.dir_bytes.items():
+            self.dir_bytes[relative_dir] = self.dir_bytes.get(relative_dir, 0) + nbytes
+        for item in other.largest_files:
+            if len(self.largest_files) < self.top:
+                heapq.heappush(self.largest_files, item)
+            elif item > self.largest_files[0]:
+                heapq.heappushpop(self.largest_files, item)
+
+    def top_files(self):
+        """Return ``(size, path)`` of the largest files, largest first."""
+        return sorted(self.largest_files, reverse=True)
+
+    def top_directories(self):
+        """Return ``(size, path)`` of the largest directories including subdirectories."""
+        totals = dict(self.dir_bytes)
+        for relative_dir in self.dir_bytes:
+            while relative_dir != ".":
+                relative_dir = os.path.dirname(relative_dir) or "."
+                totals.setdefault(relative_dir, 0)
+
+        # Roll sizes up to every parent, deepest directories first
+        for relative_dir in sorted(totals, key=lambda d: d.count(os.sep), reverse=True):
+            if relative_dir != ".":
+                parent = os.path.dirname(relative_dir) or "."
+                totals[parent] += totals[relative_dir]
+        return sorted(((size, path) for path, size in totals.items() if path != "."), reverse=True)[:self.top]
+
+    def top_extensions(self):
+        """Return ``(extension, files, bytes)`` sorted by bytes."""
+        ranked = sorted(self.extensions.items(), key=lambda item: item[1][1], reverse=True)
+        return [(extension, files, nbytes) for extension, (files, nbytes) in ranked[:self.top]]
+
+    def histogram_labels(self):
+        """Return labels for the size histogram buckets."""
+        bounds = [format_size(bound) for bound in SIZE_HISTOGRAM_BOUNDS]
+        labels = [f"<{bounds[0]}"]
+        labels += [f"{low}-{high}" for low, high in zip(bounds, bounds[1:])]
+        labels.append(f">={bounds[-1]}")
+        return labels
+
+    def to_dict(self):
+        """Return the statistics as plain data."""
+        return {
+            "root": self.root,
+            "files": self.files,
+            "directories": self.dirs,
+            "bytes": self.bytes,
+            "errors": self.errors,
+            "seconds": self.elapsed,
+            "tiny_files": self.tiny_files,
+            "tiny_bytes": self.tiny_bytes,
+            "size_histogram": dict(zip(self.histogram_labels(), self.size_histogram)),
+            "largest_files": [{"path": path, "bytes": size} for size, path in self.top_files()],
+            "largest_directories": [{"path": path, "bytes": size} for size, path in self.top_directories()],
+            "extensions": [{"extension": extension, "files": files, "bytes": nbytes}
+                           for extension, files, nbytes in self.top_extensions()],
+        }
+
+    def report(self):
+        """Return a multi-line human readable report."""
+        lines = [f"Files: {self.files} in {self.dirs} directories, {self.bytes / (1024 ** 3):.2f} GB "
+                 f"(scanned in {self.elapsed:.2f} s)",
+                 f"Tiny files (<{format_size(TINY_FILE_SIZE)}): {self.tiny_files} "
+                 f"({self.tiny_files / max(self.files, 1) * 100:.1f}% of files)",
+                 "Size histogram:"]
+        for label, count in zip(self.histogram_labels(), self.size_histogram):
+            lines.append(f"  {label:>10}: {count}")
+        lines.append("Largest files:")
+        for size, path in self.top_files():
+            lines.append(f"  {size / (1024 ** 2):10.2f} MB  {path}")
+        lines.append("Largest directories:")
+        for size, path in self.top_directories():
+            lines.append(f"  {size / (1024 ** 2):10.2f} MB  {path}")
+        lines.append("By extension:")
+        for extension, files, nbytes in self.top_extensions():
+            lines.append(f"  {extension:>10}: {files} files, {nbytes / (1024 ** 2):.2f} MB")
+        if self.errors:
+            lines.append(f"Unreadable entries: {self.errors}")
+        return "\n".join(lines) + "\n"
+
+
+_scan_cache = {}
+_scan_cache_lock = threading.Lock()
+
+
+def cached_scan(root, max_age=SCAN_CACHE_MAX_AGE):
+    """Return the last deep scan of ``root`` if it is recent enough, else None."""
+    with _scan_cache_lock:
+        scan = _scan_cache.get(os.path.normcase(os.path.abspath(root)))
+    if scan is not None and time.time() - scan.scanned_at <= max_age:
+        return scan
+    return None
+
+
+def _scan_directory(root, path, partial, work):
+    """Scan one directory into a worker's partial result; subdirectories go back on the queue."""
+    relative_dir = os.path.relpath(path, root)
+    dir_bytes = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    # is_dir() uses the directory entry type, only files are stat'ed (once)
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            partial.dirs += 1
+                            work.put(entry.path)
+                        continue
+                    size = entry.stat().st_size
+                    partial.add_file(relative_dir, entry.name, size)
+                    dir_bytes += size
+                except OSError:
+                    partial.errors += 1
+    except OSError:
+        partial.errors += 1
+    if dir_bytes:
+        partial.dir_bytes[relative_dir] = partial.dir_bytes.get(relative_dir, 0) + dir_bytes
+
+
+def deep_scan(root, workers=DEFAULT_SCAN_WORKERS, process_queue=None, cancel_event=None, report_interval=1.0,
+              top=10):
+    """Scan a tree with a pool of threads sharing a queue of directories.
+
+    Every worker collects into its own TreeScan, merged when the walk is done.
+    Running totals are posted to ``process_queue`` every ``report_interval``
+    seconds. The result is cached for cached_scan.
+    """
+    start = time.perf_counter()
+    work = Queue()
+    work.put(root)
+    partials = [TreeScan(root, top) for _ in range(max(1, int(workers)))]
+
+    def worker(partial):
+        while True:
+            path = work.get()
+            try:
+                if path is None:
+                    return
+                if cancel_event is None or not cancel_event.is_set():
+                    _scan_directory(root, path, partial, work)
+            finally:
+                work.task_done()
+
+    threads = [threading.Thread(target=worker, args=(partial,), daemon=True) for partial in partials]
+    for thread in threads:
+        thread.start()
+    finished = threading.Event()
+    threading.Thread(target=lambda: (work.join(), finished.set()), daemon=True).start()
+
+    while not finished.wait(report_interval):
+        if process_queue is not None:
+            files = sum(p.files for p in partials)
+            nbytes = sum(p.bytes for p in partials)
+            dirs = sum(p.dirs for p in partials)
+            process_queue.put(f"Scanning... {files} files, {dirs} directories, {nbytes / (1024 ** 2):.1f} MB\n")
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    if cancel_event is not None and cancel_event.is_set():
+        raise OperationCancelled("Analysis cancelled")
+
+    scan = partials[0]
+    for partial in partials[1:]:
+        scan.merge(partial)
+    scan.elapsed = time.perf_counter() - start
+    scan.scanned_at = time.time()
+    with _scan_cache_lock:
+        _scan_cache[os.path.normcase(os.path.abspath(root))] = scan
+    return scan
+
+
+def run_analysis(drive, process_queue=None, cancel_event=None, deep=True, **options):
+    """Analyze a drive; ``deep`` adds a content scan (``options`` go to deep_scan)."""
+    info = analyze_drive(drive)
+    if deep:
+        if process_queue is not None:
+            process_queue.put("Analyzing drive contents...\n")
+        scan = deep_scan(drive, process_queue=process_queue, cancel_event=cancel_event, **options)
+        if process_queue is not None:
+            process_queue.put(scan.report())
+        info["content"] = scan.to_dict()
+        logging.info(f"Deep analyzed drive: {drive} - {scan.files} files, {scan.bytes} bytes "
+                     f"in {scan.elapsed:.2f} s", extra=log_fields(drive, "analysis", scan.bytes, scan.elapsed))
+    return info
+
+
+def run_benchmark(drive, process_queue=None, cancel_event=None, **options):
+    """Benchmark a drive; ``options`` are passed to DiskBenchmark."""
+    if process_queue is not None:
+        process_queue.put("Running benchmark... Please wait.\n")
+    progress = ProgressTracker(process_queue)
+    results = DiskBenchmark(drive, process_queue=process_queue, cancel_event=cancel_event, progress=progress,
+                            **options).run()
+    logging.info(f"Benchmarked drive: {drive} - " + "; ".join(r.summary() for r in results),
+                 extra=log_fields(drive, "benchmark"))
+    return {"drive": drive, "results": [result.to_dict() for result in results]}
+
+
+def run_backup(drive, destination, process_queue=None, cancel_event=None, incremental=False,
+               hash_name=None, verify=None, **options):
+    """Back up a drive into ``destination``; ``options`` are passed to ParallelBackup.
+
+    A verified incremental backup records its digests in the manifest, so
+    later runs can list unchanged files in the checksum file too.
+    """
+    if process_queue is not None:
+        process_queue.put("Starting backup...\n")
+    scan = cached_scan(drive)  # A recent deep analysis saves the pre-scan
+    total_bytes, total_files = (scan.bytes, scan.files) if scan else scan_tree(drive)
+    progress = ProgressTracker(process_queue, total_bytes, total_files)
+    manifest = BackupManifest(destination, hash_name=hash_name or verify) if incremental else None
+    stats = ParallelBackup(drive, destination, process_queue=process_queue, manifest=manifest,
+                           cancel_event=cancel_event, progress=progress, verify=verify, **options).run()
+    if process_queue is not None:
+        if stats.verify_failures:
+            process_queue.put(f"\nBackup completed, but {len(stats.verify_failures)} files failed verification."
+                              f"\n{stats.summary()}\n")
+        else:
+            process_queue.put(f"\nBackup completed successfully.\n{stats.summary()}\n")
+    logging.info(f"Backed up drive: {drive} to {destination} - {stats.summary()}",
+                 extra=log_fields(drive, "backup", stats.bytes, stats.elapsed))
+    return dict(drive=drive, destination=destination, **stats.to_dict())
+
+
+def store_name(drive):
+    """Return the snapshot name for a drive: its label, else its mount point or letter."""
+    if sys.platform == "win32":
+        label = get_drive_label(drive)
+        name = drive[0] if label == "No Label" else label
+    else:
+        name = os.path.basename(os.path.normpath(drive))  # /media/<user>/<label>
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "drive"
+
+
+def run_store_backup(drive, store, name=None, process_queue=None, cancel_event=None, **options):
+    """Back up a drive into a deduplicating ChunkStore; ``options`` are passed to StoreBackup."""
+    name = name or store_name(drive)
+    if process_queue is not None:
+        process_queue.put(f"Starting backup of {drive} into the store {store} as \"{name}\"...\n")
+    scan = cached_scan(drive)
+    total_bytes, total_files = (scan.bytes, scan.files) if scan else scan_tree(drive)
+    progress = ProgressTracker(process_queue, total_bytes, total_files)
+    backup = StoreBackup(drive, store, name, process_queue=process_queue, cancel_event=cancel_event,
+                         progress=progress, **options)
+    stats = backup.run()
+    if process_queue is not None:
+        process_queue.put(f"\nBackup completed successfully.\n{stats.summary()}\n")
+    logging.info(f"Backed up drive: {drive} to store {store} as {name} - {stats.summary()}",
+                 extra=log_fields(drive, "store backup", stats.bytes, stats.elapsed))
+    return dict(drive=drive, store=store, name=name, snapshot=backup.snapshot, **stats.to_dict())
+
+
+def run_restore(store, name, destination, snapshot=None, process_queue=None, cancel_event=None):
+    """Restore the latest (or the given) snapshot of ``name`` from a ChunkStore."""
+    chunk_store = ChunkStore(store)
+    snapshot = snapshot or next(reversed(chunk_store.snapshots(name)), None)
+    if snapshot is None:
+        raise FileNotFoundError(f"No snapshots of \"{name}\" in {store}")
+    if process_queue is not None:
+        process_queue.put(f"Restoring {os.path.basename(snapshot)} of \"{name}\" to {destination}...\n")
+    stats = restore_snapshot(chunk_store, snapshot, destination, process_queue=process_queue,
+                             cancel_event=cancel_event)
+    if process_queue is not None:
+        process_queue.put(f"\nRestore completed.\n{stats.summary()}\n")
+    logging.info(f"Restored {snapshot} to {destination} - {stats.summary()}",
+                 extra=log_fields(destination, "restore", stats.bytes, stats.elapsed))
+    return dict(store=store, name=name, snapshot=snapshot, destination=destination, **stats.to_dict())
+
+
+def run_archive_backup(drive, destination, compression="gz", process_queue=None, cancel_event=None, **options):
+    """Back up a drive into one compressed tar archive; ``options`` are passed to ArchiveBackup.
+
+    ``destination`` is the archive file, or a folder to create
+    ``<drive>-<date>.tar.gz`` (or ``.tar.xz``) in.
+    """
+    archive = destination
+    if os.path.isdir(destination):
+        archive = os.path.join(destination, f"{store_name(drive)}-{time.strftime('%Y%m%d-%H%M%S')}.tar.{compression}")
+    if process_queue is not None:
+        process_queue.put(f"Starting archive backup to {archive}...\n")
+    scan = cached_scan(drive)
+    total_bytes, total_files = (scan.bytes, scan.files) if scan else scan_tree(drive)
+    progress = ProgressTracker(process_queue, total_bytes, total_files)
+    stats = ArchiveBackup(drive, archive, compression=compression, process_queue=process_queue,
+                          cancel_event=cancel_event, progress=progress, **options).run()
+    if process_queue is not None:
+        process_queue.put(f"\nBackup completed successfully.\n{stats.summary()}\n")
+    logging.info(f"Backed up drive: {drive} to {archive} - {stats.summary()}",
+                 extra=log_fields(drive, "archive backup", stats.bytes, stats.elapsed))
+    return dict(drive=drive, archive=archive, **stats.to_dict())
+
+
+def raw_device(drive):
+    """Return the device a drive lives on: the whole disk on Linux, the volume on Windows."""
+    if sys.platform == "win32":
+        return rf"\\.\{drive[0]}:"
+    import psutil
+    partition = next((p for p in psutil.disk_partitions(all=True) if drive in (p.device, p.mountpoint)), None)
+    if partition is None:
+        raise ValueError(f"No device found for {drive}")
+    name = os.path.basename(partition.device)
+    sys_path = os.path.join("/sys/class/block", name)
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        name = os.path.basename(os.path.dirname(os.path.realpath(sys_path)))  # sdb1 -> sdb
+    return os.path.join("/dev", name)
+
+
+def run_image(source, image, process_queue=None, cancel_event=None, allocation_map=False, **options):
+    """Image a device (or file) into a sparse file; ``options`` are passed to DiskImager.
+
+    A mounted drive given as ``source`` is imaged from its raw device.
+    """
+    if os.path.isdir(source):
+        source = raw_device(source)
+    if process_queue is not None:
+        process_queue.put(f"Imaging {source} to {image}...\n")
+    imager = DiskImager(source, image, map_out=image + IMAGE_MAP_SUFFIX if allocation_map else None,
+                        process_queue=process_queue, cancel_event=cancel_event,
+                        progress=ProgressTracker(process_queue), **options)
+    stats = imager.run()
+    if process_queue is not None:
+        process_queue.put(f"\nImage completed.\n{stats.summary()}\n")
+    logging.info(f"Imaged {source} to {image} - {stats.summary()}",
+                 extra=log_fields(source, "image", stats.size, stats.elapsed))
+    return dict(source=source, image=image, **stats.to_dict())
+
+
+def run_image_restore(image, target, process_queue=None, cancel_event=None, **options):
+    """Write an image back to a device (or file), using its allocation map if there is one."""
+    map_in = image + IMAGE_MAP_SUFFIX
+    if process_queue is not None:
+        process_queue.put(f"Restoring {image} to {target}...\n")
+    stats = DiskImager(image, target, map_in=map_in if os.path.exists(map_in) else None,
+                       process_queue=process_queue, cancel_event=cancel_event,
+                       progress=ProgressTracker(process_queue), **options).run()
+    if process_queue is not None:
+        process_queue.put(f"\nRestore completed.\n{stats.summary()}\n")
+    logging.info(f"Restored {image} to {target} - {stats.summary()}",
+                 extra=log_fields(target, "image restore", stats.size, stats.elapsed))
+    return dict(image=image, target=target, **stats.to_dict())
+
+
+def run_surface_test(drive, process_queue=None, cancel_event=None, **options):
+    """Fill a drive with test data and verify it; ``options`` are passed to SurfaceTest."""
+    if process_queue is not None:
+        process_queue.put("Running surface test... This writes the whole free space and can take hours.\n")
+    progress = ProgressTracker(process_queue)
+    result = SurfaceTest(drive, process_queue=process_queue, cancel_event=cancel_event, progress=progress,
+                         **options).run()
+    if process_queue is not None:
+        process_queue.put(result.summary() + "\n")
+    logging.info(f"Surface tested drive: {drive} - {result.ok_bytes} bytes OK, "
+                 f"{result.corrupted_bytes} corrupted, usable capacity {result.usable_capacity}",
+                 extra=log_fields(drive, "surface test", result.written_bytes + result.verified_bytes,
+                                  result.write_seconds + result.read_seconds))
+    return dict(drive=drive, **result.to_dict())
+
+
+def run_repair(drive, process_queue=None, cancel_event=None):
+    """Run ``chkdsk /f`` on a Windows drive and stream its output."""
+    if sys.platform != "win32":
+        raise OSError("Repair uses chkdsk and is only available on Windows")
+    drive_letter = drive[0]
+    if not drive_letter.isalpha():
+        raise ValueError(f"Invalid drive letter: {drive_letter}")
+
+    import ctypes
+    if not ctypes.windll.shell32.IsUserAnAdmin():
+        raise PermissionError("Please run the program as an administrator.")
+
+    # Use the full path to chkdsk
+    chkdsk_path = os.path.join(os.getenv("SystemRoot"), "System32", "chkdsk.exe")
+    process = subprocess.Popen([chkdsk_path, f"{drive_letter}:", "/f"], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True, shell=True,
+                               creationflags=subprocess.CREATE_NO_WINDOW)
+    if process_queue is not None:
+        process_queue.put("Repairing USB...\n")
+
+    # chkdsk reports "NN percent complete." while it works
+    progress = ProgressTracker(process_queue)
+    for line in iter(process.stdout.readline, ""):
+        if cancel_event is not None and cancel_event.is_set():
+            process.terminate()
+            raise OperationCancelled("Repair cancelled")
+        match = re.search(r"(\d+) percent", line)
+        if match:
+            progress.set_fraction(int(match.group(1)) / 100)
+        elif process_queue is not None:
+            process_queue.put(line)
+
+    returncode = process.wait()
+    progress.finish()
+    if process_queue is not None:
+        process_queue.put("\nRepair completed.\n")
+    logging.info(f"Repaired drive: {drive}", extra=log_fields(drive, "repair"))
+    return {"drive": drive, "returncode": returncode}
+
+
+HISTORY_FILENAME = "uct_history.sqlite3"
+HISTORY_KINDS = ("analysis", "benchmark", "surface test")  # Job kinds whose results are kept
+HISTORY_REGRESSION_THRESHOLD = 0.2  # Flag drives writing 20% slower than their baseline or batch
+HISTORY_BATCH_SIZE = 1000  # Results written per transaction at most
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS drives (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    serial TEXT,
+    label TEXT,
+    size INTEGER,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    drive_id INTEGER NOT NULL REFERENCES drives(id),
+    kind TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    batch TEXT NOT NULL,
+    write_mb_s REAL,
+    read_mb_s REAL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_drive ON runs(drive_id, kind, recorded, write_mb_s);
+CREATE INDEX IF NOT EXISTS runs_by_batch ON runs(batch, kind);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs(recorded);
+CREATE VIEW IF NOT EXISTS write_speeds AS
+SELECT d.key, d.serial, d.label, d.size, s.kind, s.runs,
+       (SELECT write_mb_s FROM runs r WHERE r.drive_id = s.drive_id AND r.kind = s.kind
+        AND r.write_mb_s IS NOT NULL ORDER BY r.recorded LIMIT 1) AS baseline,
+       (SELECT write_mb_s FROM runs r WHERE r.drive_id = s.drive_id AND r.kind = s.kind
+        AND r.write_mb_s IS NOT NULL ORDER BY r.recorded DESC LIMIT 1) AS latest,
+       (SELECT batch FROM runs r WHERE r.drive_id = s.drive_id AND r.kind = s.kind
+        AND r.write_mb_s IS NOT NULL ORDER BY r.recorded DESC LIMIT 1) AS latest_batch
+FROM (SELECT drive_id, kind, COUNT(*) AS runs FROM runs WHERE write_mb_s IS NOT NULL
+      GROUP BY drive_id, kind) s
+JOIN drives d ON d.id = s.drive_id;
+"""
+
+
+def _disk_id(device):
+    """Return the udev by-id name (bus, model and serial) of a Linux disk, or None."""
+    by_id = "/dev/disk/by-id"
+    try:
+        names = sorted(os.listdir(by_id))
+    except OSError:
+        return None
+    device = os.path.realpath(device)
+    for prefix in ("usb-", "ata-", "nvme-", "mmc-", "scsi-", ""):
+        for name in names:
+            if name.startswith(prefix) and "-part" not in name and not name.startswith("wwn-") \
+                    and os.path.realpath(os.path.join(by_id, name)) == device:
+                return name
+    return None
+
+
+def _volume_serial(drive):
+    """Return the serial number of a Windows volume as hex, or None."""
+    import ctypes
+    serial = ctypes.c_uint32()
+    if not ctypes.windll.kernel32.GetVolumeInformationW(ctypes.c_wchar_p(drive[0] + ":\\"), None, 0,
+                                                        ctypes.byref(serial), None, None, None, 0):
+        return None
+    return f"{serial.value:08X}"
+
+
+def drive_identity(drive):
+    """Return ``(serial, label, size)`` of the drive behind a path; serial and size may be None.
+
+    The serial is the udev by-id name of the whole disk on Linux and the
+    volume serial on Windows; a plain directory or image file has none.
+    """
+    label = store_name(drive)
+    try:
+        if os.path.isdir(drive):
+            size = shutil.disk_usage(drive).total
+        else:
+            with open(drive, "rb") as f:
+                size = device_size(f.fileno())
+    except OSError:
+        size = None
+    try:
+        if sys.platform == "win32":
+            serial = _volume_serial(drive)
+        else:
+            serial = _disk_id(raw_device(drive) if os.path.isdir(drive) else drive)
+    except (OSError, ValueError):
+        serial = None
+    return serial, label, size
+
+
+def _result_speeds(kind, result):
+    """Return the ``(write, read)`` MB/s of a result that are compared across runs."""
+    if kind == "benchmark":
+        speeds = {}  # profile -> (block size, mean MB/s) at the largest block size
+        for entry in result.get("results", ()):
+            if entry["profile"] in ("seq-write", "seq-read") \
+                    and entry["block_size"] >= speeds.get(entry["profile"], (0, None))[0]:
+                speeds[entry["profile"]] = (entry["block_size"], entry["mb_per_second"]["mean"])
+        return speeds.get("seq-write", (0, None))[1], speeds.get("seq-read", (0, None))[1]
+    if kind == "surface test":
+        return result.get("write_mb_per_second"), result.get("read_mb_per_second")
+    return None, None
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+class ResultsHistory:
+    """Benchmark, analysis and surface test results kept in a SQLite database.
+
+    Runs are keyed by drive identity (see drive_identity) rather than by
+    mount point, so a stick keeps its history whatever letter or folder it
+    gets. ``record`` only queues the result: a writer thread resolves the
+    drive and inserts everything queued in one transaction, so callers on
+    an I/O path never wait for the database. Every ``ResultsHistory``
+    instance is one ``batch`` (one GUI session or CLI run), which is what
+    ``regressions`` compares drives within.
+    """
+
+    def __init__(self, path=HISTORY_FILENAME, batch=None):
+        self.path = path
+        self.batch = batch or time.strftime("%Y%m%d-%H%M%S")
+        self._db = self._connect()
+        self._db.executescript(HISTORY_SCHEMA)
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="uct-history", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.row_factory = sqlite3.Row
+        return db
+
+    def record(self, kind, drive, result):
+        """Queue a result dict for writing; returns immediately."""
+        self._queue.put((kind, drive, result, time.time()))
+
+    def flush(self):
+        """Block until everything recorded so far is written."""
+        self._queue.join()
+
+    def close(self):
+        """Write what is queued and close the database."""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._db.close()
+
+    def _write_loop(self):
+        """Writer thread: insert queued results in batches."""
+        db = self._connect()
+        running = True
+        while running:
+            items = [self._queue.get()]
+            while len(items) < HISTORY_BATCH_SIZE:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            running = None not in items
+            try:
+                self._write(db, [item for item in items if item is not None])
+            except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+                logging.error(f"Error writing results history {self.path}: {e}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+        db.close()
+
+    def _write(self, db, items):
+        """Insert results (and their drives) in one transaction."""
+        identities = {}  # drive path -> (serial, label, size), resolved once per batch
+        rows = []
+        for kind, drive, result, recorded in items:
+            if drive not in identities:
+                identities[drive] = drive_identity(drive)
+            serial, label, size = identities[drive]
+            key = f"serial:{serial}" if serial else f"label:{label}:{size or 0}"
+            write_mb_s, read_mb_s = _result_speeds(kind, result)
+            rows.append((key, serial, label, size, recorded, kind, self.batch, write_mb_s, read_mb_s,
+                         json.dumps(result, default=str)))
+        with db:
+            db.executemany("INSERT INTO drives (key, serial, label, size, first_seen, last_seen) "
+                           "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                           "label = excluded.label, size = excluded.size, last_seen = excluded.last_seen",
+                           [row[:5] + (row[4],) for row in rows])
+            db.executemany("INSERT INTO runs (drive_id, kind, recorded, batch, write_mb_s, read_mb_s, result) "
+                           "SELECT id, ?, ?, ?, ?, ?, ? FROM drives WHERE key = ?",
+                           [(kind, recorded, batch, write_mb_s, read_mb_s, result, key)
+                            for key, _, _, _, recorded, kind, batch, write_mb_s, read_mb_s, result in rows])
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params)]
+
+    def drives(self):
+        """Return every drive seen, most recently seen first."""
+        return self._query("SELECT key, serial, label, size, first_seen, last_seen FROM drives "
+                           "ORDER BY last_seen DESC")
+
+    def runs(self, drive=None, kind=None, limit=100):
+        """Return the latest runs, optionally of one drive (its key) and/or kind, newest first."""
+        where, params = [], []
+        if drive is not None:
+            where.append("d.key = ?")
+            params.append(drive)
+        if kind is not None:
+            where.append("r.kind = ?")
+            params.append(kind)
+        rows = self._query("SELECT r.id, d.key, d.label, r.kind, r.recorded, r.batch, r.write_mb_s, r.read_mb_s, "
+                           "r.result FROM runs r JOIN drives d ON d.id = r.drive_id "
+                           + ("WHERE " + " AND ".join(where) if where else "")
+                           + " ORDER BY r.recorded DESC LIMIT ?", params + [limit])
+        for row in rows:
+            row["result"] = json.loads(row["result"])
+        return rows
+
+    def write_speeds(self, kind="benchmark"):
+        """Return each drive's first (baseline) and latest sustained write speed."""
+        return self._query("SELECT * FROM write_speeds WHERE kind = ?", (kind,))
+
+    def regressions(self, threshold=HISTORY_REGRESSION_THRESHOLD, kind="benchmark"):
+        """Return drives whose latest write speed is ``threshold`` (a fraction) below their
+        own baseline or below the median of the drives last tested in the same batch."""
+        speeds = self.write_speeds(kind)
+        batches = {}
+        for row in speeds:
+            batches.setdefault(row["latest_batch"], []).append(row["latest"])
+        flagged = []
+        for row in speeds:
+            row["batch_median"] = _median(batches[row["latest_batch"]])
+            row["drop_from_baseline"] = 1 - row["latest"] / row["baseline"] if row["baseline"] else 0.0
+            row["drop_from_batch"] = 1 - row["latest"] / row["batch_median"] if row["batch_median"] else 0.0
+            if row["drop_from_baseline"] > threshold or row["drop_from_batch"] > threshold:
+                flagged.append(row)
+        return flagged
+
+
+class Job:
+    """One benchmark, backup or repair operation queued for a device."""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, device, func, kwargs):
+        self.id = next(self._ids)
+        self.kind = kind
+        self.device = device
+        self.func = func
+        self.kwargs = kwargs
+        self.state = self.PENDING
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.progress = None  # Latest ProgressUpdate
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def finished_state(self):
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def status_line(self):
+        """Return a one-line description of the job's state."""
+        line = f"[Job {self.id}] {self.kind} on {self.device}: {self.state}"
+        if self.error is not None:
+            line += f" ({self.error})"
+        return line
+
+    def to_dict(self):
+        """Return the job as plain data."""
+        return {"id": self.id, "kind": self.kind, "device": self.device, "state": self.state,
+                "error": str(self.error) if self.error is not None else None, "result": self.result,
+                "submitted": self.submitted, "started": self.started, "finished": self.finished}
+
+
+class _JobMessages:
+    """Queue adapter that tags a job's messages with the device it runs on."""
+
+    def __init__(self, job, process_queue):
+        self.job = job
+        self.process_queue = process_queue
+
+    def put(self, message):
+        if isinstance(message, ProgressUpdate):
+            message.job = self.job
+            self.job.progress = message
+            self.process_queue.put(message)
+        else:
+            self.process_queue.put(f"[{self.job.device}] {message}")
+
+
+class JobScheduler:
+    """Run jobs on several devices at once.
+
+    A device only ever runs one job at a time, at most ``max_concurrent`` jobs
+    run in total, and everything else waits in submission order. Job messages
+    and the Job objects themselves (whenever their state changes) are put on
+    ``process_queue``. Results of finished HISTORY_KINDS jobs are recorded in
+    ``history`` (a ResultsHistory) if one is given.
+    """
+
+    def __init__(self, max_concurrent=4, process_queue=None, history=None):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.process_queue = process_queue
+        self.history = history
+        self.jobs = []
+        self._pending = deque()
+        self._busy_devices = set()
+        self._running = 0
+        self._lock = threading.Condition()
+
+    @staticmethod
+    def device_key(device):
+        """Normalize a device path so different spellings share one lock."""
+        return os.path.normcase(os.path.abspath(device))
+
+    def submit(self, kind, device, func, **kwargs):
+        """Queue ``func(device, process_queue=..., cancel_event=..., **kwargs)``."""
+        job = Job(kind, device, func, kwargs)
+        with self._lock:
+            self.jobs.append(job)
+            self._pending.append(job)
+        self._notify(job)
+        self._dispatch()
+        return job
+
+    def cancel(self, job):
+        """Cancel a job; queued jobs never start, running jobs stop at the next check."""
+        with self._lock:
+            if job.finished_state:
+                return False
+            job.cancel_event.set()
+            if job.state != Job.PENDING:
+                return True
+            self._pending.remove(job)
+            job.state = Job.CANCELLED
+            job.finished = time.time()
+            self._lock.notify_all()
+        self._notify(job)
+        return True
+
+    def cancel_device(self, device):
+        """Cancel every unfinished job on a device; returns how many were cancelled."""
+        key = self.device_key(device)
+        with self._lock:
+            jobs = [job for job in self.jobs if self.device_key(job.device) == key and not job.finished_state]
+        return sum(self.cancel(job) for job in jobs)
+
+    def is_busy(self, device):
+        """Return True if a job is running on the device."""
+        with self._lock:
+            return self.device_key(device) in self._busy_devices
+
+    def active_jobs(self):
+        """Return the jobs that are queued or running."""
+        with self._lock:
+            return [job for job in self.jobs if not job.finished_state]
+
+    def wait(self, timeout=None):
+        """Block until no jobs are queued or running; returns False on timeout."""
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._pending and not self._running, timeout)
+
+    def _dispatch(self):
+        """Start every queued job whose device is free, up to the concurrency cap."""
+        started = []
+        with self._lock:
+            for job in list(self._pending):
+                if self._running >= self.max_concurrent:
+                    break
+                key = self.device_key(job.device)
+                if key in self._busy_devices:
+                    continue
+                self._pending.remove(job)
+                self._busy_devices.add(key)
+                self._running += 1
+                job.state = Job.RUNNING
+                job.started = time.time()
+                started.append(job)
+
+        for job in started:
+            self._notify(job)
+            threading.Thread(target=self._run_job, args=(job,), name=f"uct-job-{job.id}", daemon=True).start()
+
+    def _run_job(self, job):
+        """Run one job on its own thread."""
+        messages = _JobMessages(job, self.process_queue) if self.process_queue is not None else None
+        try:
+            job.result = job.func(job.device, process_queue=messages, cancel_event=job.cancel_event, **job.kwargs)
+            job.state = Job.DONE
+            if self.history is not None and job.kind in HISTORY_KINDS:
+                self.history.record(job.kind, job.device, job.result)
+        except OperationCancelled as e:
+            job.error = e
+            job.state = Job.CANCELLED
+        except Exception as e:
+            job.error = e
+            job.state = Job.FAILED
+            logging.error(f"{job.kind} failed on {job.device}: {e}")
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                self._busy_devices.discard(self.device_key(job.device))
+                self._running -= 1
+                self._lock.notify_all()
+            self._notify(job)
+            self._dispatch()
+
+    def _notify(self, job):
+        """Post a job's state change to the process queue."""
+        if self.process_queue is not None:
+            self.process_queue.put(job)
+
+
+class ConsoleBuffer:
+    """Batch queued messages for a text console.
+
+    ``drain`` is called once per UI tick: it takes messages off the queue for
+    at most ``time_budget`` milliseconds, passes non-text messages (Job,
+    ProgressUpdate, ...) to a handler and returns the text of the last
+    ``max_lines`` messages as one string, so the UI does one insert per tick
+    however many messages arrived. ``interval`` adapts the polling delay: it
+    drops to ``min_interval`` while a backlog remains and backs off to
+    ``max_interval`` when the queue is idle.
+    """
+
+    def __init__(self, max_lines=5000, time_budget=15, min_interval=20, max_interval=200):
+        self.max_lines = max_lines
+        self.time_budget = time_budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.dropped = 0
+        self._pending = deque(maxlen=max_lines)
+        self._received = 0
+
+    def write(self, text):
+        """Add text for the next insert (call from the UI thread)."""
+        self._received += 1
+        self._pending.append(text)
+
+    def drain(self, process_queue, handle_object=None):
+        """Collect pending messages and return the text to insert (may be empty)."""
+        deadline = time.perf_counter() + self.time_budget / 1000
+        taken = 0
+        backlog = False
+        while True:
+            try:
+                message = process_queue.get_nowait()
+            except Empty:
+                break
+            taken += 1
+            if isinstance(message, str):
+                self.write(message)
+            elif handle_object is not None:
+                handle_object(message)
+            if taken % 256 == 0 and time.perf_counter() > deadline:
+                backlog = True
+                break
+
+        if backlog:
+            self.interval = self.min_interval  # Come back soon for the rest
+        elif taken:
+            self.interval = max(self.min_interval, self.interval // 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+
+        skipped = self._received - len(self._pending)
+        text = "".join(self._pending)
+        self._pending.clear()
+        self._received = 0
+        if skipped > 0:
+            self.dropped += skipped
+            text = f"... {skipped} messages skipped ...\n" + text
+        return text